@@ -0,0 +1,58 @@
+"""
+Compare re-fetching `/availability` of every product with following the change feed, after random inventory changes.
+
+Usage: python benchmarks/change_feed.py [--days N] [--changes N,N,...]
+"""
+import argparse
+from datetime import date, timedelta
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from supplier_server.app import app  # noqa: E402
+from supplier_server.drift import Drift  # noqa: E402
+from supplier_server.registry import registry  # noqa: E402
+
+HEADERS = {'API-Key': 'secret'}
+
+
+def measure(client, urls):
+    """Bytes and seconds of the responses to `urls`, and the last body."""
+    started = time.perf_counter()
+    # streamed responses are read before the next request
+    bodies = [client.get(url, headers=HEADERS).data for url in urls]
+    return sum(len(body) for body in bodies), time.perf_counter() - started, bodies[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--days', type=int, default=30, help='days of availability polled')
+    parser.add_argument('--changes', default='10,100,1000', help='inventory changes between two polls')
+    args = parser.parse_args()
+
+    client = app.test_client()
+    start = date.today()
+    end = start + timedelta(days=args.days - 1)
+    full_urls = [f'/v2/products/{product.id}/availability?start={start}&end={end}' for product in registry.products]
+    drift = Drift(1, 1, args.days)
+    cursor = client.get('/v2/availability/changes', headers=HEADERS).json['cursor']
+
+    print(f'{registry.stats()["products"]} products, {args.days} days')
+    print(f'{"changes":>8}{"full bytes":>14}{"full time":>12}{"feed bytes":>12}{"feed time":>12}{"saved":>8}')
+    for changes in (int(n) for n in args.changes.split(',')):
+        drift.apply(changes)
+        feed_url = f'/v2/availability/changes?cursor={cursor}&limit={changes * 2}'
+        feed_size, feed_time, feed = measure(client, [feed_url])
+        cursor = json.loads(feed)['cursor']
+        full_size, full_time, _ = measure(client, full_urls)
+        print(
+            f'{changes:>8}{full_size:>14}{full_time * 1000:>10.1f}ms{feed_size:>12}{feed_time * 1000:>10.1f}ms'
+            f'{1 - feed_size / full_size:>8.1%}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Compare response sizes and compression/decompression times per encoding and level.
+
+Usage: python benchmarks/compression.py [--number N] [--days N]
+"""
+import argparse
+from datetime import date, timedelta
+import gzip
+import os
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from supplier_server import availability, compression  # noqa: E402
+from supplier_server.app import app  # noqa: E402
+from supplier_server.registry import registry  # noqa: E402
+
+LEVELS = {
+    'gzip': (1, 6, 9),
+    'br': (1, 5, 11),
+}
+
+
+def decompressor(encoding: str):
+    if encoding == 'br':
+        return compression.brotli.decompress
+    return gzip.decompress
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=50, help='runs per measurement')
+    parser.add_argument('--days', type=int, default=180, help='days of availability')
+    args = parser.parse_args()
+
+    start = date.today()
+    end = start + timedelta(days=args.days)
+    product = registry.require('A300-FX')
+    bodies = {
+        f'availability A300-FX ({args.days} days)': app.json.dumps_compact(availability.get_range(product, start, end)),
+        'products': app.json.dumps_compact(registry.public),
+    }
+    encodings = [encoding for encoding in LEVELS if encoding != 'br' or compression.brotli is not None]
+
+    print(f'{"body":<36}{"encoding":>10}{"level":>7}{"bytes":>10}{"ratio":>8}{"compress":>12}{"decompress":>12}')
+    for name, body in bodies.items():
+        print(f'{name:<36}{"identity":>10}{"-":>7}{len(body):>10}{1:>8.1f}{"-":>12}{"-":>12}')
+        for encoding in encodings:
+            for level in LEVELS[encoding]:
+                compressed = compression.compress(body, encoding, level)
+                compress_ms = timeit(lambda: compression.compress(body, encoding, level), number=args.number)
+                decompress = decompressor(encoding)
+                decompress_ms = timeit(lambda: decompress(compressed), number=args.number)
+                print(
+                    f'{name:<36}{encoding:>10}{level:>7}{len(compressed):>10}{len(body) / len(compressed):>8.1f}'
+                    f'{compress_ms / args.number * 1000:>10.3f}ms{decompress_ms / args.number * 1000:>10.3f}ms'
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+"""
+Generate a large product catalog for the catalog backends.
+
+Usage: python benchmarks/generate_catalog.py OUTPUT [--products N]
+
+The format follows the extension of OUTPUT: `.json`, `.ndjson` or `.db` (SQLite). Serve it with
+`SUPPLIER_SERVER_CATALOG=OUTPUT` (`sqlite:///OUTPUT` for SQLite).
+"""
+import argparse
+from itertools import cycle, islice
+import json
+import os
+import sys
+from typing import Dict, Iterator
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from supplier_server import catalog, constants  # noqa: E402
+
+
+def generate(count: int) -> Iterator[Dict]:
+    """`count` products cycling through the built-in ones, with unique ids."""
+    for n, product in enumerate(islice(cycle(constants.PRODUCTS), count)):
+        product_id = f'{product["id"]}-{n:07d}'
+        yield dict(product, id=product_id, name=product_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('output', help='.json, .ndjson or .db file to write')
+    parser.add_argument('--products', type=int, default=100000, help='number of products')
+    args = parser.parse_args()
+
+    products = generate(args.products)
+    if args.output.endswith('.db'):
+        catalog.create_sqlite(args.output, products)
+    elif args.output.endswith(('.ndjson', '.jsonl')):
+        with open(args.output, 'w') as f:
+            f.writelines(json.dumps(product) + '\n' for product in products)
+    elif args.output.endswith('.json'):
+        with open(args.output, 'w') as f:
+            json.dump(list(products), f)
+    else:
+        sys.exit('OUTPUT must end with .json, .ndjson or .db')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""
+Compare the JSON serializers on the /availability and /v2/products response paths.
+
+Usage: python benchmarks/json_serializer.py [--number N]
+"""
+import argparse
+from datetime import date, timedelta
+import os
+import sys
+from timeit import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from supplier_server import availability, constants, serialization  # noqa: E402
+from supplier_server.app import app  # noqa: E402
+from supplier_server.registry import registry  # noqa: E402
+
+HEADERS = {'API-Key': 'secret'}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=200, help='requests per measurement')
+    args = parser.parse_args()
+
+    # measure encoding, not streaming or generation
+    constants.AVAILABILITY_STREAMING_MIN_DAYS = 10 ** 6
+    start = date.today()
+    end = start + timedelta(days=180)
+    product = registry.require('A300-FX')
+    payload = availability.get_range(product, start, end)
+
+    cases = {
+        'encode 6 months of availability': None,
+        'GET /v2/products/A300-FX/availability (6 months)': (
+            f'/v2/products/A300-FX/availability?start={start}&end={end}'
+        ),
+        'GET /v2/products': '/v2/products',
+    }
+    client = app.test_client()
+    names = [name for name in serialization.PROVIDERS if name != 'orjson' or serialization.orjson is not None]
+
+    print(f'{"case":<52}' + ''.join(f'{name:>12}' for name in names) + f'{"speedup":>10}')
+    for case, url in cases.items():
+        timings = []
+        for name in names:
+            serialization.install(app, name)
+            with app.app_context():
+                if url is None:
+                    seconds = timeit(lambda: app.json.response(payload), number=args.number)
+                else:
+                    seconds = timeit(lambda: client.get(url, headers=HEADERS), number=args.number)
+            timings.append(seconds / args.number * 1000)
+        speedup = f'{timings[0] / timings[-1]:.2f}x' if len(timings) > 1 else '-'
+        print(f'{case:<52}' + ''.join(f'{ms:>10.3f}ms' for ms in timings) + f'{speedup:>10}')
+
+
+if __name__ == '__main__':
+    main()
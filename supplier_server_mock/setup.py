@@ -18,6 +18,7 @@ setuptools.setup(
     entry_points='''
         [console_scripts]
         supplier_server=supplier_server.app:run
+        supplier_server_serve=supplier_server.serve:main
     ''',
     classifiers=[
         'Programming Language :: Python',
@@ -28,4 +29,10 @@ setuptools.setup(
     ],
     python_requires='>=3.7',
     install_requires=requirements,
+    extras_require={
+        'fast': ['orjson'],
+        'asgi': ['uvicorn'],
+        'brotli': ['brotli'],
+        'yaml': ['PyYAML'],
+    },
 )
@@ -1,278 +1,320 @@
-import binascii
-from datetime import date, datetime, timedelta
-from datetime import timezone
-from typing import Dict
-from typing import List
+import time
+from typing import Optional
 
 import werkzeug
 
-import arrow
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
 
-from .utils import product_provides_pricing
 from .auth import authorization_header
 from .validation import date_range_validator
-from . import constants, error_handlers, exceptions, utils
+from .registry import registry
+from . import availability as availability_engine
+from . import broadcast, compression, conditional, constants, error_handlers, exceptions, faults, handlers, idempotency
+from . import keys, ledger, metrics, profiling, serialization, streaming, table
 
 app = Flask('supplier_server')
+serialization.install(app, constants.JSON_SERIALIZER)
 app.register_error_handler(werkzeug.exceptions.MethodNotAllowed, error_handlers.bad_method)
 app.register_error_handler(werkzeug.exceptions.InternalServerError, error_handlers.server_error)
 app.register_error_handler(exceptions.BadRequest, error_handlers.bad_request)
 
+if constants.AVAILABILITY_TABLE:
+    table.install(constants.AVAILABILITY_TABLE, registry)
+
+if constants.LEDGER_DIR:
+    handlers.restore(ledger.install(constants.LEDGER_DIR))
+
+
+@app.before_request
+def start_request_metrics():
+    g.metrics_started = time.perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+
+
+@app.after_request
+def record_request_metrics(response: Response) -> Response:
+    # registered first so it runs last and sees the response as it is sent
+    started = g.pop('metrics_started', None)
+    if started is None:
+        return response
+    route, method, status = request.endpoint or 'unmatched', request.method, response.status_code
+    request_size = request.content_length or 0
+    sent = None
+    if response.is_streamed:
+        sent = [0]
+        response.response = metrics.count_bytes(response.iter_encoded(), sent)
+
+    def observe():
+        metrics.REQUESTS_IN_FLIGHT.dec()
+        handlers.update_state_metrics()
+        if method == 'HEAD':
+            size = 0
+        else:
+            size = sent[0] if sent is not None else response.calculate_content_length()
+        metrics.observe_request(route, method, status, time.perf_counter() - started, request_size, size)
+
+    response.call_on_close(observe)
+    return response
+
+
+@app.before_request
+def admit_request():
+    # registered before the fault hooks, a request over its quota is answered at once
+    api_key = keys.lookup(request.headers.get('API-Key'))
+    if api_key is None:
+        return None  # answered by `authorization_header`, unless the route is public
+    wait = api_key.acquire()
+    if wait is not None:
+        body, status = error_handlers.too_many_requests(None)
+        return Response(body, status, headers={'Retry-After': keys.retry_after(wait)})
+    g.api_key = api_key
+    return None
+
+
+@app.after_request
+def release_request(response: Response) -> Response:
+    api_key = g.get('api_key')
+    if api_key is None:
+        return response
+    if response.is_streamed:
+        # the request holds its slot until the body is sent
+        response.call_on_close(api_key.release)
+    else:
+        api_key.release()
+    return response
+
+
+@app.before_request
+def inject_faults():
+    api_key = g.get('api_key')
+    if faults.injector is None or api_key is None:
+        return None
+    profile_name = request.headers.get(faults.PROFILE_HEADER) or api_key.scenario
+    plan = faults.injector.plan(request.endpoint, request.headers.get('API-Key'), profile_name)
+    if plan is None:
+        return None
+    g.fault_plan = plan
+    # the Flask server blocks the worker thread while waiting, so the waits of a request are capped, see `faults`
+    g.fault_deadline = time.monotonic() + constants.FAULT_SYNC_MAX_WAIT
+    if plan.delay:
+        time.sleep(min(plan.delay, constants.FAULT_SYNC_MAX_WAIT))
+    if plan.error == '500':
+        return error_handlers.server_error(None)
+    if plan.error == '503':
+        return error_handlers.service_unavailable(None)
+    if plan.error == 'timeout':
+        time.sleep(max(0.0, min(plan.timeout, g.fault_deadline - time.monotonic())))
+        return error_handlers.gateway_timeout(None)
+    return None
+
+
+@app.after_request
+def inject_response_faults(response: Response) -> Response:
+    plan = g.get('fault_plan')
+    if plan is None:
+        return response
+    if plan.error == 'reset':
+        response.response = faults.reset(response.iter_encoded())
+    elif plan.bandwidth:
+        response.response = faults.throttle(response.iter_encoded(), plan.bandwidth, g.fault_deadline)
+    return response
+
+
+@app.before_request
+def start_profile():
+    # registered after the fault hooks, a request answered with an injected error isn't profiled
+    if profiling.profiler is None or request.endpoint is None:
+        return None
+    requested = request.headers.get(profiling.HEADER) == '1' and g.get('api_key') is not None
+    g.profile = profiling.profiler.start(request.endpoint, requested)
+
+
+@app.after_request
+def stop_profile(response: Response) -> Response:
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    route = request.endpoint
+    if response.is_streamed:
+        # the body is generated while it is sent
+        response.call_on_close(lambda: profiling.profiler.stop(profile, route))
+    else:
+        profiling.profiler.stop(profile, route)
+    return response
+
+
+def not_modified(etag: str) -> Response:
+    """304 with the ETag of the representation the request would get, see `compress_response`."""
+    response = Response(status=304)
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    response.headers['ETag'] = compression.representation_etag(etag, encoding) if encoding else etag
+    if compression.ENCODINGS:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def with_etag(response: Response, etag: str) -> Response:
+    response.headers['ETag'] = etag
+    return response
+
+
+@app.after_request
+def compress_response(response: Response) -> Response:
+    # registered after the fault hooks so it runs before them, faults apply to the bytes on the wire
+    if (
+        not compression.ENCODINGS
+        or response.status_code != 200
+        or 'Content-Encoding' in response.headers
+        or not compression.is_compressible(response.mimetype)
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+    etag = response.headers.get('ETag')
+    if response.is_streamed:
+        body = response.response
+        response.response = compression.compress_stream(body, encoding, etag, getattr(body, 'close', None))
+    else:
+        data = response.get_data()
+        if not compression.worth_compressing(len(data)):
+            return response
+        response.set_data(compression.compress_cached(data, encoding, etag))
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.headers['ETag'] = compression.representation_etag(etag, encoding)
+    return response
+
+
+def from_compression_cache(etag: str) -> Optional[Response]:
+    """The cached compressed response with `etag` for this request, its body is neither built nor compressed again."""
+    encoding = compression.negotiate(request.headers.get('Accept-Encoding'))
+    body = compression.cached(etag, encoding)
+    if body is None:
+        return None
+    response = app.response_class(body, mimetype='application/json')
+    response.headers['Content-Encoding'] = encoding
+    response.headers['ETag'] = compression.representation_etag(etag, encoding)
+    response.vary.add('Accept-Encoding')
+    return response
+
 
 @app.route('/v2/products')
 @authorization_header
 def products():
-    # expose public attributes only
-    return jsonify([{k: p[k] for k in p.keys() if not k.startswith('_')} for p in constants.PRODUCTS])
+    etag = handlers.products_etag(g.api_key)
+    if conditional.matches(request.headers.get('If-None-Match'), etag):
+        return not_modified(etag)
+    return from_compression_cache(etag) or with_etag(jsonify(handlers.products(g.api_key)), etag)
 
 
 @app.route('/v2/products/<product_id>/availability')
 @authorization_header
 @date_range_validator
 def availability(product_id: str):
-    utils.check_product_id(product_id)
-    start = utils.get_date(request.args, 'start')
-    end = utils.get_date(request.args, 'end')
-    if start > end:
-        raise exceptions.BadRequest(2001, 'Incorrect date range', 'The end date cannot be earlier than start date')
-    today = date.today()
-    if end < today:
+    window = handlers.availability_window(product_id, request.args, g.api_key)
+    if window is None:
         return jsonify({})
-    start = max(today, start)
-    result = {}
-    day = start
-    while day <= end:
-        result.update(utils.get_availability(product_id, day))
-        day = day + timedelta(days=1)
-    return jsonify(result)
+    product, start, end = window
+    etag = handlers.availability_etag(product, start, end)
+    if conditional.matches(request.headers.get('If-None-Match'), etag):
+        return not_modified(etag)
+    cached = from_compression_cache(etag)
+    if cached is not None:
+        return cached
+    if handlers.should_stream(start, end):
+        return with_etag(streaming.stream_json_object(availability_engine.iter_range(product, start, end)), etag)
+    return with_etag(jsonify(availability_engine.get_range(product, start, end)), etag)
+
+
+@app.route('/v2/products/<product_id>/availability/stream')
+@authorization_header
+def availability_stream(product_id: str):
+    product = g.api_key.product(product_id)
+    events = broadcast.broadcaster.iter_events(product.id, request.headers.get('Last-Event-ID'), app.json.dumps_compact)
+    return Response(events, mimetype=broadcast.CONTENT_TYPE, headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@app.route('/v2/availability', methods=['GET', 'POST'])
+@authorization_header
+def bulk_availability():
+    data = request.args if request.method == 'GET' else request.json
+    return streaming.stream_json_objects(handlers.bulk_availability(data.get('product_ids'), data, g.api_key))
+
+
+@app.route('/v2/availability/changes')
+@authorization_header
+def availability_changes():
+    return jsonify(handlers.availability_changes(request.args, g.api_key))
 
 
 @app.route('/v2/products/<product_id>/reservation', methods=['POST'])
 @authorization_header
 def reservation(product_id: str):
-    utils.check_product_id(product_id)
-
-    datetime_parameter_value = request.json.get('datetime')
-    if not datetime_parameter_value:
-        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "datetime" was not found')
-
-    tickets = request.json.get('tickets')
-    if not tickets:
-        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "tickets" was not found')
-
-    customer = request.json.get('customer')
-    if not customer:
-        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "customer" was not found')
-
-    # get the additional order-level information required by this product
-    product_requires_additional_order_data = utils.product_required_additional_order_data(product_id)
-    if product_requires_additional_order_data:
-        required_order_data = request.json.get('required_order_data', {})
-        required_order_data_keys = required_order_data.keys()
-        missing_fields = product_requires_additional_order_data.difference(required_order_data_keys)
-        if not required_order_data or missing_fields:
-            raise exceptions.BadRequest(
-                1003,
-                'Missing required fields',
-                f'Missing required additional order data: {",".join(missing_fields)}',
-            )
-
-    # extract date and timeslot information from datetime attribute
-    try:
-        datetime_parameter = datetime.strptime(datetime_parameter_value, '%Y-%m-%dT%H:%M')
-        day = datetime_parameter.date()
-        timeslot: str = datetime_parameter.time().strftime('%H:%M')
-    except ValueError:
-        raise exceptions.BadRequest(
-            2000,
-            'Malformed datetime',
-            f'Expected datetime attribute with format YYYY-MM-DDTHH:MM'
-        )
-
-    today_utc = datetime.utcnow().date()
-    if day < today_utc:
-        raise exceptions.BadRequest(2009, 'Incorrect date', 'Cannot use the past date')
-
-    if day > arrow.get(today_utc).shift(months=constants.MAX_DATE_RANGE).date():
-        raise exceptions.BadRequest(
-            2009,
-            'Incorrect date',
-            f'This date is too far ahead in the future. You can book max {constants.MAX_DATE_RANGE} months ahead.'
-        )
-
-    # if the product doesn't support timeslots then set the time component to 00:00 to extract availability for that
-    # date/time
-    timeslot_availability_key: str = (
-        datetime_parameter_value if utils.product_supports_timeslot(product_id) else f'{day}T00:00'
-    )
-
-    product_availability: Dict = utils.get_availability(product_id, day)
-
-    # map variant ids to available tickets
-    variant_quantity_mapping: Dict[str, int] = {
-        str(variant['id']): variant['available_tickets']
-        for variant in product_availability.get(timeslot_availability_key, {}).get('variants', [])
-    }
-
-    # get the additional visitors-level information required by this product
-    product_requires_additional_visitors_data = utils.product_required_additional_visitors_data(product_id)
-
-    for ticket in tickets:
-        ticket_variant_id = str(ticket['variant_id'])
-        if (
-                not variant_quantity_mapping.get(ticket_variant_id)
-                or (ticket['quantity'] > variant_quantity_mapping.get(ticket_variant_id))
-        ):
-            raise exceptions.BadRequest(
-                3000,
-                'Availability error',
-                f'The requested number of tickets is not longer available for the given variant and/or timeslot'
-            )
-
-        if product_requires_additional_visitors_data:
-            required_visitor_data: List[Dict] = ticket.get('required_visitor_data', [])
-
-            if not required_visitor_data or len(required_visitor_data) != ticket['quantity']:
-                missing_qty = ticket['quantity'] - len(required_visitor_data)
-                raise exceptions.BadRequest(
-                    1003, 'Missing required fields', f'Missing visitor information for {missing_qty} visitors',
-                )
-
-            for visitor_data in required_visitor_data:
-                missing_fields = product_requires_additional_visitors_data.difference(visitor_data.keys())
-                if missing_fields:
-                    raise exceptions.BadRequest(
-                        1003,
-                        'Missing required fields',
-                        f'Missing required additional visitor data: {",".join(missing_fields)}'
-                    )
-
-    expires_at = arrow.utcnow().shift(minutes=30)
-    reservation_date = datetime.fromisoformat(day.isoformat() + " " + timeslot)
-
-    reservation_response = {
-        'reservation_id': utils.encode_reservation_id(expires_at, tickets, product_id, reservation_date),
-        'expires_at': expires_at.isoformat(),
-    }
-
-    if product_provides_pricing(product_id):
-        variant_price_mapping: Dict[str, Dict] = {}  # map variant ids to price data
-        for variant in product_availability.get(timeslot_availability_key, {}).get('variants', []):
-            variant_price_mapping[variant['id']] = variant['price']
-
-        reservation_response['unit_price'] = {}
-
-        for variant_id in [str(ticket.get('variant_id')) for ticket in tickets]:
-            if variant_id in variant_price_mapping:
-                reservation_response['unit_price'][variant_id] = variant_price_mapping.get(variant_id, {})
-
-    return jsonify(reservation_response)
+    return jsonify(handlers.reservation(product_id, request.json, g.api_key))
 
 
 @app.route('/v2/booking', methods=['POST'])
 @authorization_header
 def booking():
-    reservation_id = request.json.get('reservation_id')
-    order_reference = request.json.get('order_reference')
+    body, replayed = handlers.booking_body(request.json, g.api_key, lambda data: app.json.dumps_compact(data) + b'\n')
+    response = app.response_class(body, mimetype='application/json')
+    if replayed:
+        response.headers[idempotency.REPLAYED_HEADER] = 'true'
+    return response
 
-    if not reservation_id:
-        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "reservation_id" was not found')
 
-    if not order_reference:
-        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "order_reference" was not found')
+@app.route('/v2/booking/<booking_id>', methods=['DELETE'])
+@authorization_header
+def cancel_booking(booking_id):
+    handlers.cancel_booking(booking_id, g.api_key)
+    return '', 204
 
-    try:
-        expires_at, variant_quantity_map, product_id, booking_date = utils.decode_reservation_data(reservation_id)
-    except Exception:
-        raise exceptions.BadRequest(3002, 'Incorrect reservation ID', 'Given reservation ID is incorrect')
-
-    now = arrow.utcnow().datetime
-    if now > expires_at:
-        minutes_ago = round((now - expires_at).seconds / 60)
-        raise exceptions.BadRequest(
-            3001, 'Reservation expired', f'Your reservation has expired {minutes_ago} minutes ago'
-        )
-
-    tickets = {}
-    product = [p for p in constants.PRODUCTS if p["id"] == product_id][0]
-
-    for variant_id, quantity in variant_quantity_map.items():
-        if product["_ticket_content_type"] == "PDF":
-            barcodes = [utils.encode_barcode(f'{reservation_id}{variant_id}{i}') for i in range(quantity)]
-        elif product["_ticket_content_type"] == "AZTEC-BYTES":
-            barcodes = [
-                utils.encode_barcode(
-                    str(utils.str_to_int(f'{reservation_id}{variant_id}{i}', 10))
-                )
-                for i in range(quantity)
-            ]
-        else:
-            barcodes = [
-                str(utils.str_to_int(f'{reservation_id}{variant_id}{i}', 10))
-                for i in range(quantity)
-            ]
-        tickets[variant_id] = barcodes
 
-    booking_id = utils.encode_booking_id(booking_date.isoformat(), product_id)
+@app.route('/_admin/availability-cache')
+@authorization_header
+def availability_cache_stats():
+    return jsonify(availability_engine.cache.stats())
 
-    if booking_id in product['_cancelled_bookings']:
-        del product['_cancelled_bookings'][booking_id]
 
-    return jsonify(
-        {
-            'booking_id': booking_id,
-            'barcode_format': product["_ticket_content_type"],
-            'barcode_scope': 'ticket',
-            'barcode': '',
-            'tickets': tickets,
-        }
-    )
+@app.route('/_admin/catalog')
+@authorization_header
+def catalog_stats():
+    return jsonify(registry.stats())
 
 
-@app.route('/v2/booking/<booking_id>', methods=['DELETE'])
+@app.route('/_admin/profiles', methods=['GET', 'POST'])
 @authorization_header
-def cancel_booking(booking_id):
+def profiles():
+    if profiling.profiler is None:
+        return 'Not Found - Profiling is disabled, set SUPPLIER_SERVER_PROFILE_DIR', 404
     try:
-        booked_for, product_id = utils.decode_booking_data(booking_id)
-    except binascii.Error:
-        raise exceptions.BadRequest(1004, 'Missing booking', f"Booking with ID {booking_id} doesn't exist")
-    product = [p for p in constants.PRODUCTS if p["id"] == product_id][0]
-
-    if not product["is_refundable"]:
-        raise exceptions.BadRequest(
-            3004,
-            'Cancellation not possible',
-            'The booking cannot be cancelled, the product does not allow cancellations',
-        )
-
-    if product['_tickets_already_used']:
-        raise exceptions.BadRequest(
-            3005,
-            'Tickets already used',
-            'The booking cannot be cancelled because tickets have already been used',
-        )
-
-    booking_for_time = datetime.fromisoformat(booked_for).replace(tzinfo=timezone.utc)
-    cancellation_time = datetime.now(timezone.utc)
-    if booking_for_time < cancellation_time:
-        raise exceptions.BadRequest(2009, 'Incorrect date', 'Cannot use the past date')
-
-    difference = booking_for_time - cancellation_time
-    hours_in_advance = round(difference.total_seconds()/3600)
-    if product["cutoff_time"] != 0 and product["cutoff_time"] > hours_in_advance:
-        raise exceptions.BadRequest(
-            2009, 'Incorrect date', f'The booking can only be cancelled {product["cutoff_time"]} hours in advance'
-        )
-
-    if booking_id in product["_cancelled_bookings"]:
-        raise exceptions.BadRequest(
-            3003, 'Already cancelled', f'The booking with ID {booking_id} was already cancelled'
-        )
-
-    # if we want to test double cancellation, we need to store the cancelled booking id somewhere
-    product["_cancelled_bookings"][booking_id] = True
-    return '', 204
+        if request.method == 'POST':
+            profiling.profiler.set_sample_rate((request.get_json(silent=True) or {}).get('sample_rate'))
+        return jsonify(profiling.profiler.summary(request.args))
+    except ValueError as e:
+        return f'Bad Request - {e}', 400
+
+
+@app.route('/_admin/profiles/<route>')
+@authorization_header
+def route_profile(route: str):
+    data = profiling.profiler.dump(route) if profiling.profiler is not None else None
+    if data is None:
+        return f'Not Found - No profiles of {route}', 404
+    return Response(data, mimetype='application/octet-stream', headers={
+        'Content-Disposition': f'attachment; filename="{route}.prof"',
+    })
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    handlers.update_state_metrics()
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
 
 def run():
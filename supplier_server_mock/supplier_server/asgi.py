@@ -0,0 +1,467 @@
+"""
+ASGI application serving the same endpoints as the Flask application on an event loop.
+
+Every in-flight request is a coroutine instead of a worker thread, so slow clients and injected latency don't tie up
+threads. Run it with any ASGI server, e.g. `uvicorn supplier_server.asgi:app`.
+
+The request handling, validation, availability generation and JSON encoding are shared with the Flask application.
+The handlers writing to the state store or the ledger may wait on locks held by other processes, they run in the
+default thread pool so they don't block the event loop.
+"""
+import asyncio
+from functools import partial
+import json
+import re
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Pattern, Tuple, Union
+from urllib.parse import parse_qsl
+
+from . import availability as availability_engine
+from . import broadcast, compression, conditional, error_handlers, exceptions, faults, handlers, idempotency, keys
+from . import metrics, profiling, streaming
+from .app import app as flask_app
+from .keys import ApiKey
+from .registry import registry
+
+JSON_CONTENT_TYPE = b'application/json'
+TEXT_CONTENT_TYPE = b'text/html; charset=utf-8'
+
+
+class Request:
+    def __init__(self, scope: Dict, body: bytes, path_params: Dict[str, str], receive: Optional[Callable] = None):
+        self.method: str = scope['method']
+        self.path: str = scope['path']
+        self.headers: Dict[str, str] = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in scope['headers']}
+        self.args: Dict[str, str] = dict(parse_qsl(scope.get('query_string', b'').decode('latin-1')))
+        self.body = body
+        self.path_params = path_params
+        # receives `http.disconnect` once the client went away, the body is already read
+        self.receive = receive
+        self.api_key: Optional[ApiKey] = None
+
+    @property
+    def json(self) -> Dict:
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400, 'Bad Request - The request body is not valid JSON')
+        if not isinstance(data, dict):
+            raise HTTPError(400, 'Bad Request - The request body must be a JSON object')
+        return data
+
+
+class Response:
+    def __init__(
+        self,
+        body: Union[bytes, AsyncIterator[bytes]] = b'',
+        status: int = 200,
+        content_type: Optional[bytes] = TEXT_CONTENT_TYPE,
+        headers: Optional[List[Tuple[bytes, bytes]]] = None,
+    ):
+        self.body = body
+        self.status = status
+        self.headers = list(headers or [])
+        if content_type is not None:
+            self.headers.append((b'content-type', content_type))
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        self.status = status
+        self.message = message
+
+
+def dumps(obj: Any) -> bytes:
+    return flask_app.json.dumps_compact(obj)
+
+
+def json_response(obj: Any, status: int = 200, headers: Optional[List[Tuple[bytes, bytes]]] = None) -> Response:
+    return Response(dumps(obj) + b'\n', status, JSON_CONTENT_TYPE, headers)
+
+
+def get_header(response: Response, name: bytes) -> Optional[bytes]:
+    return next((value for key, value in response.headers if key == name), None)
+
+
+def set_header(response: Response, name: bytes, value: bytes):
+    response.headers = [(key, v) for key, v in response.headers if key != name] + [(name, value)]
+
+
+async def compress_stream(
+    chunks: AsyncIterator[bytes], compressor: compression.StreamCompressor,
+) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        data = compressor.process(chunk)
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+def compress(request: Request, response: Response) -> Response:
+    content_type = get_header(response, b'content-type')
+    if (
+        not compression.ENCODINGS
+        or response.status != 200
+        or get_header(response, b'content-encoding') is not None
+        or not compression.is_compressible(content_type.decode() if content_type else None)
+    ):
+        return response
+    response.headers.append((b'vary', b'Accept-Encoding'))
+    encoding = compression.negotiate(request.headers.get('accept-encoding'))
+    if encoding is None:
+        return response
+    etag = get_header(response, b'etag')
+    etag = etag.decode() if etag else None
+    if isinstance(response.body, bytes):
+        if not compression.worth_compressing(len(response.body)):
+            return response
+        response.body = compression.compress_cached(response.body, encoding, etag)
+    else:
+        response.body = compress_stream(response.body, compression.StreamCompressor(encoding, etag))
+    response.headers.append((b'content-encoding', encoding.encode()))
+    if etag:
+        set_header(response, b'etag', compression.representation_etag(etag, encoding).encode())
+    return response
+
+
+def from_compression_cache(request: Request, etag: str) -> Optional[Response]:
+    """The cached compressed response with `etag` for this request, its body is neither built nor compressed again."""
+    encoding = compression.negotiate(request.headers.get('accept-encoding'))
+    body = compression.cached(etag, encoding)
+    if body is None:
+        return None
+    return Response(body, content_type=JSON_CONTENT_TYPE, headers=[
+        (b'content-encoding', encoding.encode()),
+        (b'etag', compression.representation_etag(etag, encoding).encode()),
+        (b'vary', b'Accept-Encoding'),
+    ])
+
+
+def not_modified(request: Request, etag: str) -> Response:
+    """304 with the ETag of the representation the request would get, see `compress`."""
+    encoding = compression.negotiate(request.headers.get('accept-encoding'))
+    if encoding is not None:
+        etag = compression.representation_etag(etag, encoding)
+    headers = [(b'etag', etag.encode())]
+    if compression.ENCODINGS:
+        headers.append((b'vary', b'Accept-Encoding'))
+    return Response(status=304, content_type=None, headers=headers)
+
+
+async def run_blocking(function: Callable, *args) -> Any:
+    """Call `function` in the default thread pool."""
+    return await asyncio.get_running_loop().run_in_executor(None, partial(function, *args))
+
+
+async def iterate(chunks: Iterable[bytes]) -> AsyncIterator[bytes]:
+    for chunk in chunks:
+        yield chunk
+        # let the other requests run between the chunks of a large response
+        await asyncio.sleep(0)
+
+
+async def products(request: Request) -> Response:
+    etag = handlers.products_etag(request.api_key)
+    if conditional.matches(request.headers.get('if-none-match'), etag):
+        return not_modified(request, etag)
+    cached = from_compression_cache(request, etag)
+    if cached is not None:
+        return cached
+    return json_response(handlers.products(request.api_key), headers=[(b'etag', etag.encode())])
+
+
+async def availability(request: Request) -> Response:
+    window = handlers.availability_window(request.path_params['product_id'], request.args, request.api_key)
+    if window is None:
+        return json_response({})
+    product, start, end = window
+    etag = handlers.availability_etag(product, start, end)
+    if conditional.matches(request.headers.get('if-none-match'), etag):
+        return not_modified(request, etag)
+    cached = from_compression_cache(request, etag)
+    if cached is not None:
+        return cached
+    headers = [(b'etag', etag.encode())]
+    if handlers.should_stream(start, end):
+        parts = availability_engine.iter_range(product, start, end)
+        return Response(
+            iterate(streaming.iter_json_object(parts, dumps)), content_type=JSON_CONTENT_TYPE, headers=headers,
+        )
+    return json_response(availability_engine.get_range(product, start, end), headers=headers)
+
+
+async def bulk_availability(request: Request) -> Response:
+    data = request.args if request.method == 'GET' else request.json
+    objects = handlers.bulk_availability(data.get('product_ids'), data, request.api_key)
+    return Response(iterate(streaming.iter_json_objects(objects, dumps)), content_type=JSON_CONTENT_TYPE)
+
+
+async def availability_changes(request: Request) -> Response:
+    return json_response(handlers.availability_changes(request.args, request.api_key))
+
+
+async def availability_stream(request: Request) -> Response:
+    product = request.api_key.product(request.path_params['product_id'])
+    last_event_id = request.headers.get('last-event-id')
+    events = broadcast.broadcaster.aiter_events(product.id, last_event_id, dumps, request.receive)
+    return Response(events, content_type=broadcast.CONTENT_TYPE.encode(), headers=[
+        (b'cache-control', b'no-cache'),
+        (b'x-accel-buffering', b'no'),
+    ])
+
+
+async def reservation(request: Request) -> Response:
+    return json_response(
+        await run_blocking(handlers.reservation, request.path_params['product_id'], request.json, request.api_key),
+    )
+
+
+async def booking(request: Request) -> Response:
+    body, replayed = await run_blocking(
+        handlers.booking_body, request.json, request.api_key, lambda data: dumps(data) + b'\n',
+    )
+    headers = [(idempotency.REPLAYED_HEADER.lower().encode(), b'true')] if replayed else []
+    return Response(body, content_type=JSON_CONTENT_TYPE, headers=headers)
+
+
+async def cancel_booking(request: Request) -> Response:
+    await run_blocking(handlers.cancel_booking, request.path_params['booking_id'], request.api_key)
+    return Response(status=204, content_type=None)
+
+
+async def availability_cache_stats(request: Request) -> Response:
+    return json_response(availability_engine.cache.stats())
+
+
+async def catalog_stats(request: Request) -> Response:
+    return json_response(registry.stats())
+
+
+async def profiles(request: Request) -> Response:
+    if profiling.profiler is None:
+        return text_response('Not Found - Profiling is disabled, set SUPPLIER_SERVER_PROFILE_DIR', 404)
+    try:
+        if request.method == 'POST':
+            profiling.profiler.set_sample_rate(request.json.get('sample_rate'))
+        return json_response(profiling.profiler.summary(request.args))
+    except ValueError as e:
+        return text_response(f'Bad Request - {e}', 400)
+
+
+async def route_profile(request: Request) -> Response:
+    route = request.path_params['route']
+    data = profiling.profiler.dump(route) if profiling.profiler is not None else None
+    if data is None:
+        return text_response(f'Not Found - No profiles of {route}', 404)
+    return Response(data, content_type=b'application/octet-stream', headers=[
+        (b'content-disposition', f'attachment; filename="{route}.prof"'.encode()),
+    ])
+
+
+async def prometheus_metrics(request: Request) -> Response:
+    await run_blocking(handlers.update_state_metrics)
+    return Response(metrics.render().encode(), content_type=metrics.CONTENT_TYPE.encode())
+
+
+Handler = Callable[[Request], Awaitable[Response]]
+
+ROUTES: List[Tuple[Pattern, str, Handler]] = [
+    (re.compile(r'/v2/products'), 'GET', products),
+    (re.compile(r'/v2/products/(?P<product_id>[^/]+)/availability'), 'GET', availability),
+    (re.compile(r'/v2/products/(?P<product_id>[^/]+)/availability/stream'), 'GET', availability_stream),
+    (re.compile(r'/v2/availability'), 'GET', bulk_availability),
+    (re.compile(r'/v2/availability'), 'POST', bulk_availability),
+    (re.compile(r'/v2/availability/changes'), 'GET', availability_changes),
+    (re.compile(r'/v2/products/(?P<product_id>[^/]+)/reservation'), 'POST', reservation),
+    (re.compile(r'/v2/booking'), 'POST', booking),
+    (re.compile(r'/v2/booking/(?P<booking_id>[^/]+)'), 'DELETE', cancel_booking),
+    (re.compile(r'/_admin/availability-cache'), 'GET', availability_cache_stats),
+    (re.compile(r'/_admin/catalog'), 'GET', catalog_stats),
+    (re.compile(r'/_admin/profiles'), 'GET', profiles),
+    (re.compile(r'/_admin/profiles'), 'POST', profiles),
+    (re.compile(r'/_admin/profiles/(?P<route>[^/]+)'), 'GET', route_profile),
+    (re.compile(r'/metrics'), 'GET', prometheus_metrics),
+]
+# served without an API key
+PUBLIC_ROUTES = {prometheus_metrics}
+
+
+def resolve(method: str, path: str) -> Tuple[Handler, Dict[str, str]]:
+    path_matched = False
+    for pattern, route_method, handler in ROUTES:
+        match = pattern.fullmatch(path)
+        if match is None:
+            continue
+        if route_method == method or (route_method == 'GET' and method == 'HEAD'):
+            return handler, match.groupdict()
+        path_matched = True
+    if path_matched:
+        raise HTTPError(405, f'Method Not Allowed - Incorrect method was used ({method})')
+    raise HTTPError(404, 'Not Found - The requested URL was not found on the server')
+
+
+def text_response(body: str, status: int) -> Response:
+    return Response(body.encode(), status)
+
+
+async def chunks_of(body: Union[bytes, AsyncIterator[bytes]]) -> AsyncIterator[bytes]:
+    if isinstance(body, bytes):
+        yield body
+        return
+    async for chunk in body:
+        yield chunk
+
+
+async def inject_faults(plan: faults.Plan, handler: Handler, request: Request) -> Response:
+    if plan.delay:
+        await asyncio.sleep(plan.delay)
+    if plan.error == '500':
+        return text_response(*error_handlers.server_error(None))
+    if plan.error == '503':
+        return text_response(*error_handlers.service_unavailable(None))
+    if plan.error == 'timeout':
+        await asyncio.sleep(plan.timeout)
+        return text_response(*error_handlers.gateway_timeout(None))
+    response = compress(request, await handler(request))
+    if plan.error == 'reset':
+        if isinstance(response.body, bytes):
+            # announce the full body so the client notices the truncation
+            response.headers.append((b'content-length', str(len(response.body)).encode()))
+        response.body = faults.areset(chunks_of(response.body))
+    elif plan.bandwidth:
+        if isinstance(response.body, bytes):
+            response.headers.append((b'content-length', str(len(response.body)).encode()))
+        response.body = faults.athrottle(chunks_of(response.body), plan.bandwidth)
+    return response
+
+
+async def read_body(receive: Callable) -> bytes:
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def handle(scope: Dict, receive: Callable, on_close: List[Callable]) -> Response:
+    """Response to a request, `on_close` collects the callbacks to run once it is sent."""
+    try:
+        handler, path_params = resolve(scope['method'], scope['path'])
+        request = Request(scope, await read_body(receive), path_params, receive)
+        if handler in PUBLIC_ROUTES:
+            return await handler(request)
+        api_key = keys.lookup(request.headers.get('api-key'))
+        if api_key is None:
+            return Response(b'Forbidden - Missing or incorrect API key', 403)
+        wait = api_key.acquire()
+        if wait is not None:
+            body, status = error_handlers.too_many_requests(None)
+            return Response(body.encode(), status, headers=[(b'retry-after', keys.retry_after(wait).encode())])
+        on_close.append(api_key.release)
+        request.api_key = api_key
+        if faults.injector is not None:
+            profile_name = request.headers.get(faults.PROFILE_HEADER.lower()) or api_key.scenario
+            plan = faults.injector.plan(handler.__name__, request.headers['api-key'], profile_name)
+            if plan is not None:
+                return await inject_faults(plan, handler, request)
+        return compress(request, await handler(request))
+    except HTTPError as e:
+        return Response(e.message.encode(), e.status)
+    except exceptions.BadRequest as e:
+        return json_response(*error_handlers.bad_request(e))
+    except Exception:
+        flask_app.logger.exception('Exception on %s [%s]', scope['path'], scope['method'])
+        return text_response(*error_handlers.server_error(None))
+
+
+async def send_response(response: Response, send: Callable, include_body: bool = True) -> int:
+    """Send `response`, returns the size of the body sent."""
+    headers = response.headers
+    # 304 responses keep no body, their length would be the one of the full response
+    if isinstance(response.body, bytes) and response.status != 304:
+        headers = headers + [(b'content-length', str(len(response.body)).encode())]
+    await send({'type': 'http.response.start', 'status': response.status, 'headers': headers})
+    if isinstance(response.body, bytes):
+        body = response.body if include_body else b''
+        await send({'type': 'http.response.body', 'body': body})
+        return len(body)
+    sent = 0
+    async for chunk in response.body:
+        if include_body:
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            sent += len(chunk)
+    await send({'type': 'http.response.body', 'body': b''})
+    return sent
+
+
+async def lifespan(receive: Callable, send: Callable):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+def route_name(scope: Dict) -> str:
+    """Name of the route of a request, the same as the Flask endpoint."""
+    try:
+        return resolve(scope['method'], scope['path'])[0].__name__
+    except HTTPError:
+        return 'unmatched'
+
+
+def scope_header(scope: Dict, name: bytes) -> Optional[bytes]:
+    return next((value for key, value in scope['headers'] if key == name), None)
+
+
+def request_size(scope: Dict) -> int:
+    value = scope_header(scope, b'content-length')
+    return int(value) if value is not None and value.isdigit() else 0
+
+
+def start_profile(scope: Dict, route: str):
+    if profiling.profiler is None or route == 'unmatched':
+        return None
+    api_key = scope_header(scope, b'api-key')
+    requested = (
+        scope_header(scope, profiling.HEADER.lower().encode()) == b'1'
+        and keys.lookup(api_key.decode('latin-1') if api_key is not None else None) is not None
+    )
+    return profiling.profiler.start(route, requested)
+
+
+async def app(scope: Dict, receive: Callable, send: Callable):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        raise ValueError(f'Unsupported ASGI scope type {scope["type"]!r}')
+    started = time.perf_counter()
+    metrics.REQUESTS_IN_FLIGHT.inc()
+    route = route_name(scope)
+    profile = start_profile(scope, route)
+    sent = None
+    response = None
+    on_close: List[Callable] = []
+    try:
+        response = await handle(scope, receive, on_close)
+        sent = await send_response(response, send, include_body=scope['method'] != 'HEAD')
+    finally:
+        for callback in on_close:
+            callback()
+        if profile is not None:
+            profiling.profiler.stop(profile, route)
+        metrics.REQUESTS_IN_FLIGHT.dec()
+        handlers.update_state_metrics()
+        metrics.observe_request(
+            route,
+            scope['method'],
+            response.status if response is not None else 500,
+            time.perf_counter() - started,
+            request_size(scope),
+            sent,
+        )
@@ -1,12 +1,13 @@
 from functools import wraps
-from flask import request, Response
+
+from flask import g, Response
 
 
 def authorization_header(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        api_key = request.headers.get('API-Key')
-        if not api_key or api_key != 'secret':
+        # the key is looked up and admitted by the app's `admit_request` hook
+        if g.get('api_key') is None:
             return Response('Forbidden - Missing or incorrect API key', 403)
         return f(*args, **kwargs)
     return decorated_function
@@ -0,0 +1,231 @@
+"""
+Availability range engine.
+
+The generated inventory for a day only depends on the day itself, so a `[start, end]` window is computed in one pass
+over the days and then rendered for a product using the per-product parts (timeslots, variants, prices) prepared
+once per product.
+"""
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import time
+import zlib
+
+from . import calendars, metrics
+from .cache import TTLCache
+from .constants import AVAILABILITY_CACHE_SIZE, AVAILABILITY_CACHE_TTL, VARIANTS
+from .inventory import Allocation, CellKey, inventory
+from .registry import CompiledProduct
+
+# (max tickets, available tickets per variant), or None when the product is closed that day
+DayCounts = Optional[Tuple[int, Tuple[int, ...]]]
+
+CLOSED_WEEKDAY = 7  # Sunday
+TIMESLOTS = ('17:30', '19:30')
+NO_TIMESLOT = ('00:00',)
+
+
+def str_to_int(some_str: str, number_of_digits: int) -> int:
+    """Stable replacement for the salted builtin `hash()`: the same input gives the same number in every process."""
+    return int(str(zlib.crc32(some_str.encode()) % (10 ** 8))[:number_of_digits])
+
+
+def day_counts(day: date) -> DayCounts:
+    weekday = day.isoweekday()
+    if weekday == CLOSED_WEEKDAY:
+        return None
+
+    day_str = day.isoformat()
+    number_of_digits = 1 if weekday % 3 == 0 else 2
+    max_tickets = str_to_int(day_str, number_of_digits)
+    tickets_left = max_tickets
+
+    counts = []
+    for i in range(1, len(VARIANTS)):
+        variant_max_ticket = min(tickets_left, str_to_int(f'{i * weekday}{day_str}', number_of_digits))
+        tickets_left -= variant_max_ticket
+        counts.append(variant_max_ticket)
+    counts.append(tickets_left)
+
+    return max_tickets, tuple(counts)
+
+
+def iter_days(start: date, end: date) -> Iterator[date]:
+    day = start
+    one_day = timedelta(days=1)
+    while day <= end:
+        yield day
+        day += one_day
+
+
+class ProductLayout:
+    """Parts of the availability response that never change for a product."""
+
+    __slots__ = ('timeslots', 'variants', 'as_sum', 'calendar', 'calendar_timeslots')
+
+    def __init__(self, product: CompiledProduct):
+        self.timeslots: Tuple[str, ...] = TIMESLOTS if product.use_timeslots else NO_TIMESLOT
+        # rule-based calendar replacing the generated inventory, see `calendars`
+        self.calendar = calendars.of(product.id)
+        # the timeslots follow the opening hours of the calendar
+        self.calendar_timeslots = self.calendar is not None and product.use_timeslots
+        self.as_sum = product.timeslot_available_tickets_as_sum
+        self.variants: List[Tuple[str, str, Optional[Dict]]] = []
+        for i, variant in enumerate(VARIANTS, 1):
+            price = None
+            if product.provides_pricing:
+                price = {'amount': f"{Decimal('12.45') * i}", 'currency': product.currency}
+            self.variants.append((str(i), variant, price))
+
+    def render_timeslot(self, counts: DayCounts, taken: Dict[str, int]) -> Dict:
+        if counts is None:
+            return {}
+        max_tickets, variant_counts = counts
+
+        variants = []
+        for (variant_id, name, price), available_tickets in zip(self.variants, variant_counts):
+            available_tickets = max(0, available_tickets - taken.get(variant_id, 0))
+            current_variant = {'id': variant_id, 'name': name, 'available_tickets': available_tickets}
+            if price is not None:
+                current_variant['price'] = price
+            variants.append(current_variant)
+
+        if self.as_sum:
+            timeslot_available_tickets = max(0, max_tickets - sum(taken.values()))
+        else:
+            timeslot_available_tickets = max(variant['available_tickets'] for variant in variants)
+        return {
+            'available_tickets': timeslot_available_tickets,
+            'variants': variants,
+        }
+
+    def day_timeslots(self, day: date) -> Tuple[str, ...]:
+        return self.calendar.timeslots(day) if self.calendar_timeslots else self.timeslots
+
+    def render_day(self, day: date, counts: DayCounts, taken: Optional[Dict[CellKey, int]] = None) -> Dict:
+        """Availability of a day, minus the tickets `taken` by reservations and bookings."""
+        day_str = day.isoformat()
+        result = {}
+        for timeslot in self.day_timeslots(day):
+            timeslot_key = f'{day_str}T{timeslot}'
+            timeslot_taken = {}
+            if taken:
+                timeslot_taken = {variant_id: n for (key, variant_id), n in taken.items() if key == timeslot_key}
+            result[timeslot_key] = self.render_timeslot(counts, timeslot_taken)
+        return result
+
+
+_layouts: Dict[str, ProductLayout] = {}
+
+# rendered availability per (product id, day)
+cache = TTLCache(AVAILABILITY_CACHE_SIZE, AVAILABILITY_CACHE_TTL)
+
+# precomputed `table.AvailabilityTable` shared by the worker processes, see `table.install`
+table = None
+
+
+def get_layout(product: CompiledProduct) -> ProductLayout:
+    layout = _layouts.get(product.id)
+    if layout is None:
+        layout = _layouts[product.id] = ProductLayout(product)
+    return layout
+
+
+def get_counts(product: CompiledProduct, day: date, shared: Optional[Dict[date, DayCounts]] = None) -> DayCounts:
+    """
+    Counts of a day, `shared` keeps the counts computed for other products of the same request, or for the other days
+    of the request of a calendar product (see `range_counts`).
+    """
+    calendar = get_layout(product).calendar
+    if calendar is not None:
+        if shared is not None and day in shared:
+            return shared[day]
+        return calendar.counts(day)
+    if table is not None and table.covers(day):
+        return table.counts(product, day)
+    if shared is None:
+        return day_counts(day)
+    if day not in shared:
+        shared[day] = day_counts(day)
+    return shared[day]
+
+
+def range_counts(
+    product: CompiledProduct, start: date, end: date, shared: Optional[Dict[date, DayCounts]] = None,
+) -> Optional[Dict[date, DayCounts]]:
+    """Counts shared by the days of a range request: a calendar product's own range query, or else `shared`."""
+    calendar = get_layout(product).calendar
+    if calendar is None:
+        return shared
+    return dict(calendar.range(start, end))
+
+
+def capacity(product: CompiledProduct, day: date) -> Dict[str, int]:
+    """Generated tickets per variant id of every timeslot of a day, before reservations and bookings."""
+    counts = get_counts(product, day)
+    if counts is None:
+        return {}
+    return {variant_id: n for (variant_id, _, _), n in zip(get_layout(product).variants, counts[1])}
+
+
+def timeslot_key(product: CompiledProduct, moment: datetime) -> str:
+    """Availability key of the timeslot of `moment`, products without timeslots have a single one at 00:00."""
+    if product.use_timeslots:
+        return moment.strftime('%Y-%m-%dT%H:%M')
+    return f'{moment.date().isoformat()}T00:00'
+
+
+def get_day(product: CompiledProduct, day: date, shared: Optional[Dict[date, DayCounts]] = None) -> Dict:
+    """Availability of a single day. The returned data is shared through the cache and must not be modified."""
+    inventory.release_expired()
+    key = (product.id, day)
+    result = cache.get(key)
+    if result is None:
+        started = time.perf_counter()
+        version = inventory.version(product.id)
+        result = get_layout(product).render_day(day, get_counts(product, day, shared), inventory.taken(product.id, day))
+        metrics.AVAILABILITY_GENERATION.observe(time.perf_counter() - started)
+        # tickets taken while rendering may have been invalidated before the render is cached, it would stay stale
+        if inventory.version(product.id) == version:
+            cache.set(key, result)
+    return result
+
+
+def iter_range(product: CompiledProduct, start: date, end: date) -> Iterator[Dict]:
+    """Availability of a date range, one day at a time."""
+    shared = range_counts(product, start, end)
+    for day in iter_days(start, end):
+        yield get_day(product, day, shared)
+
+
+def get_range(product: CompiledProduct, start: date, end: date) -> Dict:
+    shared = range_counts(product, start, end)
+    result = {}
+    for day in iter_days(start, end):
+        result.update(get_day(product, day, shared))
+    return result
+
+
+def iter_bulk(products: Iterable[CompiledProduct], start: date, end: date) -> Iterator[Tuple[str, Iterator[Dict]]]:
+    """
+    Availability of several products over one date range, as (product id, days) pairs.
+
+    The generated counts of a day don't depend on the product, they are computed once for all the products.
+    """
+    days = list(iter_days(start, end))
+    shared: Dict[date, DayCounts] = {}
+    for product in products:
+        product_shared = range_counts(product, start, end, shared)
+        yield product.id, (get_day(product, day, product_shared) for day in days)
+
+
+def invalidate(product_id: str, day: date):
+    """Drop the cached availability of a day after a reservation, booking or cancellation changed it."""
+    cache.invalidate((product_id, day))
+
+
+def _on_inventory_change(allocation: Allocation):
+    invalidate(allocation.product_id, allocation.day)
+
+
+inventory.subscribe(_on_inventory_change)
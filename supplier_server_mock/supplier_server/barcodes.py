@@ -0,0 +1,161 @@
+"""
+Batch barcode generation.
+
+Every ticket gets a serial number from the state store (`StateStore.allocate_serials`), so no two tickets share one,
+and the serial is scrambled by a keyed 64-bit Feistel permutation. A permutation maps distinct serials to distinct
+numbers, so barcodes are unique while not revealing how many tickets were sold. Booking the same reservation again
+returns the same barcodes: the serials are allocated per booking ID, which is unique per reservation.
+
+The barcode of a number depends on the product's ticket content type, see `FORMATS`. A format renders all the
+barcodes of an order at once.
+"""
+from abc import ABC, abstractmethod
+from base64 import b64encode
+import hashlib
+import struct
+from typing import Dict, List, Mapping, Sequence, Tuple
+
+from . import state
+from .constants import ID_SECRET
+from .registry import CompiledProduct
+
+MASK32 = 0xFFFFFFFF
+_round_keys = struct.unpack('<4I', hashlib.blake2b(f'{ID_SECRET}\x1fbarcodes'.encode(), digest_size=16).digest())
+
+
+def _round(value: int, key: int) -> int:
+    value = ((value ^ key) * 0x9E3779B1) & MASK32
+    return value ^ (value >> 16)
+
+
+def permute(serial: int) -> int:
+    """Keyed bijection of the 64-bit integers."""
+    left, right = serial >> 32, serial & MASK32
+    for key in _round_keys:
+        left, right = right, left ^ _round(right, key)
+    return (left << 32) | right
+
+
+class BarcodeFormat(ABC):
+    name: str
+
+    @abstractmethod
+    def render(self, product: CompiledProduct, numbers: Sequence[int]) -> List[str]:
+        """Barcodes of unique 64-bit `numbers`."""
+
+
+class Code128Format(BarcodeFormat):
+    name = 'CODE128'
+
+    def render(self, product: CompiledProduct, numbers: Sequence[int]) -> List[str]:
+        # 20 digits fit every 64-bit number, CODE128 packs digit pairs into one symbol
+        return [f'{number:020d}' for number in numbers]
+
+
+class QRCodeFormat(BarcodeFormat):
+    name = 'QRCODE'
+
+    def render(self, product: CompiledProduct, numbers: Sequence[int]) -> List[str]:
+        # upper case, digits and colons only, so the QR code uses the compact alphanumeric mode
+        prefix = product.id.upper()
+        return [f'{prefix}:{number:016X}' for number in numbers]
+
+
+class AztecBytesFormat(BarcodeFormat):
+    name = 'AZTEC-BYTES'
+
+    def render(self, product: CompiledProduct, numbers: Sequence[int]) -> List[str]:
+        packed = struct.pack(f'>{len(numbers)}Q', *numbers)
+        return [b64encode(packed[i:i + 8]).decode() for i in range(0, len(packed), 8)]
+
+
+def _pdf(title: bytes, number: bytes) -> bytes:
+    """Single page PDF ticket showing `title` and `number`."""
+    content = b'BT /F1 14 Tf 20 90 Td (%s) Tj 0 -30 Td (%s) Tj ET' % (title, number)
+    objects = [
+        b'<</Type/Catalog/Pages 2 0 R>>',
+        b'<</Type/Pages/Kids[3 0 R]/Count 1>>',
+        b'<</Type/Page/Parent 2 0 R/MediaBox[0 0 298 140]/Contents 4 0 R/Resources<</Font<</F1 5 0 R>>>>>>',
+        b'<</Length %d>>stream\n%s\nendstream' % (len(content), content),
+        b'<</Type/Font/Subtype/Type1/BaseFont/Courier>>',
+    ]
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for number_of_object, obj in enumerate(objects, 1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (number_of_object, obj)
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    pdf += b'trailer\n<</Size %d/Root 1 0 R>>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return pdf
+
+
+class PDFFormat(BarcodeFormat):
+    """
+    Base64 PDF ticket per barcode.
+
+    The number has a fixed width, so every PDF of a product has the same layout. The parts before and after the
+    number are base64 encoded once per product, only the few bytes around the number are encoded per ticket.
+    """
+
+    name = 'PDF'
+    PLACEHOLDER = b'0' * 20
+
+    def __init__(self):
+        self._templates: Dict[str, Tuple[str, bytes, bytes, str]] = {}
+
+    def _template(self, product: CompiledProduct) -> Tuple[str, bytes, bytes, str]:
+        template = self._templates.get(product.id)
+        if template is None:
+            title = product.id.encode().replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+            pdf = _pdf(title, self.PLACEHOLDER)
+            start = pdf.index(self.PLACEHOLDER, pdf.index(b'stream'))
+            end = start + len(self.PLACEHOLDER)
+            # cut on multiples of 3 bytes, base64 of the parts then concatenates to base64 of the whole
+            cut_start = start - start % 3
+            cut_end = end + (cut_start - end) % 3
+            template = self._templates[product.id] = (
+                b64encode(pdf[:cut_start]).decode(),
+                pdf[cut_start:start],
+                pdf[end:cut_end],
+                b64encode(pdf[cut_end:]).decode(),
+            )
+        return template
+
+    def render(self, product: CompiledProduct, numbers: Sequence[int]) -> List[str]:
+        prefix, before, after, suffix = self._template(product)
+        return [prefix + b64encode(b'%s%020d%s' % (before, number, after)).decode() + suffix for number in numbers]
+
+
+FORMATS: Dict[str, BarcodeFormat] = {}
+DEFAULT_FORMAT = Code128Format.name
+
+
+def register(barcode_format: BarcodeFormat):
+    FORMATS[barcode_format.name] = barcode_format
+
+
+for _format in (Code128Format(), QRCodeFormat(), AztecBytesFormat(), PDFFormat()):
+    register(_format)
+
+
+def get_format(ticket_content_type: str) -> BarcodeFormat:
+    return FORMATS.get(ticket_content_type) or FORMATS[DEFAULT_FORMAT]
+
+
+def generate(product: CompiledProduct, key: str, quantities: Mapping[str, int]) -> Dict[str, List[str]]:
+    """Barcodes per variant id of an order, `key` identifies the order (the booking ID)."""
+    total = sum(quantities.values())
+    if not total:
+        return {variant_id: [] for variant_id in quantities}
+    first = state.store.allocate_serials(key, total)
+    codes = get_format(product.ticket_content_type).render(
+        product, [permute(serial) for serial in range(first, first + total)],
+    )
+    barcodes = {}
+    offset = 0
+    for variant_id, quantity in quantities.items():
+        barcodes[variant_id] = codes[offset:offset + quantity]
+        offset += quantity
+    return barcodes
@@ -0,0 +1,209 @@
+"""
+Server-Sent Events stream of the availability changes of a product.
+
+`GET /v2/products/<product_id>/availability/stream` pushes an `availability` event whenever tickets of the product are
+taken or given back (see `changes`), with the changed timeslots in the shape of `/availability` and only the changed
+variants. The stream starts with a `resync` event: fetch the full availability, then apply the events.
+
+Every product with subscribers has a channel: a ring of its latest `SUPPLIER_SERVER_SSE_BACKLOG` events, each rendered
+and encoded once whatever the number of subscribers. Subscribers have no queue of their own, only their position in
+the ring, and a subscriber woken up gets all the events it missed in one chunk. A subscriber that falls further behind
+than the backlog is sent a `resync` event and disconnected, so slow clients never hold more memory. A comment is sent
+after `SUPPLIER_SERVER_SSE_HEARTBEAT` seconds without events, it keeps proxies from closing the connection and lets the
+server notice clients that went away.
+
+A client reconnecting with `Last-Event-ID` gets the events it missed while they are still in the backlog, or else a
+`resync` event. The channels are per worker process, the ASGI server scales to many more subscribers than the worker
+threads of the Flask application.
+"""
+import asyncio
+import os
+from threading import Condition, Lock
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+from . import changes, metrics
+from .constants import SSE_BACKLOG, SSE_HEARTBEAT
+from .inventory import Allocation, inventory
+
+CONTENT_TYPE = 'text/event-stream'
+HEARTBEAT = b': keep-alive\n\n'
+
+Dumps = Callable[[Any], bytes]
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Channel:
+    def __init__(self, product_id: str, backlog: int):
+        self.product_id = product_id
+        self.backlog = backlog
+        # event ids of a previous channel of the product are not resumed
+        self.epoch = os.urandom(4).hex()
+        # [data, encoded event] of the event `seq` at `seq % backlog`, encoded by the first subscriber reading it
+        self._events: List[Optional[List]] = [None] * backlog
+        self.head = 0
+        self.subscribers = 0
+        self._condition = Condition(Lock())
+        # future resolved by the next event, shared by the subscribers waiting on an event loop
+        self._futures: Dict[asyncio.AbstractEventLoop, asyncio.Future] = {}
+
+    def event_id(self, seq: int) -> str:
+        return f'{self.epoch}-{seq}'
+
+    def position(self, last_event_id: Optional[str]) -> Optional[int]:
+        """Position of a subscriber resuming after `last_event_id`, None when its events are gone."""
+        epoch, _, seq = (last_event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        seq = int(seq)
+        with self._condition:
+            return seq if self.head - self.backlog <= seq <= self.head else None
+
+    def publish(self, data: Dict):
+        with self._condition:
+            self.head += 1
+            self._events[self.head % self.backlog] = [data, None]
+            self._condition.notify_all()
+            futures, self._futures = self._futures, {}
+        for loop, future in futures.items():
+            loop.call_soon_threadsafe(_wake, future)
+
+    def read(self, position: int, dumps: Dumps) -> Tuple[Optional[bytes], int]:
+        """Encoded events after `position` and the new position, None when they are no longer in the backlog."""
+        with self._condition:
+            if position < self.head - self.backlog:
+                return None, self.head
+            chunks = []
+            for seq in range(position + 1, self.head + 1):
+                event = self._events[seq % self.backlog]
+                if event[1] is None:
+                    event[1] = b'id: %s\nevent: availability\ndata: %s\n\n' % (
+                        self.event_id(seq).encode(), dumps(event[0]),
+                    )
+                chunks.append(event[1])
+            return b''.join(chunks), self.head
+
+    def wait(self, position: int, timeout: float) -> bool:
+        """Block until there are events after `position`, returns False on timeout."""
+        with self._condition:
+            return self._condition.wait_for(lambda: self.head > position, timeout)
+
+    def future(self) -> asyncio.Future:
+        """Future of the running event loop resolved by the next event."""
+        loop = asyncio.get_running_loop()
+        with self._condition:
+            future = self._futures.get(loop)
+            if future is None:
+                future = self._futures[loop] = loop.create_future()
+            return future
+
+
+class Subscription:
+    def __init__(self, channel: Channel, position: Optional[int]):
+        self.channel = channel
+        self.resync = position is None
+        self.position = channel.head if position is None else position
+        self.closed = False
+
+    def read(self, dumps: Dumps) -> bytes:
+        """Events to send, empty when there are none; a `resync` event closes the subscription when it fell behind."""
+        if self.resync:
+            self.resync = False
+            return self._resync_event()
+        events, self.position = self.channel.read(self.position, dumps)
+        if events is None:
+            self.closed = True
+            metrics.SSE_SLOW_CONSUMERS.inc()
+            return self._resync_event()
+        return events
+
+    def _resync_event(self) -> bytes:
+        return b'id: %s\nevent: resync\ndata: {}\n\n' % self.channel.event_id(self.position).encode()
+
+
+class Broadcaster:
+    def __init__(self, backlog: int, heartbeat: float):
+        if backlog < 1 or heartbeat <= 0:
+            raise ValueError('SSE needs a backlog of at least 1 and a positive heartbeat')
+        self.backlog = backlog
+        self.heartbeat = heartbeat
+        self._channels: Dict[str, Channel] = {}
+        self._lock = Lock()
+
+    def subscribe(self, product_id: str, last_event_id: Optional[str] = None) -> Subscription:
+        with self._lock:
+            channel = self._channels.get(product_id)
+            if channel is None:
+                channel = self._channels[product_id] = Channel(product_id, self.backlog)
+            channel.subscribers += 1
+        metrics.SSE_SUBSCRIBERS.inc()
+        return Subscription(channel, channel.position(last_event_id))
+
+    def unsubscribe(self, subscription: Subscription):
+        channel = subscription.channel
+        with self._lock:
+            channel.subscribers -= 1
+            if not channel.subscribers:
+                del self._channels[channel.product_id]
+        metrics.SSE_SUBSCRIBERS.dec()
+
+    def publish(self, allocation: Allocation):
+        channel = self._channels.get(allocation.product_id)
+        if channel is None:
+            return
+        cells = [
+            (allocation.product_id, allocation.day, allocation.timeslot, variant_id)
+            for variant_id in allocation.quantities
+        ]
+        data = changes.render(cells).get(allocation.product_id)
+        if data:
+            channel.publish(data)
+
+    def iter_events(self, product_id: str, last_event_id: Optional[str], dumps: Dumps) -> Iterator[bytes]:
+        """Body of a stream served by a worker thread, the subscription ends when the body is closed."""
+        subscription = self.subscribe(product_id, last_event_id)
+        try:
+            while not subscription.closed:
+                events = subscription.read(dumps)
+                if events:
+                    yield events
+                elif not subscription.channel.wait(subscription.position, self.heartbeat):
+                    yield HEARTBEAT
+        finally:
+            self.unsubscribe(subscription)
+
+    async def aiter_events(
+        self, product_id: str, last_event_id: Optional[str], dumps: Dumps, receive: Callable,
+    ) -> AsyncIterator[bytes]:
+        """
+        Body of a stream served on an event loop, the subscription ends when `receive` reports that the client
+        disconnected.
+        """
+        subscription = self.subscribe(product_id, last_event_id)
+        disconnect = asyncio.ensure_future(receive())
+        try:
+            while not subscription.closed:
+                events = subscription.read(dumps)
+                if events:
+                    yield events
+                    continue
+                future = subscription.channel.future()
+                if subscription.channel.head > subscription.position:  # published meanwhile
+                    continue
+                done, _ = await asyncio.wait(
+                    (future, disconnect), timeout=self.heartbeat, return_when=asyncio.FIRST_COMPLETED,
+                )
+                if disconnect in done:
+                    return
+                if not done:
+                    yield HEARTBEAT
+        finally:
+            disconnect.cancel()
+            self.unsubscribe(subscription)
+
+
+broadcaster = Broadcaster(SSE_BACKLOG, SSE_HEARTBEAT)
+inventory.subscribe(broadcaster.publish)
@@ -0,0 +1,236 @@
+"""
+Rule-based availability calendars, replacing the generated inventory of the products they are assigned to.
+
+`SUPPLIER_SERVER_CALENDARS` points to a JSON file, or a YAML file with the `yaml` extra installed:
+
+    calendars:
+      museum:
+        opening_hours:            # timeslots per weekday, the weekdays not listed are closed
+          mon-fri: ["10:00", "14:00"]
+          sat,sun: ["10:00"]
+        closures:                 # single days or ranges, both ends included
+          - 2024-12-25
+          - {from: 2025-01-01, to: 2025-01-07}
+        seasons:                  # tickets per timeslot, seasons must not overlap
+          - {from: 2024-06-01, to: 2024-08-31, capacity: 100, variants: {"1": 70, "2": 30}}
+        capacity: 20              # outside of the seasons, the days outside of the seasons are closed without it
+        variants: {"1": 20, "2": 5}
+    products:
+      A300-FX: museum
+      "*": museum                 # every product not listed, optional
+
+`capacity` is a timeslot's `available_tickets` and `variants` the quota per variant id; without `variants` every
+variant can sell up to the capacity. Products without timeslots keep their single `00:00` timeslot, which is open on
+the days with opening hours.
+
+Calendars are compiled on startup into sorted arrays of day ordinals: the closures merged into disjoint ranges and
+the seasons. A day costs a binary search in each, a range of `k` days one binary search and a walk over the `k` days.
+"""
+from bisect import bisect_right
+from datetime import date, datetime
+import hashlib
+import json
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from .constants import CALENDARS, VARIANTS
+from .registry import registry
+
+try:
+    import yaml
+except ImportError:  # pragma: no cover
+    yaml = None
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+# any product not assigned to a calendar of its own
+DEFAULT_PRODUCT = '*'
+
+# (max tickets, available tickets per variant) like `availability.DayCounts`
+Counts = Tuple[int, Tuple[int, ...]]
+
+
+def _date(value) -> date:
+    if isinstance(value, date):  # YAML dates
+        return value
+    try:
+        return date.fromisoformat(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{value!r} is not a date, expected YYYY-MM-DD')
+
+
+def _time(value) -> str:
+    try:
+        return datetime.strptime(value, '%H:%M').strftime('%H:%M')
+    except (TypeError, ValueError):
+        raise ValueError(f'{value!r} is not a time, expected HH:MM')
+
+
+def _weekdays(spec: str) -> List[int]:
+    """Weekday indexes (Monday is 0) of `mon-fri`, `sat,sun` or `wed`."""
+    weekdays = []
+    for part in str(spec).lower().split(','):
+        first, _, last = part.strip().partition('-')
+        if first[:3] not in WEEKDAYS or (last and last[:3] not in WEEKDAYS):
+            raise ValueError(f'{spec!r} is not a weekday or range of weekdays')
+        start = WEEKDAYS.index(first[:3])
+        end = WEEKDAYS.index(last[:3]) if last else start
+        weekdays.extend(day % 7 for day in range(start, end + 1 if end >= start else end + 8))
+    return weekdays
+
+
+def _counts(data: Dict) -> Counts:
+    capacity = data['capacity']
+    if not isinstance(capacity, int) or capacity < 0:
+        raise ValueError(f'capacity must be a non-negative integer, got {capacity!r}')
+    quotas = data.get('variants')
+    if quotas is None:
+        return capacity, (capacity,) * len(VARIANTS)
+    unknown = set(map(str, quotas)) - {str(i) for i in range(1, len(VARIANTS) + 1)}
+    if unknown:
+        raise ValueError(f'unknown variant ids {", ".join(sorted(unknown))}')
+    quotas = {str(variant_id): quota for variant_id, quota in quotas.items()}
+    if not all(isinstance(quota, int) and quota >= 0 for quota in quotas.values()):
+        raise ValueError('variant quotas must be non-negative integers')
+    return capacity, tuple(quotas.get(str(i), 0) for i in range(1, len(VARIANTS) + 1))
+
+
+def _range(data) -> Tuple[int, int]:
+    """First and last day ordinals of a single day or a `{from, to}` range."""
+    if isinstance(data, dict):
+        first, last = _date(data['from']).toordinal(), _date(data['to']).toordinal()
+    else:
+        first = last = _date(data).toordinal()
+    if first > last:
+        raise ValueError(f'range {data!r} ends before it starts')
+    return first, last
+
+
+class Calendar:
+    def __init__(
+        self,
+        name: str,
+        opening_hours: Sequence[Tuple[str, ...]],
+        closures: Sequence[Tuple[int, int]] = (),
+        seasons: Sequence[Tuple[int, int, Counts]] = (),
+        default: Optional[Counts] = None,
+    ):
+        self.name = name
+        # timeslots per weekday, Monday first
+        self.opening_hours = tuple(opening_hours)
+        # closures merged into disjoint sorted ranges
+        self._closure_starts: List[int] = []
+        self._closure_ends: List[int] = []
+        for first, last in sorted(closures):
+            if self._closure_ends and first <= self._closure_ends[-1] + 1:
+                self._closure_ends[-1] = max(self._closure_ends[-1], last)
+            else:
+                self._closure_starts.append(first)
+                self._closure_ends.append(last)
+        self._season_starts: List[int] = []
+        self._season_ends: List[int] = []
+        self._season_counts: List[Counts] = []
+        for first, last, counts in sorted(seasons, key=lambda season: season[0]):
+            if self._season_ends and first <= self._season_ends[-1]:
+                raise ValueError(f'calendar {name!r} has overlapping seasons')
+            self._season_starts.append(first)
+            self._season_ends.append(last)
+            self._season_counts.append(counts)
+        self.default = default
+
+    @classmethod
+    def from_json(cls, name: str, data: Dict) -> 'Calendar':
+        try:
+            opening_hours: List[Tuple[str, ...]] = [()] * 7
+            for spec, timeslots in data.get('opening_hours', {}).items():
+                for weekday in _weekdays(spec):
+                    opening_hours[weekday] = tuple(sorted({_time(timeslot) for timeslot in timeslots}))
+            return cls(
+                name,
+                opening_hours,
+                [_range(closure) for closure in data.get('closures', [])],
+                [_range(season) + (_counts(season),) for season in data.get('seasons', [])],
+                _counts(data) if 'capacity' in data else None,
+            )
+        except KeyError as e:
+            raise ValueError(f'Invalid calendar {name!r}: missing {e.args[0]!r}')
+        except (TypeError, ValueError) as e:
+            raise ValueError(f'Invalid calendar {name!r}: {e}')
+
+    def timeslots(self, day: date) -> Tuple[str, ...]:
+        return self.opening_hours[day.weekday()]
+
+    def _day_counts(self, day: date, closed: bool, season: Optional[int]) -> Optional[Counts]:
+        if closed or not self.opening_hours[day.weekday()]:
+            return None
+        return self._season_counts[season] if season is not None else self.default
+
+    def counts(self, day: date) -> Optional[Counts]:
+        """Counts of every timeslot of a day, None when it is closed."""
+        ordinal = day.toordinal()
+        i = bisect_right(self._closure_starts, ordinal) - 1
+        closed = i >= 0 and ordinal <= self._closure_ends[i]
+        i = bisect_right(self._season_starts, ordinal) - 1
+        season = i if i >= 0 and ordinal <= self._season_ends[i] else None
+        return self._day_counts(day, closed, season)
+
+    def range(self, start: date, end: date) -> Iterator[Tuple[date, Optional[Counts]]]:
+        """(day, counts) of the days from `start` to `end`."""
+        ordinal, last = start.toordinal(), end.toordinal()
+        closure = max(0, bisect_right(self._closure_starts, ordinal) - 1)
+        season = max(0, bisect_right(self._season_starts, ordinal) - 1)
+        while ordinal <= last:
+            while closure < len(self._closure_ends) and self._closure_ends[closure] < ordinal:
+                closure += 1
+            while season < len(self._season_ends) and self._season_ends[season] < ordinal:
+                season += 1
+            closed = closure < len(self._closure_starts) and self._closure_starts[closure] <= ordinal
+            in_season = season < len(self._season_starts) and self._season_starts[season] <= ordinal
+            day = date.fromordinal(ordinal)
+            yield day, self._day_counts(day, closed, season if in_season else None)
+            ordinal += 1
+
+
+class CalendarSet:
+    def __init__(self, calendars: Dict[str, Calendar], products: Dict[str, str], version: str = ''):
+        self.calendars = calendars
+        self._products = {product_id: calendars[name] for product_id, name in products.items()}
+        self._default = self._products.pop(DEFAULT_PRODUCT, None)
+        self.version = version
+
+    @classmethod
+    def from_json(cls, data: Dict, version: str = '') -> 'CalendarSet':
+        calendars = {name: Calendar.from_json(name, calendar) for name, calendar in data.get('calendars', {}).items()}
+        products = data.get('products', {})
+        for product_id, name in products.items():
+            if name not in calendars:
+                raise ValueError(f'Product {product_id!r} uses the unknown calendar {name!r}')
+            if product_id != DEFAULT_PRODUCT and product_id not in registry:
+                raise ValueError(f'Calendar {name!r} is assigned to the unknown product {product_id!r}')
+        return cls(calendars, products, version)
+
+    @classmethod
+    def load(cls, path: str) -> 'CalendarSet':
+        with open(path, 'rb') as f:
+            raw = f.read()
+        if path.endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError(f'{path} is a YAML file, install the yaml extra to read it')
+            data = yaml.safe_load(raw)
+        else:
+            data = json.loads(raw)
+        return cls.from_json(data, hashlib.blake2b(raw, digest_size=8).hexdigest())
+
+    def of(self, product_id: str) -> Optional[Calendar]:
+        """Calendar of a product, None for the products with generated availability."""
+        return self._products.get(product_id, self._default)
+
+
+calendar_set = CalendarSet.load(CALENDARS) if CALENDARS else None
+
+
+def of(product_id: str) -> Optional[Calendar]:
+    return calendar_set.of(product_id) if calendar_set is not None else None
+
+
+def version() -> str:
+    """Version of the calendars file, part of the availability ETags."""
+    return calendar_set.version if calendar_set is not None else ''
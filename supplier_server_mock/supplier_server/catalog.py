@@ -0,0 +1,127 @@
+"""
+Catalog backends, the source of the products compiled into the `registry`.
+
+`SUPPLIER_SERVER_CATALOG` selects the backend:
+
+- `python:<module>:<attribute>`: a list of product dicts in a Python module, the default is the built-in catalog
+  `python:supplier_server.constants:PRODUCTS`
+- `<path>.json`: a JSON array of products
+- `<path>.ndjson` (or `.jsonl`): one JSON product per line, read line by line
+- `sqlite:///<path>`: a SQLite database with a `products` table holding one JSON product per row in its `data` column
+
+Products use the same fields as `constants.PRODUCTS`. The file and SQLite backends are read one product at a time, so
+large catalogs are never held in memory as raw JSON.
+"""
+import importlib
+import json
+import sqlite3
+from typing import Dict, Iterator
+
+from .constants import CATALOG
+
+DEFAULT_CATALOG = 'python:supplier_server.constants:PRODUCTS'
+# characters read at once from a JSON catalog
+READ_SIZE = 64 * 1024
+
+
+def iter_python(spec: str) -> Iterator[Dict]:
+    module_name, _, attribute = spec.partition(':')
+    yield from getattr(importlib.import_module(module_name), attribute or 'PRODUCTS')
+
+
+def iter_json(path: str) -> Iterator[Dict]:
+    """Products of a JSON array, decoded one at a time while the file is read in blocks."""
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        buffer = ''
+        position = 0
+        eof = False
+
+        def read_more():
+            nonlocal buffer, position, eof
+            block = f.read(READ_SIZE)
+            eof = not block
+            buffer = buffer[position:] + block
+            position = 0
+
+        def next_char() -> str:
+            """Next character that is not whitespace, empty at the end of the file."""
+            nonlocal position
+            while True:
+                while position < len(buffer) and buffer[position].isspace():
+                    position += 1
+                if position < len(buffer) or eof:
+                    return buffer[position:position + 1]
+                read_more()
+
+        if next_char() != '[':
+            raise ValueError(f'{path} is not a JSON array of products')
+        position += 1
+        if next_char() == ']':
+            return
+        while True:
+            next_char()
+            try:
+                product, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                read_more()
+                continue
+            position = end
+            yield product
+            separator = next_char()
+            if separator == ']':
+                return
+            if separator != ',':
+                raise ValueError(f'{path} is not a JSON array of products')
+            position += 1
+
+
+def iter_ndjson(path: str) -> Iterator[Dict]:
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_sqlite(path: str) -> Iterator[Dict]:
+    connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    try:
+        for data, in connection.execute('SELECT data FROM products ORDER BY rowid'):
+            yield json.loads(data)
+    finally:
+        connection.close()
+
+
+def create_sqlite(path: str, products: Iterator[Dict]):
+    """Write `products` into a SQLite catalog at `path`."""
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute('CREATE TABLE IF NOT EXISTS products (id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        connection.executemany(
+            'INSERT OR REPLACE INTO products (id, data) VALUES (?, ?)',
+            ((product['id'], json.dumps(product)) for product in products),
+        )
+    connection.close()
+
+
+def iter_products(url: str) -> Iterator[Dict]:
+    """Products of the catalog at `url`, see the module documentation for the supported backends."""
+    if url.startswith('python:'):
+        return iter_python(url[len('python:'):])
+    if url.startswith('sqlite:///'):
+        return iter_sqlite(url[len('sqlite:///'):])
+    if url.endswith(('.ndjson', '.jsonl')):
+        return iter_ndjson(url)
+    if url.endswith('.json'):
+        return iter_json(url)
+    raise ValueError(
+        f'Unknown catalog {url!r}, expected "python:<module>:<attribute>", a .json or .ndjson file or '
+        '"sqlite:///<path>"'
+    )
+
+
+def products() -> Iterator[Dict]:
+    """Products of the configured catalog."""
+    return iter_products(CATALOG or DEFAULT_CATALOG)
@@ -0,0 +1,111 @@
+"""
+Feed of the availability cells changed since a cursor, for clients syncing deltas instead of re-fetching windows.
+
+Every change to the tickets taken from a (product, timeslot, variant) cell, by a reservation, an expired hold, a
+booking, a cancellation or the scheduled drift (see `drift`), is appended to a ring buffer of the last
+`SUPPLIER_SERVER_CHANGE_FEED_SIZE` changes. `GET /v2/availability/changes?cursor=<cursor>` returns the cells changed
+since the cursor with their current availability, in the shape of `/availability` with only the changed variants,
+and the cursor to pass next.
+
+Cursors are opaque. A request without cursor, or with a cursor older than the buffer or issued by another worker
+process (the feed is per process), is answered with `"resync": true` and the current cursor: the client fetches the
+full availability again and then follows the feed from that cursor. Changes made meanwhile are returned again by the
+next request, so no change is missed.
+"""
+import base64
+import binascii
+from datetime import date
+import os
+from threading import Lock
+from typing import Dict, FrozenSet, List, Optional, Set, Tuple
+
+# imported first, so the cache of a day is invalidated before its change is recorded
+from . import availability
+from .constants import CHANGE_FEED_SIZE
+from .inventory import Allocation, inventory
+from .registry import registry
+
+# (product id, day, timeslot key, variant id)
+Cell = Tuple[str, date, str, str]
+
+EPOCH = os.urandom(8)
+
+
+def encode_cursor(seq: int) -> str:
+    return base64.urlsafe_b64encode(EPOCH + seq.to_bytes(8, 'big')).rstrip(b'=').decode()
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[int]:
+    """Sequence number of a cursor issued by this process, None for the others."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    except (binascii.Error, ValueError):
+        return None
+    if len(raw) != 16 or raw[:8] != EPOCH:
+        return None
+    return int.from_bytes(raw[8:], 'big')
+
+
+class ChangeFeed:
+    def __init__(self, size: int):
+        self.size = size
+        self._cells: List[Optional[Cell]] = [None] * size
+        # sequence number of the latest change, the change `seq` is kept at `seq % size`
+        self.head = 0
+        self._lock = Lock()
+
+    def record(self, allocation: Allocation):
+        if not self.size:
+            return
+        with self._lock:
+            for variant_id in allocation.quantities:
+                self.head += 1
+                self._cells[self.head % self.size] = (
+                    allocation.product_id, allocation.day, allocation.timeslot, variant_id,
+                )
+
+    def since(self, seq: int, limit: int) -> Optional[Tuple[List[Cell], int]]:
+        """
+        Cells changed after the change `seq`, at most `limit` changes, and the sequence number of the last one. None
+        when the changes after `seq` are no longer buffered.
+        """
+        with self._lock:
+            if seq > self.head or seq < self.head - self.size:
+                return None
+            last = min(self.head, seq + limit)
+            return [self._cells[i % self.size] for i in range(seq + 1, last + 1)], last
+
+
+feed = ChangeFeed(CHANGE_FEED_SIZE)
+inventory.subscribe(feed.record)
+
+
+def render(cells: List[Cell], within: Optional[FrozenSet[str]] = None) -> Dict[str, Dict]:
+    """
+    Current availability of the changed cells per product id and timeslot, with only the changed variants. A cell
+    changed several times is rendered once, the products missing from `within` are left out.
+    """
+    changed: Dict[Tuple[str, date], Dict[str, Set[str]]] = {}
+    for product_id, day, timeslot, variant_id in cells:
+        if within is None or product_id in within:
+            changed.setdefault((product_id, day), {}).setdefault(timeslot, set()).add(variant_id)
+    result: Dict[str, Dict] = {}
+    for (product_id, day), timeslots in changed.items():
+        product = registry.get(product_id)
+        if product is None:
+            continue
+        rendered_day = availability.get_day(product, day)
+        product_changes = result.setdefault(product_id, {})
+        for timeslot, variant_ids in timeslots.items():
+            rendered = rendered_day.get(timeslot)
+            if rendered is None:
+                continue
+            if rendered:
+                rendered = {
+                    'available_tickets': rendered['available_tickets'],
+                    'variants': [variant for variant in rendered['variants'] if variant['id'] in variant_ids],
+                }
+            product_changes[timeslot] = rendered
+    return result
@@ -0,0 +1,173 @@
+"""
+Response compression negotiated from `Accept-Encoding`.
+
+gzip is always available, brotli (`br`) when the `brotli` package is installed. Buffered bodies under
+`SUPPLIER_SERVER_COMPRESSION_MIN_SIZE` bytes are sent as they are, streamed bodies are compressed on the fly.
+
+Compressed bodies of the responses with an ETag are cached by ETag and encoding: the ETag changes with the content,
+so an entry never goes stale and a hit skips generating, encoding and compressing the body.
+"""
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+import zlib
+
+from .cache import TTLCache
+from .constants import (
+    AVAILABILITY_CACHE_TTL, COMPRESSION, COMPRESSION_BROTLI_QUALITY, COMPRESSION_CACHE_SIZE, COMPRESSION_LEVEL,
+    COMPRESSION_MIN_SIZE,
+)
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# zlib window bits selecting the gzip container
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# larger bodies are compressed but not cached
+CACHE_MAX_BODY_SIZE = 1024 * 1024
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+# event streams are sent as the events happen, a compressor would hold them back
+UNCOMPRESSED_TYPES = ('text/event-stream',)
+
+
+class _GzipCompressor:
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+    def process(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+def _compressor(encoding: str, level: Optional[int] = None):
+    """Incremental compressor with `process(data)` and `finish()`."""
+    if encoding == 'br':
+        return brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY if level is None else level)
+    return _GzipCompressor(COMPRESSION_LEVEL if level is None else level)
+
+
+def _available_encodings(names: str) -> Tuple[str, ...]:
+    encodings = []
+    for name in filter(None, (name.strip() for name in names.split(','))):
+        if name not in ('br', 'gzip'):
+            raise ValueError(f'Unknown compression {name!r}, expected br or gzip')
+        if name != 'br' or brotli is not None:
+            encodings.append(name)
+    return tuple(encodings)
+
+
+# supported encodings in order of preference
+ENCODINGS = _available_encodings(COMPRESSION)
+
+# compressed body per (ETag, encoding)
+cache = TTLCache(COMPRESSION_CACHE_SIZE, AVAILABILITY_CACHE_TTL)
+
+
+def negotiate(accept_encoding: Optional[str]) -> Optional[str]:
+    """Preferred encoding accepted by the client, None to send the body as it is."""
+    if not accept_encoding or not ENCODINGS:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        accepted[name.strip().lower()] = quality
+    wildcard = accepted.get('*', 0.0)
+    best, best_quality = None, 0.0
+    for encoding in ENCODINGS:
+        quality = accepted.get(encoding, wildcard)
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+    return (
+        bool(content_type) and content_type.startswith(COMPRESSIBLE_TYPES)
+        and not content_type.startswith(UNCOMPRESSED_TYPES)
+    )
+
+
+def worth_compressing(size: int) -> bool:
+    return size >= COMPRESSION_MIN_SIZE
+
+
+def cached(etag: str, encoding: Optional[str]) -> Optional[bytes]:
+    """Compressed body of the response with `etag`, None when it is not cached."""
+    if encoding is None:
+        return None
+    return cache.get((etag, encoding))
+
+
+def compress(data: bytes, encoding: str, level: Optional[int] = None) -> bytes:
+    compressor = _compressor(encoding, level)
+    return compressor.process(data) + compressor.finish()
+
+
+def compress_cached(data: bytes, encoding: str, etag: Optional[str]) -> bytes:
+    """Compress `data`, caching the result under the ETag of the response when it has one."""
+    body = compress(data, encoding)
+    if etag and len(body) <= CACHE_MAX_BODY_SIZE:
+        cache.set((etag, encoding), body)
+    return body
+
+
+class StreamCompressor:
+    """
+    Compresses a streamed body on the fly, the compressor decides when it has enough data for a chunk.
+
+    The compressed body is cached under `etag` when the stream completes and is small enough.
+    """
+
+    def __init__(self, encoding: str, etag: Optional[str] = None):
+        self.encoding = encoding
+        self.etag = etag
+        self._compressor = _compressor(encoding)
+        self._kept: Optional[List[bytes]] = [] if etag else None
+        self._kept_size = 0
+
+    def _keep(self, data: bytes) -> bytes:
+        if self._kept is not None and data:
+            self._kept.append(data)
+            self._kept_size += len(data)
+            if self._kept_size > CACHE_MAX_BODY_SIZE:
+                self._kept = None
+        return data
+
+    def process(self, chunk: bytes) -> bytes:
+        return self._keep(self._compressor.process(chunk))
+
+    def finish(self) -> bytes:
+        data = self._keep(self._compressor.finish())
+        if self._kept is not None:
+            cache.set((self.etag, self.encoding), b''.join(self._kept))
+        return data
+
+
+def compress_stream(
+    chunks: Iterable[bytes], encoding: str, etag: Optional[str] = None, close: Optional[Callable] = None,
+) -> Iterator[bytes]:
+    compressor = StreamCompressor(encoding, etag)
+    try:
+        for chunk in chunks:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if close is not None:
+            close()
+
+
+def representation_etag(etag: str, encoding: str) -> str:
+    """ETag of the compressed representation, a strong ETag must differ between encodings."""
+    return f'{etag[:-1]}-{encoding}"'
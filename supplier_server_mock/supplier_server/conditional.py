@@ -0,0 +1,40 @@
+"""
+Strong ETags and `If-None-Match` handling for conditional requests.
+
+The ETags are derived from versions, never from the response body, so a matching request is answered with
+`304 Not Modified` without building or encoding the body.
+"""
+import hashlib
+import os
+from typing import Optional
+
+# compressed representations append their encoding to the ETag, see `compression.representation_etag`
+ENCODING_SUFFIXES = ('-gzip"', '-br"')
+
+# the inventory versions count changes in this process, the epoch tells the worker processes apart
+EPOCH = os.urandom(8).hex()
+
+
+def make_etag(*parts) -> str:
+    """Quoted strong ETag of the version `parts`."""
+    return '"%s"' % hashlib.blake2b('\x1f'.join(map(str, parts)).encode(), digest_size=12).hexdigest()
+
+
+def matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    Whether an `If-None-Match` header value matches `etag` or one of its compressed representations, using the weak
+    comparison of RFC 7232.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag.endswith(ENCODING_SUFFIXES):
+            tag = tag[:tag.rindex('-')] + '"'
+        if tag == etag:
+            return True
+    return False
@@ -1,3 +1,5 @@
+import os
+
 PRODUCTS = [
     {
         'id': 'A300-FX',
@@ -9,7 +11,6 @@ PRODUCTS = [
         'provides_pricing': True,
         # but these fields are not part of spec...
         '_ticket_content_type': 'CODE128',
-        '_cancelled_bookings': {},
         '_timeslot_available_tickets_as_sum': True,  # available tickets is the sum among all variants
         '_tickets_already_used': False,
     },
@@ -25,7 +26,6 @@ PRODUCTS = [
         'required_visitor_data': ['full_name', 'phone'],
         'required_order_data': ['pickup_location', 'passport_id'],
         '_ticket_content_type': 'CODE128',
-        '_cancelled_bookings': {},
         '_timeslot_available_tickets_as_sum': False,
         '_tickets_already_used': False,
     },
@@ -40,7 +40,6 @@ PRODUCTS = [
         'provides_pricing': True,
         'required_order_data': ['pickup_location', 'passport_id', 'flight_number'],
         '_ticket_content_type': 'CODE128',
-        '_cancelled_bookings': {},
         '_timeslot_available_tickets_as_sum': False,
         '_tickets_already_used': False,
     },
@@ -54,7 +53,6 @@ PRODUCTS = [
         'required_visitor_data': ['email', 'date_of_birth'],
         'provides_pricing': False,
         '_ticket_content_type': 'PDF',
-        '_cancelled_bookings': {},
         '_timeslot_available_tickets_as_sum': False,
         '_tickets_already_used': False,
     },
@@ -68,7 +66,6 @@ PRODUCTS = [
         'required_order_data': ['nationality'],
         'provides_pricing': False,
         '_ticket_content_type': 'AZTEC-BYTES',
-        '_cancelled_bookings': {},
         '_timeslot_available_tickets_as_sum': False,
         '_tickets_already_used': True,
     },
@@ -78,3 +75,63 @@ MAX_DATE_RANGE = 6  # in months
 PRODUCTS_CURRENCIES = {
     'A400-FX': 'USD',
 }
+
+# generated availability per (product, day), see `availability.cache`; a size of 0 disables the cache
+AVAILABILITY_CACHE_SIZE = int(os.environ.get('SUPPLIER_SERVER_AVAILABILITY_CACHE_SIZE', 10000))
+AVAILABILITY_CACHE_TTL = float(os.environ.get('SUPPLIER_SERVER_AVAILABILITY_CACHE_TTL', 300))  # in seconds
+# path of the precomputed availability table shared by the worker processes, see `table`
+AVAILABILITY_TABLE = os.environ.get('SUPPLIER_SERVER_AVAILABILITY_TABLE')
+# /availability responses spanning at least this many days are streamed, 0 streams every response
+AVAILABILITY_STREAMING_MIN_DAYS = int(os.environ.get('SUPPLIER_SERVER_AVAILABILITY_STREAMING_MIN_DAYS', 32))
+# JSON serializer of the responses: auto (orjson when it is installed), orjson or stdlib
+JSON_SERIALIZER = os.environ.get('SUPPLIER_SERVER_JSON_SERIALIZER', 'auto')
+# booking state store: memory (per worker process) or sqlite:///<path> (shared by all worker processes)
+STATE_STORE = os.environ.get('SUPPLIER_SERVER_STATE_STORE', 'memory')
+# directory of the durable booking ledger, see `ledger`; the ledger is disabled when it is not set
+LEDGER_DIR = os.environ.get('SUPPLIER_SERVER_LEDGER_DIR')
+# the ledger log is folded into a snapshot once it grows over this size
+LEDGER_COMPACT_BYTES = int(os.environ.get('SUPPLIER_SERVER_LEDGER_COMPACT_BYTES', 16 * 1024 * 1024))
+# JSON file with the latency and fault injection profiles, see `faults`
+FAULT_PROFILES = os.environ.get('SUPPLIER_SERVER_FAULT_PROFILES')
+# the Flask server blocks a worker thread while injecting latency, timeouts and throttling, for at most this long
+FAULT_SYNC_MAX_WAIT = float(os.environ.get('SUPPLIER_SERVER_FAULT_SYNC_MAX_WAIT', 10))  # in seconds
+# product catalog backend, see `catalog`; the built-in PRODUCTS are used when it is not set
+CATALOG = os.environ.get('SUPPLIER_SERVER_CATALOG')
+# response encodings in order of preference, br is skipped when brotli is not installed; empty disables compression
+COMPRESSION = os.environ.get('SUPPLIER_SERVER_COMPRESSION', 'br,gzip')
+# buffered responses smaller than this many bytes are not compressed
+COMPRESSION_MIN_SIZE = int(os.environ.get('SUPPLIER_SERVER_COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_LEVEL = int(os.environ.get('SUPPLIER_SERVER_COMPRESSION_LEVEL', 6))  # gzip, 1-9
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('SUPPLIER_SERVER_COMPRESSION_BROTLI_QUALITY', 5))  # 0-11
+# compressed bodies kept per (ETag, encoding), see `compression.cache`; 0 disables the cache
+COMPRESSION_CACHE_SIZE = int(os.environ.get('SUPPLIER_SERVER_COMPRESSION_CACHE_SIZE', 256))
+# key signing the reservation and booking IDs, see `ids`; set the same value for every worker process
+ID_SECRET = os.environ.get('SUPPLIER_SERVER_ID_SECRET', 'supplier-server-mock')
+# directory of the per-process metric files aggregated by /metrics, see `metrics`
+METRICS_DIR = os.environ.get('SUPPLIER_SERVER_METRICS_DIR')
+# directory of the request profiles, see `profiling`; profiling is disabled when it is not set
+PROFILE_DIR = os.environ.get('SUPPLIER_SERVER_PROFILE_DIR')
+# share of the requests profiled without asking for it, changed at runtime on /_admin/profiles
+PROFILE_SAMPLE_RATE = float(os.environ.get('SUPPLIER_SERVER_PROFILE_SAMPLE_RATE', 0))
+# JSON file of the API keys with their tenant, scenario, catalog and limits, see `keys`; only `secret` when not set
+API_KEYS = os.environ.get('SUPPLIER_SERVER_API_KEYS')
+# booking responses replayed to retried requests, see `idempotency`; 0 disables the cache
+BOOKING_CACHE_SIZE = int(os.environ.get('SUPPLIER_SERVER_BOOKING_CACHE_SIZE', 10000))
+BOOKING_CACHE_TTL = float(os.environ.get('SUPPLIER_SERVER_BOOKING_CACHE_TTL', 3600))  # in seconds
+# products of one bulk availability request, see `handlers.bulk_availability`
+BULK_AVAILABILITY_MAX_PRODUCTS = int(os.environ.get('SUPPLIER_SERVER_BULK_AVAILABILITY_MAX_PRODUCTS', 10000))
+# changes kept for the availability change feed, see `changes`; older cursors are answered with a resync
+CHANGE_FEED_SIZE = int(os.environ.get('SUPPLIER_SERVER_CHANGE_FEED_SIZE', 100000))
+# changes returned by one change feed request when it doesn't set `limit`
+CHANGE_FEED_PAGE_SIZE = int(os.environ.get('SUPPLIER_SERVER_CHANGE_FEED_PAGE_SIZE', 1000))
+# seconds between two rounds of simulated sales outside of the API, see `drift`; 0 disables the drift
+DRIFT_INTERVAL = float(os.environ.get('SUPPLIER_SERVER_DRIFT_INTERVAL', 0))
+DRIFT_CHANGES = int(os.environ.get('SUPPLIER_SERVER_DRIFT_CHANGES', 10))  # cells changed per round
+DRIFT_DAYS = int(os.environ.get('SUPPLIER_SERVER_DRIFT_DAYS', 30))  # days ahead of today that drift
+# events kept per product for the availability SSE stream, subscribers falling further behind are disconnected
+SSE_BACKLOG = int(os.environ.get('SUPPLIER_SERVER_SSE_BACKLOG', 256))
+# seconds without events after which a keep-alive comment is sent on the availability SSE stream
+SSE_HEARTBEAT = float(os.environ.get('SUPPLIER_SERVER_SSE_HEARTBEAT', 15))
+# JSON or YAML file of the rule-based availability calendars, see `calendars`; all the availability is generated when
+# it is not set
+CALENDARS = os.environ.get('SUPPLIER_SERVER_CALENDARS')
@@ -0,0 +1,87 @@
+"""
+Scheduled inventory drift: tickets sold and returned outside of the API, like at the venue's box office.
+
+Enabled by `SUPPLIER_SERVER_DRIFT_INTERVAL`. Every interval, `SUPPLIER_SERVER_DRIFT_CHANGES` random (product, timeslot,
+variant) cells of the next `SUPPLIER_SERVER_DRIFT_DAYS` days lose a few tickets or get back some of the tickets they
+lost to the drift. The drift is applied by the next availability or change feed request, at most
+`MAX_CATCH_UP_INTERVALS` intervals at once, and goes through the inventory like a reservation, so the availability
+cache, the ETags and the change feed all see it.
+
+The drift is per worker process and is not written to the ledger.
+"""
+from datetime import date, timedelta
+import random
+from threading import Lock
+import time
+from typing import Dict, Tuple
+
+from . import availability
+from .constants import DRIFT_CHANGES, DRIFT_DAYS, DRIFT_INTERVAL
+from .inventory import Allocation, inventory
+from .registry import registry
+
+MAX_CATCH_UP_INTERVALS = 10
+# tickets taken from a cell by one change
+MAX_TICKETS_PER_CHANGE = 3
+
+
+class Drift:
+    def __init__(self, interval: float, changes: int, days: int):
+        if interval <= 0 or changes < 1 or days < 1:
+            raise ValueError('drift needs a positive interval, changes and days')
+        self.interval = interval
+        self.changes = changes
+        self.days = days
+        self._due = time.monotonic() + interval
+        self._lock = Lock()
+        # tickets taken by the drift per (product id, day, timeslot, variant id)
+        self._drifted: Dict[Tuple[str, date, str, str], int] = {}
+        self._random = random.Random()
+
+    def tick(self):
+        """Apply the changes of the intervals elapsed since the last call."""
+        now = time.monotonic()
+        if now < self._due or not self._lock.acquire(blocking=False):
+            return
+        try:
+            intervals = int((now - self._due) / self.interval) + 1
+            self._due += intervals * self.interval
+            self.apply(min(intervals, MAX_CATCH_UP_INTERVALS) * self.changes)
+        finally:
+            self._lock.release()
+
+    def apply(self, changes: int):
+        """Change `changes` random cells now, the cells without tickets left are not changed."""
+        today = date.today()
+        for _ in range(changes):
+            self._change(today)
+
+    def _change(self, today: date):
+        product = self._random.choice(registry.products)
+        day = today + timedelta(days=self._random.randrange(self.days))
+        layout = availability.get_layout(product)
+        timeslots = layout.day_timeslots(day)
+        if not timeslots:
+            return
+        timeslot = f'{day.isoformat()}T{self._random.choice(timeslots)}'
+        variant_id = self._random.choice(layout.variants)[0]
+        cell = (product.id, day, timeslot, variant_id)
+        drifted = self._drifted.get(cell, 0)
+        if drifted and self._random.random() < 0.5:
+            quantity = -self._random.randint(1, drifted)
+        else:
+            quantity = self._random.randint(1, MAX_TICKETS_PER_CHANGE)
+        allocation = Allocation(product.id, day, timeslot, {variant_id: quantity})
+        if inventory.adjust(allocation, availability.capacity(product, day)):
+            if drifted + quantity:
+                self._drifted[cell] = drifted + quantity
+            else:
+                del self._drifted[cell]
+
+
+drift = Drift(DRIFT_INTERVAL, DRIFT_CHANGES, DRIFT_DAYS) if DRIFT_INTERVAL else None
+
+
+def tick():
+    if drift is not None:
+        drift.tick()
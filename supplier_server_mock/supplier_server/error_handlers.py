@@ -9,6 +9,18 @@ def server_error(exception):
     return 'Service Error - Please report that', 500
 
 
+def service_unavailable(exception):
+    return 'Service Unavailable - Please try again later', 503
+
+
+def too_many_requests(exception):
+    return 'Too Many Requests - The API key is over its quota, retry later', 429
+
+
+def gateway_timeout(exception):
+    return 'Gateway Timeout - The request took too long', 504
+
+
 def bad_request(exception):
     return {
         "error_code": exception.error_code,
@@ -0,0 +1,214 @@
+"""
+Latency and fault injection profiles.
+
+Profiles are loaded from the JSON file set in `SUPPLIER_SERVER_FAULT_PROFILES`:
+
+    {
+        "profiles": {
+            "slow-supplier": {
+                "*": {"latency": {"distribution": "lognormal", "median_ms": 150, "sigma": 0.6}},
+                "booking": {
+                    "latency": {"distribution": "histogram", "file": "booking_latency.txt"},
+                    "errors": {"500": 0.01, "503": 0.02, "timeout": 0.005, "reset": 0.001},
+                    "timeout_ms": 30000,
+                    "bandwidth": 65536
+                }
+            }
+        },
+        "api_keys": {"secret": "slow-supplier"}
+    }
+
+Routes are the endpoint names (`products`, `availability`, `bulk_availability`, `availability_changes`,
+`availability_stream`, `reservation`, `booking`, `cancel_booking`), `*` applies to the routes without their own
+settings. A request uses the profile named in the `X-Mock-Fault-Profile` header, or else the profile of its API key.
+
+Latency distributions:
+
+- `fixed`: `ms`
+- `normal`: `mean_ms`, `stddev_ms`
+- `lognormal`: `median_ms`, `sigma`
+- `histogram`: `file` with one `<upper bound in ms> <count>` bucket per line, relative to the profiles file
+
+Errors are probabilities per request: `500` and `503` answer with that status, `timeout` answers 504 after
+`timeout_ms`, `reset` drops the connection in the middle of the response. `bandwidth` throttles the response body to
+that many bytes per second.
+
+The Flask application waits in the worker thread, so it cuts the latency, timeout and throttling of a request to
+`SUPPLIER_SERVER_FAULT_SYNC_MAX_WAIT` seconds in total. The ASGI application waits on the event loop without limit.
+"""
+import asyncio
+from bisect import bisect_left
+from dataclasses import dataclass, field
+from itertools import accumulate
+import json
+import os
+import random
+import time
+from typing import AsyncIterator, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .constants import FAULT_PROFILES
+
+PROFILE_HEADER = 'X-Mock-Fault-Profile'
+ERRORS = ('500', '503', 'timeout', 'reset')
+# throttled bodies are sent in slices of this many seconds worth of bandwidth
+THROTTLE_INTERVAL = 0.1
+
+Sampler = Callable[[random.Random], float]
+
+
+def _histogram_sampler(path: str) -> Sampler:
+    bounds: List[float] = []
+    counts: List[int] = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                upper_ms, count = line.split()
+                bounds.append(float(upper_ms) / 1000)
+                counts.append(int(count))
+    cumulative = list(accumulate(counts))
+
+    def sample(rng: random.Random) -> float:
+        bucket = bisect_left(cumulative, rng.uniform(0, cumulative[-1]))
+        lower = bounds[bucket - 1] if bucket else 0.0
+        return rng.uniform(lower, bounds[bucket])
+
+    return sample
+
+
+def make_sampler(spec: Dict, base_dir: str) -> Sampler:
+    """Latency sampler in seconds."""
+    distribution = spec['distribution']
+    if distribution == 'fixed':
+        seconds = spec['ms'] / 1000
+        return lambda rng: seconds
+    if distribution == 'normal':
+        mean, stddev = spec['mean_ms'] / 1000, spec['stddev_ms'] / 1000
+        return lambda rng: max(0.0, rng.gauss(mean, stddev))
+    if distribution == 'lognormal':
+        median, sigma = spec['median_ms'] / 1000, spec['sigma']
+        return lambda rng: median * rng.lognormvariate(0, sigma)
+    if distribution == 'histogram':
+        return _histogram_sampler(os.path.join(base_dir, spec['file']))
+    raise ValueError(f'Unknown latency distribution {distribution!r}')
+
+
+@dataclass
+class Plan:
+    """What to do to a single request."""
+    delay: float = 0.0
+    error: Optional[str] = None
+    timeout: float = 0.0
+    bandwidth: Optional[int] = None
+
+
+@dataclass
+class RouteFaults:
+    latency: Optional[Sampler] = None
+    # (cumulative probability, error)
+    errors: List[Tuple[float, str]] = field(default_factory=list)
+    timeout: float = 60.0
+    bandwidth: Optional[int] = None
+
+    @classmethod
+    def from_json(cls, data: Dict, base_dir: str) -> 'RouteFaults':
+        errors = []
+        total = 0.0
+        for error, probability in data.get('errors', {}).items():
+            if error not in ERRORS:
+                raise ValueError(f'Unknown error {error!r}, expected one of {", ".join(ERRORS)}')
+            total += probability
+            errors.append((total, error))
+        return cls(
+            latency=make_sampler(data['latency'], base_dir) if 'latency' in data else None,
+            errors=errors,
+            timeout=data.get('timeout_ms', 60000) / 1000,
+            bandwidth=data.get('bandwidth'),
+        )
+
+    def plan(self, rng: random.Random) -> Plan:
+        plan = Plan(timeout=self.timeout, bandwidth=self.bandwidth)
+        if self.latency is not None:
+            plan.delay = self.latency(rng)
+        if self.errors:
+            draw = rng.random()
+            plan.error = next((error for threshold, error in self.errors if draw < threshold), None)
+        return plan
+
+
+class FaultInjector:
+    def __init__(self, profiles: Dict[str, Dict[str, RouteFaults]], api_keys: Dict[str, str]):
+        self.profiles = profiles
+        self.api_keys = api_keys
+        self._rng = random.Random()
+
+    @classmethod
+    def load(cls, path: str) -> 'FaultInjector':
+        base_dir = os.path.dirname(os.path.abspath(path))
+        with open(path) as f:
+            data = json.load(f)
+        profiles = {
+            name: {route: RouteFaults.from_json(faults, base_dir) for route, faults in routes.items()}
+            for name, routes in data.get('profiles', {}).items()
+        }
+        for api_key, name in data.get('api_keys', {}).items():
+            if name not in profiles:
+                raise ValueError(f'API key {api_key!r} uses the unknown fault profile {name!r}')
+        return cls(profiles, data.get('api_keys', {}))
+
+    def plan(self, route: str, api_key: Optional[str], profile_name: Optional[str]) -> Optional[Plan]:
+        """Faults for a request, None when no profile applies."""
+        if not profile_name:
+            profile_name = self.api_keys.get(api_key)
+        profile = self.profiles.get(profile_name)
+        if profile is None:
+            return None
+        faults = profile.get(route) or profile.get('*')
+        if faults is None:
+            return None
+        return faults.plan(self._rng)
+
+
+def _slices(data: bytes, bandwidth: int) -> Iterator[bytes]:
+    size = max(1, int(bandwidth * THROTTLE_INTERVAL))
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+
+def throttle(chunks: Iterable[bytes], bandwidth: int, deadline: float) -> Iterator[bytes]:
+    """
+    Send `chunks` at `bandwidth` bytes per second until the `time.monotonic()` deadline, then at full speed. The delay
+    blocks the thread, prefer the ASGI server.
+    """
+    for chunk in chunks:
+        for piece in _slices(chunk, bandwidth):
+            yield piece
+            remaining = deadline - time.monotonic()
+            if remaining > 0:
+                time.sleep(min(len(piece) / bandwidth, remaining))
+
+
+def reset(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Send half of the first chunk, then drop the connection."""
+    for chunk in chunks:
+        yield chunk[:len(chunk) // 2]
+        break
+    raise ConnectionResetError('Injected connection reset')
+
+
+async def athrottle(chunks: AsyncIterator[bytes], bandwidth: int) -> AsyncIterator[bytes]:
+    """Send `chunks` at `bandwidth` bytes per second without blocking the event loop."""
+    async for chunk in chunks:
+        for piece in _slices(chunk, bandwidth):
+            yield piece
+            await asyncio.sleep(len(piece) / bandwidth)
+
+
+async def areset(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    async for chunk in chunks:
+        yield chunk[:len(chunk) // 2]
+        break
+    raise ConnectionResetError('Injected connection reset')
+
+
+injector: Optional[FaultInjector] = FaultInjector.load(FAULT_PROFILES) if FAULT_PROFILES else None
@@ -0,0 +1,414 @@
+"""
+Request handlers shared by the WSGI (`app`) and ASGI (`asgi`) applications.
+
+They take the parsed request data, raise `exceptions.BadRequest` for API errors and return the data to encode.
+"""
+from datetime import date, datetime
+from datetime import timezone
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Tuple
+
+import arrow
+
+from .inventory import Allocation, inventory
+from .keys import ApiKey
+from .registry import CompiledProduct, registry
+from . import availability as availability_engine
+from . import barcodes, calendars, changes, conditional, constants, drift, exceptions, idempotency, ledger, metrics
+from . import ids, state, utils
+
+
+def products(api_key: ApiKey) -> List[Dict]:
+    return api_key.products
+
+
+def products_etag(api_key: ApiKey) -> str:
+    return conditional.make_etag('products', registry.version, api_key.catalog_version)
+
+
+def availability_etag(product: CompiledProduct, start: date, end: date) -> str:
+    """ETag of the availability of a date range, it changes when the catalog or the product's inventory changes."""
+    drift.tick()
+    inventory.release_expired()
+    version = inventory.version(product.id)
+    # untouched inventory is the same in every worker process
+    epoch = conditional.EPOCH if version else ''
+    return conditional.make_etag(
+        'availability', registry.version, calendars.version(), product.id, start, end, epoch, version,
+    )
+
+
+def availability_window(
+    product_id: str, args: Mapping[str, str], api_key: ApiKey,
+) -> Optional[Tuple[CompiledProduct, date, date]]:
+    """Product and validated date range of an availability request, None when the whole range is in the past."""
+    start = utils.get_date(args, 'start')
+    end = utils.get_date(args, 'end')
+    if start > end:
+        raise exceptions.BadRequest(2001, 'Incorrect date range', 'The end date cannot be earlier than start date')
+    product = api_key.product(product_id)
+    today = date.today()
+    if end < today:
+        return None
+    return product, max(today, start), end
+
+
+def bulk_availability(product_ids, args: Mapping[str, str], api_key: ApiKey) -> Iterator[Tuple[str, Iterable[Dict]]]:
+    """
+    Availability of several products over one date range as (product id, days) pairs, in product id order.
+
+    `product_ids` is a list or a comma separated string. The request is validated before the first pair is produced.
+    """
+    if isinstance(product_ids, str):
+        product_ids = product_ids.split(',')
+    if not isinstance(product_ids, list) or not all(isinstance(product_id, str) for product_id in product_ids):
+        raise exceptions.BadRequest(1000, 'Missing argument', 'Argument "product_ids" must be a list of product IDs')
+    product_ids = sorted({product_id.strip() for product_id in product_ids} - {''})
+    if not product_ids:
+        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "product_ids" was not found')
+    if len(product_ids) > constants.BULK_AVAILABILITY_MAX_PRODUCTS:
+        raise exceptions.BadRequest(
+            2005,
+            'Invalid Value',
+            f'At most {constants.BULK_AVAILABILITY_MAX_PRODUCTS} products can be requested at once',
+        )
+    start = utils.get_date(args, 'start')
+    end = utils.get_date(args, 'end')
+    if start > end:
+        raise exceptions.BadRequest(2001, 'Incorrect date range', 'The end date cannot be earlier than start date')
+    products = [api_key.product(product_id) for product_id in product_ids]
+    drift.tick()
+    today = date.today()
+    if end < today:
+        return ((product.id, ()) for product in products)
+    return availability_engine.iter_bulk(products, max(today, start), end)
+
+
+def availability_changes(args: Mapping[str, str], api_key: ApiKey) -> Dict:
+    """
+    Availability cells changed since the `cursor` argument, at most `limit` changes, see `changes`. Answered with
+    `resync` when the cursor is missing or expired.
+    """
+    limit = args.get('limit', constants.CHANGE_FEED_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        limit = 0
+    if limit < 1:
+        raise exceptions.BadRequest(2005, 'Invalid Value', 'Argument "limit" must be a positive integer')
+    drift.tick()
+    inventory.release_expired()
+    seq = changes.decode_cursor(args.get('cursor'))
+    page = changes.feed.since(seq, limit) if seq is not None else None
+    if page is None:
+        return {'cursor': changes.encode_cursor(changes.feed.head), 'resync': True, 'more': False, 'changes': {}}
+    cells, last = page
+    return {
+        'cursor': changes.encode_cursor(last),
+        'resync': False,
+        'more': last < changes.feed.head,
+        'changes': changes.render(cells, api_key.catalog),
+    }
+
+
+def should_stream(start: date, end: date) -> bool:
+    return (end - start).days + 1 >= constants.AVAILABILITY_STREAMING_MIN_DAYS
+
+
+def reservation(product_id: str, payload: Dict, api_key: ApiKey) -> Dict:
+    product = api_key.product(product_id)
+
+    datetime_parameter_value = payload.get('datetime')
+    if not datetime_parameter_value:
+        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "datetime" was not found')
+
+    tickets = payload.get('tickets')
+    if not tickets:
+        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "tickets" was not found')
+
+    customer = payload.get('customer')
+    if not customer:
+        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "customer" was not found')
+
+    # get the additional order-level information required by this product
+    product_requires_additional_order_data = product.required_order_data
+    if product_requires_additional_order_data:
+        required_order_data = payload.get('required_order_data', {})
+        required_order_data_keys = required_order_data.keys()
+        missing_fields = product_requires_additional_order_data.difference(required_order_data_keys)
+        if not required_order_data or missing_fields:
+            raise exceptions.BadRequest(
+                1003,
+                'Missing required fields',
+                f'Missing required additional order data: {",".join(missing_fields)}',
+            )
+
+    # extract date and timeslot information from datetime attribute
+    try:
+        datetime_parameter = datetime.strptime(datetime_parameter_value, '%Y-%m-%dT%H:%M')
+        day = datetime_parameter.date()
+        timeslot: str = datetime_parameter.time().strftime('%H:%M')
+    except ValueError:
+        raise exceptions.BadRequest(
+            2000,
+            'Malformed datetime',
+            f'Expected datetime attribute with format YYYY-MM-DDTHH:MM'
+        )
+
+    today_utc = datetime.utcnow().date()
+    if day < today_utc:
+        raise exceptions.BadRequest(2009, 'Incorrect date', 'Cannot use the past date')
+
+    if day > arrow.get(today_utc).shift(months=constants.MAX_DATE_RANGE).date():
+        raise exceptions.BadRequest(
+            2009,
+            'Incorrect date',
+            f'This date is too far ahead in the future. You can book max {constants.MAX_DATE_RANGE} months ahead.'
+        )
+
+    # if the product doesn't support timeslots then set the time component to 00:00 to extract availability for that
+    # date/time
+    timeslot_availability_key: str = (
+        datetime_parameter_value if product.use_timeslots else f'{day}T00:00'
+    )
+
+    product_availability: Dict = utils.get_availability(product_id, day)
+
+    # map variant ids to available tickets
+    variant_quantity_mapping: Dict[str, int] = {
+        str(variant['id']): variant['available_tickets']
+        for variant in product_availability.get(timeslot_availability_key, {}).get('variants', [])
+    }
+
+    # get the additional visitors-level information required by this product
+    product_requires_additional_visitors_data = product.required_visitor_data
+
+    for ticket in tickets:
+        ticket_variant_id = str(ticket['variant_id'])
+        quantity = ticket['quantity']
+        if not isinstance(quantity, int) or isinstance(quantity, bool):
+            raise exceptions.BadRequest(
+                2004, 'Incorrect type', f'Expected "quantity" to be an integer, got {type(quantity).__name__} instead',
+            )
+        if quantity < 0:
+            raise exceptions.BadRequest(2005, 'Invalid Value', 'The ticket quantity must not be negative')
+        if (
+                not variant_quantity_mapping.get(ticket_variant_id)
+                or (ticket['quantity'] > variant_quantity_mapping.get(ticket_variant_id))
+        ):
+            raise exceptions.BadRequest(
+                3000,
+                'Availability error',
+                f'The requested number of tickets is not longer available for the given variant and/or timeslot'
+            )
+
+        if product_requires_additional_visitors_data:
+            required_visitor_data: List[Dict] = ticket.get('required_visitor_data', [])
+
+            if not required_visitor_data or len(required_visitor_data) != ticket['quantity']:
+                missing_qty = ticket['quantity'] - len(required_visitor_data)
+                raise exceptions.BadRequest(
+                    1003, 'Missing required fields', f'Missing visitor information for {missing_qty} visitors',
+                )
+
+            for visitor_data in required_visitor_data:
+                missing_fields = product_requires_additional_visitors_data.difference(visitor_data.keys())
+                if missing_fields:
+                    raise exceptions.BadRequest(
+                        1003,
+                        'Missing required fields',
+                        f'Missing required additional visitor data: {",".join(missing_fields)}'
+                    )
+
+    quantities = utils.ticket_quantities(tickets)
+    if max(quantities.values()) > ids.MAX_QUANTITY:
+        raise exceptions.BadRequest(
+            3008,
+            'Maximum tickets per order exceeded',
+            f'A maximum of {ids.MAX_QUANTITY} tickets per variant can be booked per order',
+        )
+
+    expires_at = arrow.utcnow().shift(minutes=30)
+    reservation_date = datetime.fromisoformat(day.isoformat() + " " + timeslot)
+
+    reservation_id = utils.encode_reservation_id(expires_at.datetime, tickets, product_id, reservation_date)
+    allocation = Allocation(product_id, day, timeslot_availability_key, quantities)
+    if not inventory.reserve(
+        reservation_id, allocation, availability_engine.capacity(product, day), expires_at.datetime.timestamp(),
+    ):
+        # the tickets were taken by a concurrent reservation
+        raise exceptions.BadRequest(
+            3000,
+            'Availability error',
+            'The requested number of tickets is not longer available for the given variant and/or timeslot'
+        )
+    ledger.record(
+        'reservation',
+        reservation_id=reservation_id,
+        product_id=product_id,
+        datetime=reservation_date.isoformat(),
+        tickets=allocation.quantities,
+        expires_at=expires_at.datetime.timestamp(),
+    )
+
+    reservation_response = {
+        'reservation_id': reservation_id,
+        'expires_at': expires_at.isoformat(),
+    }
+
+    if product.provides_pricing:
+        variant_price_mapping: Dict[str, Dict] = {}  # map variant ids to price data
+        for variant in product_availability.get(timeslot_availability_key, {}).get('variants', []):
+            variant_price_mapping[variant['id']] = variant['price']
+
+        reservation_response['unit_price'] = {}
+
+        for variant_id in [str(ticket.get('variant_id')) for ticket in tickets]:
+            if variant_id in variant_price_mapping:
+                reservation_response['unit_price'][variant_id] = variant_price_mapping.get(variant_id, {})
+
+    return reservation_response
+
+
+def booking(payload: Dict, api_key: ApiKey) -> Dict:
+    reservation_id = payload.get('reservation_id')
+    order_reference = payload.get('order_reference')
+
+    if not reservation_id:
+        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "reservation_id" was not found')
+
+    if not order_reference:
+        raise exceptions.BadRequest(1000, 'Missing argument', 'Required argument "order_reference" was not found')
+
+    try:
+        expires_at, variant_quantity_map, product_id, booking_date = utils.decode_reservation_data(reservation_id)
+    except Exception:
+        raise exceptions.BadRequest(3002, 'Incorrect reservation ID', 'Given reservation ID is incorrect')
+
+    now = arrow.utcnow().datetime
+    if now > expires_at:
+        minutes_ago = round((now - expires_at).seconds / 60)
+        raise exceptions.BadRequest(
+            3001, 'Reservation expired', f'Your reservation has expired {minutes_ago} minutes ago'
+        )
+
+    product = api_key.product(product_id)
+    booking_id = utils.encode_booking_id(booking_date.isoformat(), product_id, reservation_id)
+    allocation = Allocation(
+        product_id,
+        booking_date.date(),
+        availability_engine.timeslot_key(product, booking_date),
+        {str(variant_id): quantity for variant_id, quantity in variant_quantity_map.items()},
+    )
+    if not inventory.book(
+        reservation_id, booking_id, allocation, availability_engine.capacity(product, booking_date.date()),
+    ):
+        raise exceptions.BadRequest(
+            3000,
+            'Availability error',
+            'The requested number of tickets is not longer available for the given variant and/or timeslot'
+        )
+
+    tickets = barcodes.generate(product, booking_id, variant_quantity_map)
+
+    state.store.restore_booking(booking_id)
+    ledger.record(
+        'booking',
+        booking_id=booking_id,
+        reservation_id=reservation_id,
+        order_reference=order_reference,
+        product_id=product_id,
+        datetime=booking_date.isoformat(),
+        tickets=allocation.quantities,
+    )
+
+    return {
+        'booking_id': booking_id,
+        'barcode_format': product.ticket_content_type,
+        'barcode_scope': 'ticket',
+        'barcode': '',
+        'tickets': tickets,
+    }
+
+
+def booking_body(payload: Dict, api_key: ApiKey, encode: Callable[[Dict], bytes]) -> Tuple[bytes, bool]:
+    """Encoded booking response and whether it replays the response to an earlier try, see `idempotency`."""
+    return idempotency.bookings.get_or_create(
+        idempotency.booking_key(api_key, payload), lambda: encode(booking(payload, api_key)),
+    )
+
+
+def cancel_booking(booking_id: str, api_key: ApiKey):
+    try:
+        booked_for, product_id = utils.decode_booking_data(booking_id)
+    except (ValueError, IndexError, TypeError):
+        raise exceptions.BadRequest(1004, 'Missing booking', f"Booking with ID {booking_id} doesn't exist")
+    product = api_key.product(product_id)
+
+    if not product.is_refundable:
+        raise exceptions.BadRequest(
+            3004,
+            'Cancellation not possible',
+            'The booking cannot be cancelled, the product does not allow cancellations',
+        )
+
+    if product.tickets_already_used:
+        raise exceptions.BadRequest(
+            3005,
+            'Tickets already used',
+            'The booking cannot be cancelled because tickets have already been used',
+        )
+
+    booking_for_time = datetime.fromisoformat(booked_for).replace(tzinfo=timezone.utc)
+    cancellation_time = datetime.now(timezone.utc)
+    if booking_for_time < cancellation_time:
+        raise exceptions.BadRequest(2009, 'Incorrect date', 'Cannot use the past date')
+
+    difference = booking_for_time - cancellation_time
+    hours_in_advance = round(difference.total_seconds()/3600)
+    if product.cutoff_time != 0 and product.cutoff_time > hours_in_advance:
+        raise exceptions.BadRequest(
+            2009, 'Incorrect date', f'The booking can only be cancelled {product.cutoff_time} hours in advance'
+        )
+
+    # if we want to test double cancellation, we need to store the cancelled booking id somewhere
+    if not state.store.cancel_booking(booking_id):
+        raise exceptions.BadRequest(
+            3003, 'Already cancelled', f'The booking with ID {booking_id} was already cancelled'
+        )
+    inventory.cancel(booking_id)
+    ledger.record('cancellation', booking_id=booking_id)
+
+
+def update_state_metrics():
+    """Refresh the gauges of the state kept in this process."""
+    metrics.RESERVATION_HOLDS.set(inventory.holds_count())
+    if isinstance(state.store, state.MemoryStateStore):
+        metrics.CANCELLED_BOOKINGS.set(state.store.cancelled_count())
+
+
+if not isinstance(state.store, state.MemoryStateStore):
+    # a shared store gives every process the same count, it is read when the metrics are served
+    metrics.CANCELLED_BOOKINGS.collect = lambda: state.store.cancelled_count()
+
+
+def restore(recovered: ledger.LedgerState):
+    """
+    Restore the cancelled bookings and the inventory recovered from the ledger, every booking of a timeslot holds its
+    own tickets again.
+    """
+    for booking_id in recovered.cancelled:
+        state.store.cancel_booking(booking_id)
+
+    def allocation_of(event: Dict) -> Tuple[Allocation, Dict[str, int]]:
+        product = registry.require(event['product_id'])
+        moment = datetime.fromisoformat(event['datetime'])
+        allocation = Allocation(
+            product.id, moment.date(), availability_engine.timeslot_key(product, moment), event['tickets'],
+        )
+        return allocation, availability_engine.capacity(product, moment.date())
+
+    for event in recovered.reservations.values():
+        inventory.reserve(event['reservation_id'], *allocation_of(event), event['expires_at'])
+    for event in recovered.bookings.values():
+        if event['booking_id'] not in recovered.cancelled:
+            inventory.book(event['reservation_id'], event['booking_id'], *allocation_of(event))
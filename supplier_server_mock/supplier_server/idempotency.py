@@ -0,0 +1,66 @@
+"""
+Replay of booking responses to retried requests.
+
+A booking is identified by the API key, the `order_reference` and the `reservation_id`. The encoded body of its
+successful response is kept in a bounded TTL cache, so a client retrying after a timeout gets the same bytes back
+without the booking being handled again: no inventory, barcode or ledger work, and the `Idempotent-Replayed: true`
+header. Failed bookings aren't cached, their retry is handled like a new request.
+
+Concurrent requests for the same booking wait for the first one and replay its response. The cache is per worker
+process, a retry reaching another worker process is handled again (the inventory and barcodes are idempotent per
+reservation, so the booking isn't duplicated).
+"""
+from threading import Lock
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from .cache import TTLCache
+from .constants import BOOKING_CACHE_SIZE, BOOKING_CACHE_TTL
+from .keys import ApiKey
+
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+BookingKey = Tuple[bytes, str, str]
+
+
+class ResponseCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.cache = TTLCache(max_size, ttl)
+        # lock and number of requests using it per key being created
+        self._locks: Dict[Hashable, List] = {}
+        self._locks_lock = Lock()
+
+    def get_or_create(self, key: Optional[Hashable], create: Callable[[], bytes]) -> Tuple[bytes, bool]:
+        """The cached body of `key` or else the body made by `create`, and whether it was replayed."""
+        if key is None:
+            return create(), False
+        body = self.cache.get(key)
+        if body is not None:
+            return body, True
+        with self._locks_lock:
+            entry = self._locks.setdefault(key, [Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                body = self.cache.get(key)
+                if body is not None:
+                    return body, True
+                body = create()
+                self.cache.set(key, body)
+                return body, False
+        finally:
+            with self._locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+def booking_key(api_key: ApiKey, payload: Dict) -> Optional[BookingKey]:
+    """Key of a booking request, None when it misses the fields (the request fails then)."""
+    order_reference = payload.get('order_reference')
+    reservation_id = payload.get('reservation_id')
+    if not isinstance(order_reference, str) or not isinstance(reservation_id, str):
+        return None
+    return api_key.digest, order_reference, reservation_id
+
+
+bookings = ResponseCache(BOOKING_CACHE_SIZE, BOOKING_CACHE_TTL)
@@ -0,0 +1,144 @@
+"""
+Compact signed reservation and booking IDs.
+
+An ID is URL-safe base64 (without padding) of a struct-packed binary layout followed by a 64-bit MAC, keyed BLAKE2b
+(BLAKE2's built-in MAC mode, a faster equivalent of HMAC):
+
+    reservation: version, kind, nonce, expires at, booked for, product index, (variant index, quantity) pairs, MAC
+    booking:     version, kind, nonce, booked for, product index, MAC
+
+Times are epoch seconds, `booked for` is the local time of the timeslot stored as if it was UTC. The MAC covers the
+catalog version as well, so an ID can't be forged and an ID of another catalog is rejected instead of pointing to
+another product.
+
+The random 64-bit nonce makes identical reservations made in the same second distinct. The nonce of a booking is
+derived from its reservation ID, so every reservation gets its own booking ID and booking it again gives the same one.
+
+The first byte of the binary layout is the version, so new IDs start with `A`. IDs of the previous format are
+base64 JSON arrays, which start with `W`, and are still decoded by `utils`.
+"""
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import hashlib
+import hmac
+import random
+import struct
+from typing import Dict, List, Tuple
+
+from . import availability
+from .constants import ID_SECRET
+from .registry import registry
+
+VERSION = 1
+RESERVATION = 1
+BOOKING = 2
+
+HEADER = struct.Struct('<BB')
+# header and fields
+RESERVATION_FIELDS = struct.Struct('<BBQIIIB')
+BOOKING_FIELDS = struct.Struct('<BBQII')
+TICKETS = struct.Struct('<BH')
+MAC_SIZE = 8
+# largest quantity of a variant in a reservation
+MAX_QUANTITY = 0xFFFF
+
+EPOCH = datetime(1970, 1, 1)
+
+_key = hashlib.blake2b(f'{ID_SECRET}\x1f{registry.version}'.encode()).digest()
+
+
+def _mac(data: bytes) -> bytes:
+    return hashlib.blake2b(data, key=_key, digest_size=MAC_SIZE).digest()
+
+
+def _pack(data: bytes) -> str:
+    return urlsafe_b64encode(data + _mac(data)).rstrip(b'=').decode()
+
+
+def _unpack(value: str, kind: int) -> bytes:
+    """Verified binary layout of an ID, raises ValueError for anything that isn't a valid ID of `kind`."""
+    raw = urlsafe_b64decode(value + '=' * (-len(value) % 4))
+    data, mac = raw[:-MAC_SIZE], raw[-MAC_SIZE:]
+    if len(data) < HEADER.size or not hmac.compare_digest(mac, _mac(data)):
+        raise ValueError('Invalid ID signature')
+    version, id_kind = HEADER.unpack_from(data)
+    if version != VERSION or id_kind != kind:
+        raise ValueError(f'Unsupported ID version {version} or kind {id_kind}')
+    return data
+
+
+def _naive_seconds(moment: datetime) -> int:
+    return int(moment.replace(tzinfo=timezone.utc).timestamp())
+
+
+def _naive_datetime(seconds: int) -> datetime:
+    return EPOCH + timedelta(seconds=seconds)
+
+
+@lru_cache(maxsize=4096)
+def _variant_ids(product_index: int) -> List[str]:
+    return [variant_id for variant_id, _, _ in availability.get_layout(registry.products[product_index]).variants]
+
+
+def encode_reservation_id(
+    expires_at: datetime, variants_quantity_map: Dict[str, int], product_id: str, booking_date: datetime,
+) -> str:
+    product_index = registry.require(product_id).index
+    variant_ids = _variant_ids(product_index)
+    data = RESERVATION_FIELDS.pack(
+        VERSION,
+        RESERVATION,
+        random.getrandbits(64),
+        int(expires_at.timestamp()),
+        _naive_seconds(booking_date),
+        product_index,
+        len(variants_quantity_map),
+    )
+    for variant_id, quantity in variants_quantity_map.items():
+        if not 0 <= quantity <= MAX_QUANTITY:
+            raise ValueError(f'Quantity {quantity} of variant {variant_id} is out of range')
+        data += TICKETS.pack(variant_ids.index(str(variant_id)), quantity)
+    return _pack(data)
+
+
+def decode_reservation_id(reservation_id: str) -> Tuple[datetime, Dict[str, int], str, datetime]:
+    """Expiry (UTC), quantity per variant id, product id and booked time of a reservation ID."""
+    data = _unpack(reservation_id, RESERVATION)
+    _, _, _, expires_at, booked_for, product_index, count = RESERVATION_FIELDS.unpack_from(data)
+    product_id = registry.products[product_index].id
+    variant_ids = _variant_ids(product_index)
+    offset = RESERVATION_FIELDS.size
+    if len(data) != offset + count * TICKETS.size:
+        raise ValueError('Invalid reservation ID length')
+    variants_quantity_map = {
+        variant_ids[variant_index]: quantity
+        for variant_index, quantity in TICKETS.iter_unpack(data[offset:])
+    }
+    expires_at_utc = datetime.fromtimestamp(expires_at, timezone.utc)
+    return expires_at_utc, variants_quantity_map, product_id, _naive_datetime(booked_for)
+
+
+def _booking_nonce(reservation_id: str) -> int:
+    return int.from_bytes(hashlib.blake2b(reservation_id.encode(), key=_key, digest_size=8).digest(), 'little')
+
+
+def encode_booking_id(booking_date: datetime, product_id: str, reservation_id: str) -> str:
+    product_index = registry.require(product_id).index
+    return _pack(BOOKING_FIELDS.pack(
+        VERSION, BOOKING, _booking_nonce(reservation_id), _naive_seconds(booking_date), product_index,
+    ))
+
+
+def decode_booking_id(booking_id: str) -> Tuple[datetime, str]:
+    """Booked time and product id of a booking ID."""
+    data = _unpack(booking_id, BOOKING)
+    if len(data) != BOOKING_FIELDS.size:
+        raise ValueError('Invalid booking ID length')
+    _, _, _, booked_for, product_index = BOOKING_FIELDS.unpack_from(data)
+    return _naive_datetime(booked_for), registry.products[product_index].id
+
+
+def is_legacy(value: str) -> bool:
+    """IDs of the previous format are base64 JSON arrays."""
+    return value.startswith('W')
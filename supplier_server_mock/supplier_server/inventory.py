@@ -0,0 +1,171 @@
+"""
+Inventory engine: reservations hold tickets until they are booked or expire, bookings keep them until cancelled.
+
+The generated availability is the capacity of a timeslot. The engine only tracks the tickets taken from it per
+(product, day), so the availability of untouched days costs nothing. Holds are released in expiry order from a
+min-heap, each release costs O(log n) whatever the number of open holds.
+
+The inventory lives in the worker process, run a single worker process for exact sold-out behaviour.
+"""
+from collections import defaultdict
+from dataclasses import dataclass
+from datetime import date
+import heapq
+from threading import Lock
+import time
+from typing import Callable, DefaultDict, Dict, List, Optional, Tuple
+
+# (product id, day)
+DayKey = Tuple[str, date]
+# (timeslot key `YYYY-MM-DDTHH:MM`, variant id)
+CellKey = Tuple[str, str]
+
+
+@dataclass
+class Allocation:
+    product_id: str
+    day: date
+    timeslot: str
+    quantities: Dict[str, int]
+
+
+class Inventory:
+    def __init__(self):
+        self._lock = Lock()
+        # tickets held or sold per day and (timeslot, variant)
+        self._taken: Dict[DayKey, DefaultDict[CellKey, int]] = {}
+        # reservation id -> (expires at, allocation)
+        self._holds: Dict[str, Tuple[float, Allocation]] = {}
+        self._expiry_heap: List[Tuple[float, str]] = []
+        # reservation id -> booking id
+        self._confirmed: Dict[str, str] = {}
+        # booking id -> (reservation id, allocation)
+        self._sold: Dict[str, Tuple[str, Allocation]] = {}
+        self._listeners: List[Callable[[Allocation], None]] = []
+        # product id -> number of changes to its taken tickets
+        self._versions: DefaultDict[str, int] = defaultdict(int)
+
+    def subscribe(self, listener: Callable[[Allocation], None]):
+        """Call `listener` with the allocation whenever tickets are taken or given back."""
+        self._listeners.append(listener)
+
+    def _notify(self, allocations: List[Allocation]):
+        for allocation in allocations:
+            for listener in self._listeners:
+                listener(allocation)
+
+    def _take(self, allocation: Allocation, sign: int = 1):
+        self._versions[allocation.product_id] += 1
+        day_key = (allocation.product_id, allocation.day)
+        taken = self._taken.get(day_key)
+        if taken is None:
+            taken = self._taken[day_key] = defaultdict(int)
+        for variant_id, quantity in allocation.quantities.items():
+            taken[(allocation.timeslot, variant_id)] += sign * quantity
+        if not any(taken.values()):
+            del self._taken[day_key]
+
+    def _fits(self, allocation: Allocation, capacity: Dict[str, int]) -> bool:
+        taken = self._taken.get((allocation.product_id, allocation.day), {})
+        return all(
+            quantity <= capacity.get(variant_id, 0) - taken.get((allocation.timeslot, variant_id), 0)
+            for variant_id, quantity in allocation.quantities.items()
+        )
+
+    def _release_expired(self, now: float) -> List[Allocation]:
+        released = []
+        heap = self._expiry_heap
+        while heap and heap[0][0] <= now:
+            _, reservation_id = heapq.heappop(heap)
+            hold = self._holds.pop(reservation_id, None)
+            if hold is not None:  # holds converted to bookings are skipped
+                self._take(hold[1], -1)
+                released.append(hold[1])
+        return released
+
+    def release_expired(self):
+        if not self._expiry_heap or self._expiry_heap[0][0] > time.time():
+            return
+        with self._lock:
+            released = self._release_expired(time.time())
+        self._notify(released)
+
+    def reserve(
+        self, reservation_id: str, allocation: Allocation, capacity: Dict[str, int], expires_at: float,
+    ) -> bool:
+        """Hold the tickets of `allocation` until `expires_at`, returns False when they are no longer available."""
+        with self._lock:
+            released = self._release_expired(time.time())
+            reserved = self._fits(allocation, capacity)
+            if reserved:
+                self._take(allocation)
+                self._holds[reservation_id] = (expires_at, allocation)
+                heapq.heappush(self._expiry_heap, (expires_at, reservation_id))
+        self._notify(released + [allocation] if reserved else released)
+        return reserved
+
+    def book(self, reservation_id: str, booking_id: str, allocation: Allocation, capacity: Dict[str, int]) -> bool:
+        """
+        Convert the hold of a reservation into a booking.
+
+        A reservation without hold (made before a restart or by another worker process) takes the tickets directly,
+        returns False when they are no longer available. Booking a reservation again is a no-op.
+        """
+        with self._lock:
+            released = self._release_expired(time.time())
+            booked = True
+            if self._confirmed.get(reservation_id) == booking_id:
+                allocation = None
+            else:
+                hold = self._holds.pop(reservation_id, None)
+                if hold is not None:
+                    allocation = hold[1]
+                elif self._fits(allocation, capacity):
+                    self._take(allocation)
+                else:
+                    booked = False
+                if booked:
+                    self._confirmed[reservation_id] = booking_id
+                    self._sold[booking_id] = (reservation_id, allocation)
+        self._notify(released + [allocation] if booked and allocation is not None else released)
+        return booked
+
+    def cancel(self, booking_id: str):
+        """Give the tickets of a booking back."""
+        with self._lock:
+            sold = self._sold.pop(booking_id, None)
+            if sold is None:
+                return
+            reservation_id, allocation = sold
+            del self._confirmed[reservation_id]
+            self._take(allocation, -1)
+        self._notify([allocation])
+
+    def adjust(self, allocation: Allocation, capacity: Dict[str, int]) -> bool:
+        """
+        Take tickets outside of the API, e.g. sold at the venue, or give them back with negative quantities. Returns
+        False when the tickets are no longer available.
+        """
+        with self._lock:
+            released = self._release_expired(time.time())
+            adjusted = self._fits(allocation, capacity)
+            if adjusted:
+                self._take(allocation)
+        self._notify(released + [allocation] if adjusted else released)
+        return adjusted
+
+    def taken(self, product_id: str, day: date) -> Optional[Dict[CellKey, int]]:
+        """Tickets held or sold per (timeslot, variant) of a day, None when nothing was taken."""
+        with self._lock:
+            taken = self._taken.get((product_id, day))
+            return dict(taken) if taken else None
+
+    def version(self, product_id: str) -> int:
+        """Changes so far to the tickets taken from a product in this process, 0 when it was never touched."""
+        return self._versions.get(product_id, 0)
+
+    def holds_count(self) -> int:
+        return len(self._holds)
+
+
+inventory = Inventory()
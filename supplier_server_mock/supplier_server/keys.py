@@ -0,0 +1,180 @@
+"""
+API keys of the simulated integrations, with per-key rate limits and concurrency quotas.
+
+Keys are loaded from the JSON file set in `SUPPLIER_SERVER_API_KEYS`:
+
+    {
+        "keys": {
+            "secret": {"tenant": "default"},
+            "acme-load-test": {
+                "tenant": "acme",
+                "scenario": "flaky-booking",
+                "catalog": ["A300-FX", "A400-FX"],
+                "rate_limit": {"rate": 50, "burst": 100},
+                "max_concurrent": 8
+            }
+        }
+    }
+
+- `tenant`: name reported in the metrics, defaults to the key itself
+- `scenario`: fault profile (see `faults`) of the key's requests that don't name one in `X-Mock-Fault-Profile`
+- `catalog`: ids of the products the key sees, the others are answered as missing; all of them by default
+- `rate_limit`: token bucket of `rate` requests per second and up to `burst` requests at once
+- `max_concurrent`: requests of the key handled at the same time
+
+Requests over a limit are answered with `429 Too Many Requests` and `Retry-After`. The limits apply per worker
+process. Without a file the only key is `secret`, without limits.
+
+A presented key is looked up by its SHA-256 digest and the digests are compared in constant time, so the time to
+reject a key doesn't tell how much of it was right.
+"""
+import hashlib
+import hmac
+import json
+import math
+from threading import Lock
+import time
+from typing import Dict, FrozenSet, List, Optional
+
+from . import faults, metrics
+from .constants import API_KEYS
+from .registry import CompiledProduct, registry
+
+DEFAULT_KEYS = {'keys': {'secret': {'tenant': 'default'}}}
+# Retry-After of a request over the concurrency quota
+CONCURRENCY_RETRY_AFTER = 1.0
+
+
+def _digest(api_key: str) -> bytes:
+    return hashlib.sha256(api_key.encode()).digest()
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        if rate <= 0 or burst < 1:
+            raise ValueError('rate_limit needs a positive rate and a burst of at least 1')
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def take(self) -> float:
+        """Take a token, returns 0 when there was one or else the seconds until there is one."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+
+class ApiKey:
+    def __init__(
+        self,
+        digest: bytes,
+        tenant: str,
+        scenario: Optional[str] = None,
+        catalog: Optional[FrozenSet[str]] = None,
+        rate_limit: Optional[TokenBucket] = None,
+        max_concurrent: Optional[int] = None,
+    ):
+        self.digest = digest
+        self.tenant = tenant
+        self.scenario = scenario
+        self.catalog = catalog
+        self.rate_limit = rate_limit
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self._lock = Lock()
+        if catalog is None:
+            self.products: List[Dict] = registry.public
+            self.catalog_version = ''
+        else:
+            self.products = [product.public for product in registry.products if product.id in catalog]
+            self.catalog_version = hashlib.blake2b(','.join(sorted(catalog)).encode(), digest_size=8).hexdigest()
+
+    @classmethod
+    def from_json(cls, api_key: str, data: Dict) -> 'ApiKey':
+        scenario = data.get('scenario')
+        if scenario is not None and (faults.injector is None or scenario not in faults.injector.profiles):
+            raise ValueError(f'API key {api_key!r} uses the unknown fault profile {scenario!r}')
+        catalog = data.get('catalog')
+        if catalog is not None:
+            unknown = [product_id for product_id in catalog if product_id not in registry]
+            if unknown:
+                raise ValueError(f'API key {api_key!r} lists unknown products: {", ".join(unknown)}')
+            catalog = frozenset(catalog)
+        rate_limit = data.get('rate_limit')
+        max_concurrent = data.get('max_concurrent')
+        if max_concurrent is not None and max_concurrent < 1:
+            raise ValueError(f'API key {api_key!r} needs a max_concurrent of at least 1')
+        return cls(
+            _digest(api_key),
+            data.get('tenant', api_key),
+            scenario,
+            catalog,
+            TokenBucket(rate_limit['rate'], rate_limit.get('burst', rate_limit['rate'])) if rate_limit else None,
+            max_concurrent,
+        )
+
+    def product(self, product_id: str) -> CompiledProduct:
+        """Product of the key's catalog, raises `BadRequest` like a missing product for the others."""
+        return registry.require(product_id, self.catalog)
+
+    def acquire(self) -> Optional[float]:
+        """Admit a request, returns None when it may go ahead or else the seconds to wait before retrying."""
+        with self._lock:
+            if self.max_concurrent is not None and self.in_flight >= self.max_concurrent:
+                metrics.RATE_LIMITED.inc(tenant=self.tenant, limit='concurrency')
+                return CONCURRENCY_RETRY_AFTER
+            if self.rate_limit is not None:
+                wait = self.rate_limit.take()
+                if wait:
+                    metrics.RATE_LIMITED.inc(tenant=self.tenant, limit='rate')
+                    return wait
+            self.in_flight += 1
+        return None
+
+    def release(self):
+        """End a request admitted by `acquire`."""
+        with self._lock:
+            self.in_flight -= 1
+
+
+def retry_after(seconds: float) -> str:
+    """Value of the `Retry-After` header, whole seconds rounded up."""
+    return str(max(1, math.ceil(seconds)))
+
+
+class KeyRegistry:
+    def __init__(self, keys: List[ApiKey]):
+        self._by_digest: Dict[bytes, ApiKey] = {key.digest: key for key in keys}
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'KeyRegistry':
+        return cls([ApiKey.from_json(api_key, key_data) for api_key, key_data in data.get('keys', {}).items()])
+
+    @classmethod
+    def load(cls, path: str) -> 'KeyRegistry':
+        with open(path) as f:
+            return cls.from_json(json.load(f))
+
+    def lookup(self, api_key: Optional[str]) -> Optional[ApiKey]:
+        """The registered key, None when `api_key` is missing or unknown."""
+        if not api_key:
+            return None
+        digest = _digest(api_key)
+        key = self._by_digest.get(digest)
+        if key is None or not hmac.compare_digest(key.digest, digest):
+            return None
+        return key
+
+
+key_registry = KeyRegistry.load(API_KEYS) if API_KEYS else KeyRegistry.from_json(DEFAULT_KEYS)
+
+
+def lookup(api_key: Optional[str]) -> Optional[ApiKey]:
+    return key_registry.lookup(api_key)
@@ -0,0 +1,178 @@
+"""
+Durable append-only ledger of reservation, booking and cancellation events.
+
+Events are appended as JSON lines to `events.log` by a background writer thread, so request handlers only put them on
+a queue. The writer commits everything that queued up in one write and one fsync (group commit). When the log grows
+over `compact_bytes`, it is folded into `snapshot.json` and truncated, so a restart only replays the snapshot and a
+short log.
+
+Worker processes share the directory: appends and compactions are serialized with an exclusive lock on `ledger.lock`.
+Applying an event is idempotent, so replaying a log that was already folded into the snapshot (after a crash between
+writing the snapshot and truncating the log) gives the same state.
+"""
+from dataclasses import dataclass, field
+import atexit
+import fcntl
+import json
+import os
+from queue import Empty, Queue
+from threading import Thread
+import time
+from typing import Dict, Iterable, List, Optional, Set
+
+from .constants import LEDGER_COMPACT_BYTES
+
+LOG = 'events.log'
+SNAPSHOT = 'snapshot.json'
+LOCK = 'ledger.lock'
+
+
+@dataclass
+class LedgerState:
+    # reservation id -> reservation event
+    reservations: Dict[str, Dict] = field(default_factory=dict)
+    # booking id -> booking event, every reservation is booked under an ID of its own (see `ids`)
+    bookings: Dict[str, Dict] = field(default_factory=dict)
+    cancelled: Set[str] = field(default_factory=set)
+
+    def apply(self, event: Dict):
+        event_type = event['type']
+        if event_type == 'reservation':
+            self.reservations[event['reservation_id']] = event
+        elif event_type == 'booking':
+            self.reservations.pop(event['reservation_id'], None)
+            self.bookings[event['booking_id']] = event
+            self.cancelled.discard(event['booking_id'])
+        elif event_type == 'cancellation':
+            self.cancelled.add(event['booking_id'])
+
+    def drop_expired(self, now: float):
+        self.reservations = {k: v for k, v in self.reservations.items() if v['expires_at'] > now}
+
+    def to_json(self) -> Dict:
+        return {
+            'reservations': list(self.reservations.values()),
+            'bookings': list(self.bookings.values()),
+            'cancelled': sorted(self.cancelled),
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict) -> 'LedgerState':
+        return cls(
+            reservations={e['reservation_id']: e for e in data['reservations']},
+            bookings={e['booking_id']: e for e in data['bookings']},
+            cancelled=set(data['cancelled']),
+        )
+
+
+class Ledger:
+    def __init__(self, directory: str, compact_bytes: int = LEDGER_COMPACT_BYTES, max_batch: int = 1000):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.compact_bytes = compact_bytes
+        self.max_batch = max_batch
+        self._queue: 'Queue[Optional[Dict]]' = Queue()
+        self._log = open(os.path.join(directory, LOG), 'ab')
+        self._lock_file = open(os.path.join(directory, LOCK), 'w')
+        self._thread: Optional[Thread] = None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='ledger-writer', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Commit the queued events and stop the writer."""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._log.close()
+        self._lock_file.close()
+
+    def append(self, event_type: str, **data):
+        self._queue.put({'type': event_type, 'at': time.time(), **data})
+
+    def _run(self):
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            if None in batch:
+                running = False
+                batch = [event for event in batch if event is not None]
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, events: List[Dict]):
+        data = b''.join(json.dumps(event, separators=(',', ':')).encode() + b'\n' for event in events)
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            self._log.write(data)
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            if os.fstat(self._log.fileno()).st_size >= self.compact_bytes:
+                self._compact()
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _read_events(self) -> Iterable[Dict]:
+        with open(os.path.join(self.directory, LOG), 'rb') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:  # a line torn by a crash during a write
+                    continue
+
+    def _replay(self) -> LedgerState:
+        try:
+            with open(os.path.join(self.directory, SNAPSHOT)) as f:
+                state = LedgerState.from_json(json.load(f))
+        except FileNotFoundError:
+            state = LedgerState()
+        for event in self._read_events():
+            state.apply(event)
+        return state
+
+    def _compact(self) -> LedgerState:
+        state = self._replay()
+        state.drop_expired(time.time())
+        snapshot_path = os.path.join(self.directory, SNAPSHOT)
+        tmp_path = f'{snapshot_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state.to_json(), f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, snapshot_path)
+        os.truncate(os.path.join(self.directory, LOG), 0)
+        return state
+
+    def compact(self) -> LedgerState:
+        """Fold the log into the snapshot and return the current state."""
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            return self._compact()
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+
+ledger: Optional[Ledger] = None
+
+
+def record(event_type: str, **data):
+    """Append an event to the ledger, when one is installed."""
+    if ledger is not None:
+        ledger.append(event_type, **data)
+
+
+def install(directory: str) -> LedgerState:
+    """Open the ledger in `directory`, compact it and start the background writer. Returns the recovered state."""
+    global ledger
+    ledger = Ledger(directory)
+    state = ledger.compact()
+    ledger.start()
+    atexit.register(ledger.close)
+    return state
@@ -0,0 +1,347 @@
+"""
+Prometheus metrics of the mock server, served in the text exposition format on `/metrics`.
+
+Worker processes don't share memory, so when `SUPPLIER_SERVER_METRICS_DIR` is set every process keeps its values in
+its own memory-mapped file `<pid>.db` in that directory, and `/metrics` adds up the files of all the processes.
+Counters and histograms of exited processes keep counting, gauges only count live processes. An increment is a write
+into the mapped file, nothing is flushed or sent. Without a directory the values stay in the process, which is only
+correct with a single worker process. `supplier_server_serve` creates a fresh directory when none is set.
+"""
+from bisect import bisect_left
+from functools import lru_cache
+import glob
+import json
+import math
+import mmap
+import os
+import struct
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from .constants import METRICS_DIR
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+GENERATION_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005)
+
+# (sample name, sorted label pairs)
+SampleKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class ValueFile:
+    """
+    Float values by key in a memory-mapped file written by a single process.
+
+    Layout: bytes used (8 bytes), then entries of key length (4 bytes), key padded to 8 bytes and value (double). An
+    entry is written before the used size is updated, so readers never see a partial entry.
+    """
+
+    USED = struct.Struct('<Q')
+    INITIAL_SIZE = 64 * 1024
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'a+b')
+        if os.fstat(self._file.fileno()).st_size < self.INITIAL_SIZE:
+            self._file.truncate(self.INITIAL_SIZE)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._used = self.USED.unpack_from(self._mmap, 0)[0] or self.USED.size
+        self._positions = {key: position for key, _, position in _entries(self._mmap, self._used)}
+
+    def _position(self, key: str) -> int:
+        position = self._positions.get(key)
+        if position is None:
+            encoded = key.encode()
+            padded = len(encoded) + (-(4 + len(encoded)) % 8)
+            entry = struct.pack(f'<I{padded}sd', len(encoded), encoded, 0.0)
+            while self._used + len(entry) > len(self._mmap):
+                self._mmap.close()
+                self._file.truncate(2 * os.fstat(self._file.fileno()).st_size)
+                self._mmap = mmap.mmap(self._file.fileno(), 0)
+            self._mmap[self._used:self._used + len(entry)] = entry
+            position = self._positions[key] = self._used + 4 + padded
+            self._used += len(entry)
+            self.USED.pack_into(self._mmap, 0, self._used)
+        return position
+
+    def add(self, key: str, amount: float):
+        position = self._position(key)
+        struct.pack_into('<d', self._mmap, position, struct.unpack_from('<d', self._mmap, position)[0] + amount)
+
+    def set(self, key: str, value: float):
+        position = self._position(key)
+        struct.pack_into('<d', self._mmap, position, value)
+
+
+class MemoryValues:
+    """Values of a process without a metrics directory."""
+
+    def __init__(self):
+        self.values: Dict[str, float] = {}
+
+    def add(self, key: str, amount: float):
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def set(self, key: str, value: float):
+        self.values[key] = value
+
+
+def _entries(data, used: int) -> Iterator[Tuple[str, float, int]]:
+    """(key, value, value position) of the entries of a value file."""
+    position = ValueFile.USED.size
+    while position < used:
+        length = struct.unpack_from('<I', data, position)[0]
+        padded = length + (-(4 + length) % 8)
+        key = bytes(data[position + 4:position + 4 + length]).decode()
+        value_position = position + 4 + padded
+        yield key, struct.unpack_from('<d', data, value_position)[0], value_position
+        position = value_position + 8
+
+
+def read_file(path: str) -> Iterator[Tuple[str, float]]:
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < ValueFile.USED.size:
+        return
+    used = ValueFile.USED.unpack_from(data, 0)[0]
+    for key, value, _ in _entries(data, used):
+        yield key, value
+
+
+def _is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _Values:
+    """The value store of the current process, a forked child gets its own file."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pid: Optional[int] = None
+        self._store = None
+
+    def store(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._store = ValueFile(os.path.join(METRICS_DIR, f'{pid}.db')) if METRICS_DIR else MemoryValues()
+        return self._store
+
+    def add(self, key: str, amount: float):
+        with self._lock:
+            self.store().add(key, amount)
+
+    def set(self, key: str, value: float):
+        with self._lock:
+            self.store().set(key, value)
+
+
+values = _Values()
+
+
+@lru_cache(maxsize=4096)
+def _encode_key(name: str, labels: Tuple[Tuple[str, str], ...]) -> str:
+    return json.dumps([name, labels])
+
+
+def _key(name: str, labels: Dict[str, str]) -> str:
+    return _encode_key(name, tuple(sorted(labels.items())))
+
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        METRICS.append(self)
+
+    def _labels(self, labels: Dict[str, str]) -> Dict[str, str]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects the labels {", ".join(self.labelnames)}')
+        return {name: str(value) for name, value in labels.items()}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels: str):
+        values.add(_key(f'{self.name}_total', self._labels(labels)), amount)
+
+
+class Gauge(Metric):
+    """
+    Gauge summed over the live processes.
+
+    A gauge with a `collect` function is computed when `/metrics` is served instead, for values every process sees the
+    same way (e.g. a database shared by the processes).
+    """
+
+    type = 'gauge'
+
+    def __init__(self, *args, collect: Optional[Callable[[], float]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.collect = collect
+
+    def set(self, value: float, **labels: str):
+        values.set(_key(self.name, self._labels(labels)), value)
+
+    def inc(self, amount: float = 1, **labels: str):
+        values.add(_key(self.name, self._labels(labels)), amount)
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = LATENCY_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value: float, **labels: str):
+        labels = self._labels(labels)
+        # buckets are stored per bucket and made cumulative when rendered, an observation is three writes
+        bucket = self.buckets[bisect_left(self.buckets, value)]
+        with values._lock:
+            store = values.store()
+            store.add(_key(f'{self.name}_bucket', dict(labels, le=_format_value(bucket))), 1)
+            store.add(_key(f'{self.name}_sum', labels), value)
+            store.add(_key(f'{self.name}_count', labels), 1)
+
+
+METRICS: List[Metric] = []
+
+REQUESTS = Counter(
+    'supplier_server_requests', 'Requests by route, method and status.', ('route', 'method', 'status'),
+)
+REQUEST_DURATION = Histogram(
+    'supplier_server_request_duration_seconds',
+    'Time from receiving a request until its response body was sent.',
+    ('route', 'method'),
+)
+REQUESTS_IN_FLIGHT = Gauge('supplier_server_requests_in_flight', 'Requests being handled.')
+REQUEST_SIZE = Histogram(
+    'supplier_server_request_size_bytes', 'Size of the request bodies.', ('route',), buckets=SIZE_BUCKETS,
+)
+RESPONSE_SIZE = Histogram(
+    'supplier_server_response_size_bytes', 'Size of the response bodies as sent.', ('route',), buckets=SIZE_BUCKETS,
+)
+AVAILABILITY_GENERATION = Histogram(
+    'supplier_server_availability_generation_seconds',
+    'Time to generate the availability of a (product, day) missing from the cache.',
+    buckets=GENERATION_BUCKETS,
+)
+RESERVATION_HOLDS = Gauge('supplier_server_reservation_holds', 'Reservations holding tickets.')
+CANCELLED_BOOKINGS = Gauge('supplier_server_cancelled_bookings', 'Bookings in the cancelled state.')
+RATE_LIMITED = Counter(
+    'supplier_server_rate_limited_requests', 'Requests answered with 429 by tenant and limit.', ('tenant', 'limit'),
+)
+SSE_SUBSCRIBERS = Gauge('supplier_server_sse_subscribers', 'Clients subscribed to an availability SSE stream.')
+SSE_SLOW_CONSUMERS = Counter(
+    'supplier_server_sse_slow_consumers', 'SSE subscribers disconnected for falling behind the backlog.',
+)
+
+
+def observe_request(
+    route: str, method: str, status: int, duration: float, request_size: int, response_size: Optional[int],
+):
+    REQUESTS.inc(route=route, method=method, status=str(status))
+    REQUEST_DURATION.observe(duration, route=route, method=method)
+    REQUEST_SIZE.observe(request_size, route=route)
+    if response_size is not None:
+        RESPONSE_SIZE.observe(response_size, route=route)
+
+
+def count_bytes(chunks: Iterable[bytes], sent: List[int]) -> Iterator[bytes]:
+    """Pass `chunks` through, adding their size to `sent[0]`."""
+    for chunk in chunks:
+        sent[0] += len(chunk)
+        yield chunk
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if value == int(value):
+        return f'{int(value)}.0'
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _sample_line(name: str, labels: Iterable[Tuple[str, str]], value: float) -> str:
+    label_text = ','.join(f'{label}="{_escape(label_value)}"' for label, label_value in labels)
+    return f'{name}{{{label_text}}} {_format_value(value)}' if label_text else f'{name} {_format_value(value)}'
+
+
+def collect() -> Dict[SampleKey, float]:
+    """Values of all the processes added up."""
+    gauges = {metric.name for metric in METRICS if metric.type == 'gauge'}
+    if METRICS_DIR:
+        values.store()  # the serving process is listed even before its first observation
+        sources = []
+        for path in glob.glob(os.path.join(METRICS_DIR, '*.db')):
+            pid = os.path.basename(path)[:-len('.db')]
+            sources.append((read_file(path), pid.isdigit() and _is_alive(int(pid))))
+    else:
+        sources = [(values.store().values.items(), True)]
+
+    totals: Dict[SampleKey, float] = {}
+    for samples, alive in sources:
+        for key, value in samples:
+            name, labels = json.loads(key)
+            if name in gauges and not alive:
+                continue
+            sample_key = (name, tuple(tuple(label) for label in labels))
+            totals[sample_key] = totals.get(sample_key, 0.0) + value
+    return totals
+
+
+def render() -> str:
+    """All the metrics in the Prometheus text exposition format."""
+    totals = collect()
+    lines = []
+    for metric in METRICS:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        if isinstance(metric, Gauge) and metric.collect is not None:
+            lines.append(_sample_line(metric.name, (), metric.collect()))
+        elif isinstance(metric, Histogram):
+            lines.extend(_histogram_lines(metric, totals))
+        else:
+            sample_name = f'{metric.name}_total' if metric.type == 'counter' else metric.name
+            for (name, labels), value in sorted(totals.items()):
+                if name == sample_name:
+                    lines.append(_sample_line(name, labels, value))
+    return '\n'.join(lines) + '\n'
+
+
+def _histogram_lines(metric: Histogram, totals: Dict[SampleKey, float]) -> List[str]:
+    lines = []
+    counts = sorted(
+        (labels, value) for (name, labels), value in totals.items() if name == f'{metric.name}_count'
+    )
+    for labels, count in counts:
+        label_dict = dict(labels)
+        cumulative = 0.0
+        for bucket in metric.buckets:
+            le = _format_value(bucket)
+            bucket_labels = tuple(sorted(dict(label_dict, le=le).items()))
+            cumulative += totals.get((f'{metric.name}_bucket', bucket_labels), 0.0)
+            lines.append(_sample_line(f'{metric.name}_bucket', labels + (('le', le),), cumulative))
+        lines.append(_sample_line(f'{metric.name}_sum', labels, totals.get((f'{metric.name}_sum', labels), 0.0)))
+        lines.append(_sample_line(f'{metric.name}_count', labels, count))
+    return lines
@@ -0,0 +1,180 @@
+"""
+On-demand profiling of single requests with cProfile.
+
+Enabled by `SUPPLIER_SERVER_PROFILE_DIR`. A request is profiled when it sends `X-Mock-Profile: 1` with a valid API
+key, or else with the probability set by `SUPPLIER_SERVER_PROFILE_SAMPLE_RATE`. The rate can be changed while the
+server runs with `POST /_admin/profiles {"sample_rate": 0.05}`; it is stored in the profile directory, so every worker
+process picks it up within a second.
+
+Every profiled request is written as a pstats file to `<directory>/<route>/`, only the latest
+`MAX_PROFILES_PER_ROUTE` files of a route are kept. `GET /_admin/profiles` aggregates them into the hottest functions
+per route, `GET /_admin/profiles/<route>` returns them merged into one pstats file for `python -m pstats` or snakeviz.
+
+A process profiles one request at a time, a sampled request arriving meanwhile is not profiled. On the ASGI server the
+profile also contains the other requests the event loop handled in the meantime.
+"""
+import cProfile
+import marshal
+import os
+import pstats
+import random
+import tempfile
+from threading import Lock
+import time
+from typing import Dict, List, Mapping, Optional
+
+from .constants import PROFILE_DIR, PROFILE_SAMPLE_RATE
+
+HEADER = 'X-Mock-Profile'
+MAX_PROFILES_PER_ROUTE = 100
+# seconds between two reads of the sample rate set with the admin endpoint
+RATE_CHECK_INTERVAL = 1.0
+SORT_KEYS = {'cumulative': 'cumulative', 'tottime': 'tottime', 'calls': 'ncalls'}
+RATE_FILE = 'sample_rate'
+# the profiling and metrics endpoints themselves, and the SSE streams that would hold the profiler for their lifetime
+EXCLUDED_ROUTES = frozenset(('profiles', 'route_profile', 'prometheus_metrics', 'availability_stream'))
+
+
+def _validate_rate(rate) -> float:
+    if isinstance(rate, bool) or not isinstance(rate, (int, float)) or not 0 <= rate <= 1:
+        raise ValueError('sample_rate must be a number between 0 and 1')
+    return float(rate)
+
+
+class Profiler:
+    def __init__(self, directory: str, sample_rate: float = 0.0):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._default_rate = _validate_rate(sample_rate)
+        self._rate = self._default_rate
+        self._rate_checked = 0.0
+        self._lock = Lock()
+
+    @property
+    def sample_rate(self) -> float:
+        now = time.monotonic()
+        if now - self._rate_checked >= RATE_CHECK_INTERVAL:
+            self._rate_checked = now
+            try:
+                with open(os.path.join(self.directory, RATE_FILE)) as f:
+                    self._rate = float(f.read())
+            except (OSError, ValueError):
+                self._rate = self._default_rate
+        return self._rate
+
+    def set_sample_rate(self, rate: float):
+        rate = _validate_rate(rate)
+        self._write(os.path.join(self.directory, RATE_FILE), repr(rate).encode())
+        self._rate, self._rate_checked = rate, time.monotonic()
+
+    def start(self, route: str, requested: bool = False) -> Optional[cProfile.Profile]:
+        """Profile of a request to `route` that is profiled, None for the others."""
+        if route in EXCLUDED_ROUTES:
+            return None
+        if not requested:
+            rate = self.sample_rate
+            if not rate or random.random() >= rate:
+                return None
+        if not self._lock.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile: cProfile.Profile, route: str):
+        profile.disable()
+        self._lock.release()
+        profile.create_stats()
+        route_dir = os.path.join(self.directory, route)
+        os.makedirs(route_dir, exist_ok=True)
+        # time first, so the names sort from the oldest to the latest
+        self._write(os.path.join(route_dir, f'{time.time_ns():020d}-{os.getpid()}.prof'), marshal.dumps(profile.stats))
+        for name in self._profiles(route)[:-MAX_PROFILES_PER_ROUTE]:
+            try:
+                os.remove(os.path.join(route_dir, name))
+            except FileNotFoundError:  # removed by another process
+                pass
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        # readers in other processes never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _profiles(self, route: str) -> List[str]:
+        try:
+            return sorted(name for name in os.listdir(os.path.join(self.directory, route)) if name.endswith('.prof'))
+        except FileNotFoundError:
+            return []
+
+    def routes(self) -> List[str]:
+        return sorted(
+            name for name in os.listdir(self.directory) if os.path.isdir(os.path.join(self.directory, name))
+        )
+
+    def stats(self, route: str) -> Optional[pstats.Stats]:
+        """The profiles of `route` merged, None when it has none."""
+        if route not in self.routes():
+            return None
+        merged = None
+        for name in self._profiles(route):
+            try:
+                stats = pstats.Stats(os.path.join(self.directory, route, name))
+            except (FileNotFoundError, EOFError, ValueError):  # pruned meanwhile
+                continue
+            if merged is None:
+                merged = stats
+            else:
+                merged.add(stats)
+        return merged
+
+    def dump(self, route: str) -> Optional[bytes]:
+        """The profiles of `route` merged into one pstats file."""
+        stats = self.stats(route)
+        return marshal.dumps(stats.stats) if stats is not None else None
+
+    def summary(self, args: Mapping[str, str]) -> Dict:
+        """
+        Hottest functions per route, `args` are the query parameters: `route` (default: all), `sort` (`cumulative`,
+        `tottime` or `calls`) and `limit` (functions per route, default 20).
+        """
+        sort = args.get('sort', 'cumulative')
+        if sort not in SORT_KEYS:
+            raise ValueError(f'sort must be one of {", ".join(SORT_KEYS)}')
+        try:
+            limit = int(args.get('limit', 20))
+        except ValueError:
+            raise ValueError('limit must be an integer')
+        summary = {}
+        for route in self.routes():
+            if args.get('route', route) != route:
+                continue
+            stats = self.stats(route)
+            if stats is None:
+                continue
+            stats.sort_stats(SORT_KEYS[sort])
+            summary[route] = {
+                'profiles': len(self._profiles(route)),
+                'total_time': stats.total_tt,
+                'functions': [_function(stats, func) for func in stats.fcn_list[:limit]],
+            }
+        return {'sample_rate': self.sample_rate, 'routes': summary}
+
+
+def _function(stats: pstats.Stats, func) -> Dict:
+    filename, line, name = func
+    primitive_calls, calls, total_time, cumulative_time, _ = stats.stats[func]
+    return {
+        'function': name,
+        'file': filename,
+        'line': line,
+        'calls': calls,
+        'primitive_calls': primitive_calls,
+        'total_time': total_time,
+        'cumulative_time': cumulative_time,
+    }
+
+
+profiler = Profiler(PROFILE_DIR, PROFILE_SAMPLE_RATE) if PROFILE_DIR else None
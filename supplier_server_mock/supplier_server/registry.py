@@ -0,0 +1,145 @@
+from functools import reduce
+import hashlib
+import json
+import sys
+from typing import Dict, FrozenSet, Iterable, List, Optional
+
+from . import catalog
+from .constants import PRODUCTS_CURRENCIES
+from .exceptions import BadRequest
+
+# boolean product attributes indexed by `ProductRegistry.find`
+CAPABILITIES = (
+    'use_timeslots',
+    'provides_pricing',
+    'is_refundable',
+    'timeslot_available_tickets_as_sum',
+    'tickets_already_used',
+)
+
+
+class CompiledProduct:
+    """Read-only view of a catalog product with everything the handlers need precomputed."""
+
+    __slots__ = (
+        'id',
+        'index',
+        'public',
+        'use_timeslots',
+        'provides_pricing',
+        'is_refundable',
+        'cutoff_time',
+        'required_order_data',
+        'required_visitor_data',
+        'ticket_content_type',
+        'timeslot_available_tickets_as_sum',
+        'tickets_already_used',
+        'currency',
+    )
+
+    def __init__(self, index: int, data: Dict):
+        self.id: str = data['id']
+        self.index = index
+        # expose public attributes only
+        self.public: Dict = {sys.intern(k): v for k, v in data.items() if not k.startswith('_')}
+        self.use_timeslots = bool(data['use_timeslots'])
+        self.provides_pricing = bool(data['provides_pricing'])
+        self.is_refundable = bool(data['is_refundable'])
+        self.cutoff_time: int = data['cutoff_time']
+        self.required_order_data: FrozenSet[str] = _shared(frozenset(data.get('required_order_data', ())))
+        self.required_visitor_data: FrozenSet[str] = _shared(frozenset(data.get('required_visitor_data', ())))
+        self.ticket_content_type: str = sys.intern(data['_ticket_content_type'])
+        self.timeslot_available_tickets_as_sum = bool(data.get('_timeslot_available_tickets_as_sum'))
+        self.tickets_already_used = bool(data.get('_tickets_already_used'))
+        self.currency: str = sys.intern(data.get('_currency') or PRODUCTS_CURRENCIES.get(self.id, 'EUR'))
+
+
+# products of large catalogs mostly require the same data, they share one frozenset per distinct set
+_frozensets: Dict[FrozenSet[str], FrozenSet[str]] = {}
+
+
+def _shared(value: FrozenSet[str]) -> FrozenSet[str]:
+    return _frozensets.setdefault(value, value)
+
+
+class ProductRegistry:
+    """
+    Catalog compiled once into an id index and capability indexes.
+
+    Lookups by product id are O(1) and the per-product capability flags and required data sets are computed up
+    front, so request handlers never scan the catalog. Only the public attributes and the compiled fields of a product
+    are kept, the raw catalog entry is dropped.
+    """
+
+    def __init__(self, products: Iterable[Dict]):
+        self.products: List[CompiledProduct] = []
+        self.by_id: Dict[str, CompiledProduct] = {}
+        # capability -> ids of the products that have it
+        self.by_capability: Dict[str, FrozenSet[str]] = {}
+        # ticket content type -> ids of the products using it
+        self.by_ticket_content_type: Dict[str, FrozenSet[str]] = {}
+
+        capabilities: Dict[str, List[str]] = {capability: [] for capability in CAPABILITIES}
+        content_types: Dict[str, List[str]] = {}
+        digest = hashlib.blake2b(digest_size=8)
+        for index, data in enumerate(products):
+            digest.update(json.dumps(data, sort_keys=True, default=str).encode())
+            try:
+                product = CompiledProduct(index, data)
+            except KeyError as e:
+                raise ValueError(f'Product #{index} {data.get("id", "")!r} is missing the {e} field') from None
+            if product.id in self.by_id:
+                raise ValueError(f'Duplicate product ID {product.id!r}')
+            self.products.append(product)
+            self.by_id[product.id] = product
+            for capability, ids in capabilities.items():
+                if getattr(product, capability):
+                    ids.append(product.id)
+            content_types.setdefault(product.ticket_content_type, []).append(product.id)
+        self.by_capability = {capability: frozenset(ids) for capability, ids in capabilities.items()}
+        self.by_ticket_content_type = {content_type: frozenset(ids) for content_type, ids in content_types.items()}
+        self.public: List[Dict] = [p.public for p in self.products]
+        # changes whenever any product of the catalog changes
+        self.version: str = digest.hexdigest()
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def __contains__(self, product_id: str) -> bool:
+        return product_id in self.by_id
+
+    def get(self, product_id: str) -> Optional[CompiledProduct]:
+        return self.by_id.get(product_id)
+
+    def require(self, product_id: str, within: Optional[FrozenSet[str]] = None) -> CompiledProduct:
+        """The product, products missing from the catalog or from `within` raise `BadRequest`."""
+        product = self.by_id.get(product_id)
+        if product is None or (within is not None and product_id not in within):
+            raise BadRequest(1001, 'Missing product', f"Product with ID {product_id} doesn't exist")
+        return product
+
+    def find(self, ticket_content_type: Optional[str] = None, **capabilities: bool) -> List[CompiledProduct]:
+        """Products with the given ticket content type and capability flags, in catalog order."""
+        sets = [self.by_ticket_content_type.get(ticket_content_type, frozenset())] if ticket_content_type else []
+        everything = frozenset(self.by_id)
+        for capability, value in capabilities.items():
+            if capability not in self.by_capability:
+                raise ValueError(f'Unknown capability {capability!r}, expected one of {", ".join(CAPABILITIES)}')
+            ids = self.by_capability[capability]
+            sets.append(ids if value else everything - ids)
+        if not sets:
+            return list(self.products)
+        ids = reduce(frozenset.intersection, sorted(sets, key=len))
+        return sorted((self.by_id[product_id] for product_id in ids), key=lambda p: p.index)
+
+    def stats(self) -> Dict:
+        return {
+            'products': len(self.products),
+            'capabilities': {capability: len(ids) for capability, ids in self.by_capability.items()},
+            'ticket_content_types': {
+                content_type: len(ids) for content_type, ids in self.by_ticket_content_type.items()
+            },
+        }
+
+
+registry = ProductRegistry(catalog.products())
@@ -0,0 +1,71 @@
+"""
+JSON serializer layer of the response path.
+
+`JSONProvider` is Flask's default (standard library) encoder. `OrjsonJSONProvider` encodes with orjson when it is
+installed and produces the same bytes: keys are sorted, output is compact, and anything orjson would encode
+differently (non-ASCII text, non-string keys, dates, dataclasses, big integers) goes through the standard library
+encoder or Flask's `default` function. Floats are not used in the responses and are not covered by that guarantee.
+"""
+from typing import Any
+
+from flask import Flask, Response
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+COMPACT_SEPARATORS = (',', ':')
+
+
+class JSONProvider(DefaultJSONProvider):
+    def dumps_compact(self, obj: Any) -> bytes:
+        return self.dumps(obj, separators=COMPACT_SEPARATORS).encode()
+
+    def _is_compact(self) -> bool:
+        app = self._app
+        if app.config['JSONIFY_PRETTYPRINT_REGULAR'] is not None or app.config['JSONIFY_MIMETYPE'] is not None:
+            # deprecated settings, let Flask handle them
+            return False
+        return self.compact is True or (self.compact is None and not app.debug)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        if not self._is_compact():
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_compact(obj) + b'\n', mimetype=self.mimetype)
+
+
+class OrjsonJSONProvider(JSONProvider):
+    def _orjson_options(self) -> int:
+        options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return options
+
+    def dumps_compact(self, obj: Any) -> bytes:
+        try:
+            data = orjson.dumps(obj, default=self.default, option=self._orjson_options())
+        except TypeError:  # orjson.JSONEncodeError, e.g. non-string keys or integers over 64 bits
+            return super().dumps_compact(obj)
+        if self.ensure_ascii and not data.isascii():
+            return super().dumps_compact(obj)
+        return data
+
+
+PROVIDERS = {
+    'stdlib': JSONProvider,
+    'orjson': OrjsonJSONProvider,
+}
+
+
+def install(app: Flask, name: str = 'auto'):
+    """Select the JSON provider of `app`: `orjson`, `stdlib` or `auto` (orjson when it is installed)."""
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name not in PROVIDERS:
+        raise ValueError(f'Unknown JSON serializer {name!r}, expected one of auto, {", ".join(PROVIDERS)}')
+    if name == 'orjson' and orjson is None:
+        raise ValueError('The orjson JSON serializer was selected but orjson is not installed')
+    app.json = PROVIDERS[name](app)
@@ -0,0 +1,93 @@
+"""
+Production entry point: runs the mock server in uWSGI with a pre-forked pool of worker processes, or with `--asgi`
+the ASGI application in uvicorn.
+
+Unknown arguments are passed to the server unchanged, e.g. `supplier_server_serve --workers 8 --harakiri 30`.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from typing import List, Optional
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description='Run the Supplier API mock server with uWSGI or uvicorn.')
+    parser.add_argument('--asgi', action='store_true', help='serve the ASGI application with uvicorn')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker processes (default: CPUs)')
+    parser.add_argument(
+        '--threads', type=int, default=1, help='threads per worker process, uWSGI only (default: 1)',
+    )
+    parser.add_argument('--bind', default='0.0.0.0:8000', help='address to listen on (default: 0.0.0.0:8000)')
+    parser.add_argument('--unix-socket', help='listen on this Unix socket instead of --bind')
+    parser.add_argument('--backlog', type=int, default=1024, help='listen queue size (default: 1024)')
+    parser.add_argument(
+        '--keep-alive',
+        type=int,
+        default=5,
+        help='seconds an idle HTTP/1.1 keep-alive connection is kept open, 0 disables keep-alive (default: 5)',
+    )
+    return parser.parse_known_args(argv)
+
+
+def uwsgi_command(args, extra_args: List[str]) -> List[str]:
+    command = [
+        'uwsgi',
+        '--module', 'supplier_server.app:app',
+        '--master',
+        # every worker loads the app itself, so per-process state and threads are not shared by fork
+        '--lazy-apps',
+        '--need-app',
+        '--die-on-term',
+        '--vacuum',
+        '--processes', str(args.workers),
+        '--threads', str(args.threads),
+        # threads started by the application, like the ledger writer, don't run without it
+        '--enable-threads',
+        '--listen', str(args.backlog),
+    ]
+    socket = args.unix_socket or args.bind
+    if args.keep_alive > 0:
+        command += ['--http11-socket', socket, '--so-keepalive', '--socket-timeout', str(args.keep_alive)]
+    else:
+        command += ['--http-socket', socket]
+    if args.unix_socket:
+        command += ['--chmod-socket', '660']
+    return command + extra_args
+
+
+def uvicorn_command(args, extra_args: List[str]) -> List[str]:
+    command = [
+        'uvicorn', 'supplier_server.asgi:app',
+        '--workers', str(args.workers),
+        '--backlog', str(args.backlog),
+        '--timeout-keep-alive', str(args.keep_alive),
+        '--no-access-log',
+    ]
+    if args.unix_socket:
+        command += ['--uds', args.unix_socket]
+    else:
+        host, _, port = args.bind.rpartition(':')
+        command += ['--host', host or '0.0.0.0', '--port', port]
+    return command + extra_args
+
+
+def main(argv: Optional[List[str]] = None):
+    args, extra_args = parse_args(argv)
+    if args.asgi:
+        command = uvicorn_command(args, extra_args)
+        missing = 'uvicorn is not installed, install it with "pip install uvicorn"'
+    else:
+        command = uwsgi_command(args, extra_args)
+        missing = 'uWSGI is not installed, install it with "pip install uWSGI"'
+    if shutil.which(command[0]) is None:
+        sys.exit(missing)
+    # the worker processes write their metrics and profiles to these directories, see `metrics` and `profiling`
+    os.environ.setdefault('SUPPLIER_SERVER_METRICS_DIR', tempfile.mkdtemp(prefix='supplier-server-metrics-'))
+    os.environ.setdefault('SUPPLIER_SERVER_PROFILE_DIR', tempfile.mkdtemp(prefix='supplier-server-profiles-'))
+    os.execvp(command[0], command)
+
+
+if __name__ == '__main__':
+    main()
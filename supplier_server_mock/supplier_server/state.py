@@ -0,0 +1,154 @@
+"""
+Booking state shared by the request handlers.
+
+`MemoryStateStore` keeps the state in the worker process. `SQLiteStateStore` keeps it in a SQLite database in WAL
+mode, so every worker process (and every thread) sees the same state.
+"""
+from abc import ABC, abstractmethod
+import random
+import sqlite3
+from threading import Lock, local
+from typing import Dict, List, Set
+
+from .constants import STATE_STORE
+
+# the serials of the in-memory store start at a random multiple of 2 ** 40, so worker processes don't share them
+SERIAL_COUNTER_BITS = 40
+SERIAL_PREFIX_BITS = 23
+
+
+def _check_count(count: int):
+    if not isinstance(count, int) or count <= 0:
+        raise ValueError(f'Serials are allocated in positive counts, got {count!r}')
+
+
+class StateStore(ABC):
+    @abstractmethod
+    def cancel_booking(self, booking_id: str) -> bool:
+        """Atomically mark a booking as cancelled, returns False when it was already cancelled."""
+
+    @abstractmethod
+    def restore_booking(self, booking_id: str):
+        """Forget the cancellation of a booking that was made again."""
+
+    @abstractmethod
+    def cancelled_count(self) -> int:
+        """Number of cancelled bookings."""
+
+    @abstractmethod
+    def allocate_serials(self, key: str, count: int) -> int:
+        """
+        First of `count` consecutive serial numbers that were never given out before, reserved for `key`.
+
+        Allocating for the same key again returns the same range. Raises ValueError when `count` is not positive, the
+        counter only moves forward so serials never repeat.
+        """
+
+
+class MemoryStateStore(StateStore):
+    """Thread-safe in-process store, bookings are spread over striped locks to limit contention."""
+
+    def __init__(self, stripes: int = 64):
+        self._locks: List[Lock] = [Lock() for _ in range(stripes)]
+        self._cancelled: List[Set[str]] = [set() for _ in range(stripes)]
+        self._serials_lock = Lock()
+        self._next_serial = random.getrandbits(SERIAL_PREFIX_BITS) << SERIAL_COUNTER_BITS
+        self._serials: Dict[str, int] = {}
+
+    def _stripe(self, booking_id: str) -> int:
+        return hash(booking_id) % len(self._locks)
+
+    def cancel_booking(self, booking_id: str) -> bool:
+        stripe = self._stripe(booking_id)
+        with self._locks[stripe]:
+            cancelled = self._cancelled[stripe]
+            if booking_id in cancelled:
+                return False
+            cancelled.add(booking_id)
+            return True
+
+    def restore_booking(self, booking_id: str):
+        stripe = self._stripe(booking_id)
+        with self._locks[stripe]:
+            self._cancelled[stripe].discard(booking_id)
+
+    def cancelled_count(self) -> int:
+        return sum(len(cancelled) for cancelled in self._cancelled)
+
+    def allocate_serials(self, key: str, count: int) -> int:
+        _check_count(count)
+        with self._serials_lock:
+            first = self._serials.get(key)
+            if first is None:
+                first = self._serials[key] = self._next_serial
+                self._next_serial += count
+            return first
+
+
+class SQLiteStateStore(StateStore):
+    """Store shared by all worker processes through a SQLite database in WAL mode."""
+
+    def __init__(self, path: str, timeout: float = 30):
+        self.path = path
+        self.timeout = timeout
+        self._local = local()
+        connection = self._connection()
+        connection.execute('CREATE TABLE IF NOT EXISTS cancelled_bookings (booking_id TEXT PRIMARY KEY)')
+        connection.execute('CREATE TABLE IF NOT EXISTS serials (key TEXT PRIMARY KEY, first INTEGER NOT NULL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, every thread opens its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def cancel_booking(self, booking_id: str) -> bool:
+        cursor = self._connection().execute(
+            'INSERT OR IGNORE INTO cancelled_bookings (booking_id) VALUES (?)', (booking_id,)
+        )
+        return cursor.rowcount == 1
+
+    def restore_booking(self, booking_id: str):
+        self._connection().execute('DELETE FROM cancelled_bookings WHERE booking_id = ?', (booking_id,))
+
+    def cancelled_count(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM cancelled_bookings').fetchone()[0]
+
+    def allocate_serials(self, key: str, count: int) -> int:
+        _check_count(count)
+        connection = self._connection()
+        # the write lock is taken up front, so concurrent processes never read the same counter value
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute('SELECT first FROM serials WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                first = row[0]
+            else:
+                row = connection.execute("SELECT value FROM counters WHERE name = 'serial'").fetchone()
+                first = row[0] if row is not None else 0
+                connection.execute(
+                    "INSERT OR REPLACE INTO counters (name, value) VALUES ('serial', ?)", (first + count,)
+                )
+                connection.execute('INSERT INTO serials (key, first) VALUES (?, ?)', (key, first))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return first
+
+
+def create_store(url: str) -> StateStore:
+    """Create the store configured by `url`: `memory` or `sqlite:///path/to/state.db`."""
+    if url == 'memory':
+        return MemoryStateStore()
+    if url.startswith('sqlite:///'):
+        return SQLiteStateStore(url[len('sqlite:///'):])
+    raise ValueError(f'Unknown state store {url!r}, expected "memory" or "sqlite:///<path>"')
+
+
+store = create_store(STATE_STORE)
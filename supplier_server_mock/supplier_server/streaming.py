@@ -0,0 +1,44 @@
+from typing import Any, Callable, Dict, Iterable, Iterator, Tuple
+
+from flask import Response, current_app, stream_with_context
+
+
+def iter_json_object(parts: Iterable[Dict], dumps: Callable[[Any], bytes], end: bytes = b'\n') -> Iterator[bytes]:
+    """
+    Encode the merged `parts` as one JSON object, one part at a time.
+
+    The output matches `jsonify` of the merged dict as long as the parts come in sorted key order.
+    """
+    separator = b'{'
+    for part in parts:
+        for key in sorted(part):
+            yield b'%s%s:%s' % (separator, dumps(key), dumps(part[key]))
+            separator = b','
+    yield b'{}' + end if separator == b'{' else b'}' + end
+
+
+def iter_json_objects(objects: Iterable[Tuple[str, Iterable[Dict]]], dumps: Callable[[Any], bytes]) -> Iterator[bytes]:
+    """
+    Encode `{key: merged parts}` of the (key, parts) `objects` as one JSON object, one chunk per key.
+
+    The output matches `jsonify` of the whole as long as the keys and the keys of the parts come in sorted order.
+    """
+    separator = b'{'
+    for key, parts in objects:
+        yield b'%s%s:%s' % (separator, dumps(key), b''.join(iter_json_object(parts, dumps, end=b'')))
+        separator = b','
+    yield b'{}\n' if separator == b'{' else b'}\n'
+
+
+def stream_json_object(parts: Iterable[Dict]) -> Response:
+    """Response sent with chunked transfer encoding, it is never materialized in memory."""
+    return Response(
+        stream_with_context(iter_json_object(parts, current_app.json.dumps_compact)), mimetype='application/json',
+    )
+
+
+def stream_json_objects(objects: Iterable[Tuple[str, Iterable[Dict]]]) -> Response:
+    """Response of `iter_json_objects` sent with chunked transfer encoding."""
+    return Response(
+        stream_with_context(iter_json_objects(objects, current_app.json.dumps_compact)), mimetype='application/json',
+    )
@@ -0,0 +1,145 @@
+"""
+Precomputed availability table shared by all worker processes.
+
+The generated inventory of the availability horizon is written once into a fixed-layout binary file which each worker
+maps read-only, so it lives in the shared page cache instead of in per-process dicts. The generated counts only depend
+on the day, so the file holds one record per day, and the layout of every product (its timeslots and variants) that the
+records are rendered with. The file is tied to the catalog version, any change to a product rebuilds it.
+
+Layout (little endian):
+
+    header:   magic (8s), catalog version (8s), first day ordinal (I), days (I), products (I), timeslots (B),
+              variants (B)
+    days:     days records of open flag (B), available tickets (H), tickets per variant (H * variants)
+    products: products records of timeslots used (B), flags (B, HAS_PRICING)
+"""
+from datetime import date
+import fcntl
+import mmap
+import os
+import struct
+from typing import Optional, Tuple
+
+import arrow
+
+from . import availability
+from .availability import DayCounts, TIMESLOTS, day_counts, iter_days
+from .constants import MAX_DATE_RANGE, VARIANTS
+from .registry import CompiledProduct, ProductRegistry
+
+MAGIC = b'SSMAVT02'
+HEADER = struct.Struct('<8s8sIIIBB')
+LAYOUT = struct.Struct('<BB')
+HAS_PRICING = 1
+
+
+def _day_struct(variants: int) -> struct.Struct:
+    return struct.Struct(f'<BH{variants}H')
+
+
+def catalog_version(registry: ProductRegistry) -> bytes:
+    return bytes.fromhex(registry.version)
+
+
+def product_layout(product: CompiledProduct) -> Tuple[int, int]:
+    """(timeslots used, flags) of a product."""
+    return len(TIMESLOTS) if product.use_timeslots else 1, HAS_PRICING if product.provides_pricing else 0
+
+
+class AvailabilityTable:
+    """Read-only view of a table file."""
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < HEADER.size or self._mmap[:len(MAGIC)] != MAGIC:
+            self._mmap.close()
+            raise ValueError(f'{path} is not an availability table')
+        _, self.version, first_ordinal, self.days, self.products, self.timeslots, self.variants = (
+            HEADER.unpack_from(self._mmap, 0)
+        )
+        self.first_day = date.fromordinal(first_ordinal)
+        self._day = _day_struct(self.variants)
+        self._layouts_offset = HEADER.size + self.days * self._day.size
+
+    def close(self):
+        self._mmap.close()
+
+    def covers(self, day: date) -> bool:
+        return 0 <= day.toordinal() - self.first_day.toordinal() < self.days
+
+    def counts(self, product: CompiledProduct, day: date) -> DayCounts:
+        """Counts of every timeslot of a product and day. The day must be covered by the table."""
+        day_index = day.toordinal() - self.first_day.toordinal()
+        values = self._day.unpack_from(self._mmap, HEADER.size + day_index * self._day.size)
+        if not values[0]:
+            return None
+        return values[1], values[2:]
+
+    def layout(self, product: CompiledProduct) -> Tuple[int, int]:
+        """(timeslots used, flags) the table was built with for a product."""
+        return LAYOUT.unpack_from(self._mmap, self._layouts_offset + product.index * LAYOUT.size)
+
+    def matches(self, registry: ProductRegistry, first_day: date, days: int) -> bool:
+        """Whether the table was built for the catalog and horizon."""
+        return (
+            self.version == catalog_version(registry)
+            and self.products == len(registry)
+            and self.first_day == first_day
+            and self.days == days
+            and self.timeslots == len(TIMESLOTS)
+            and self.variants == len(VARIANTS)
+            and all(self.layout(product) == product_layout(product) for product in registry.products)
+        )
+
+
+def build(path: str, registry: ProductRegistry, first_day: date, days: int):
+    """Write the table to a temporary file and move it into place, readers never see a partial file."""
+    variants = len(VARIANTS)
+    day_record = _day_struct(variants)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(
+            MAGIC, catalog_version(registry), first_day.toordinal(), days, len(registry), len(TIMESLOTS), variants,
+        ))
+        for day in iter_days(first_day, date.fromordinal(first_day.toordinal() + days - 1)):
+            counts = day_counts(day)
+            if counts is None:
+                f.write(day_record.pack(0, 0, *([0] * variants)))
+            else:
+                f.write(day_record.pack(1, counts[0], *counts[1]))
+        f.write(b''.join(LAYOUT.pack(*product_layout(product)) for product in registry.products))
+    os.replace(tmp_path, path)
+
+
+def open_or_build(path: str, registry: ProductRegistry, first_day: date, days: int) -> AvailabilityTable:
+    """
+    Map the table at `path`, building it first when it is missing or stale.
+
+    Worker processes starting at the same time serialize on a lock file, so the table is only generated once.
+    """
+    with open(f'{path}.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            table: Optional[AvailabilityTable] = None
+            if os.path.exists(path):
+                try:
+                    table = AvailabilityTable(path)
+                except ValueError:  # a table of a previous format
+                    table = None
+                if table is not None and not table.matches(registry, first_day, days):
+                    table.close()
+                    table = None
+            if table is None:
+                build(path, registry, first_day, days)
+                table = AvailabilityTable(path)
+            return table
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def install(path: str, registry: ProductRegistry):
+    """Serve the availability horizon (today up to `MAX_DATE_RANGE` months ahead) from the table at `path`."""
+    today = date.today()
+    last_day = arrow.get(today).shift(months=MAX_DATE_RANGE).date()
+    availability.table = open_or_build(path, registry, today, (last_day - today).days + 1)
@@ -1,12 +1,12 @@
-from base64 import b64encode, b64decode
+from base64 import b64decode
 from datetime import date, datetime
 import json
-from decimal import Decimal
-from typing import Dict, Optional
-from typing import Set
+from typing import Dict, List, Optional
 
-from .constants import PRODUCTS, VARIANTS, PRODUCTS_CURRENCIES
+from . import availability, ids
+from .availability import str_to_int  # noqa: F401
 from .exceptions import BadRequest
+from .registry import registry
 
 
 def get_date(data, name, required=True) -> Optional[date]:
@@ -21,47 +21,9 @@ def get_date(data, name, required=True) -> Optional[date]:
         raise BadRequest(2000, 'Malformed datetime', f'Incorrect date format {data_str}, please use the YYYY-MM-DD format')
 
 
-def check_product_id(product_id: str):
-    if product_id not in [p['id'] for p in PRODUCTS]:
-        raise BadRequest(1001, 'Missing product', f"Product with ID {product_id} doesn't exist")
-
-
-def product_supports_timeslot(product_id: str) -> bool:
-    return product_id in [p['id'] for p in PRODUCTS if p['use_timeslots']]
-
-
-def product_provides_pricing(product_id: str) -> bool:
-    return product_id in [p['id'] for p in PRODUCTS if p['provides_pricing']]
-
-
-def product_required_additional_order_data(product_id: str) -> Set[str]:
-    for p in PRODUCTS:
-        if p['id'] == product_id:
-            return set(p.get('required_order_data', []))
-    return set()
-
-
-def product_required_additional_visitors_data(product_id: str) -> Set[str]:
-    for p in PRODUCTS:
-        if p['id'] == product_id:
-            return set(p.get('required_visitor_data', []))
-    return set()
-
-
-def timeslot_available_tickets_is_sum(product_id: str) -> bool:
-    for p in PRODUCTS:
-        if p['id'] == product_id:
-            return p.get('_timeslot_available_tickets_as_sum')
-    return False
-
-
-def str_to_int(some_str, number_of_digits) -> int:
-    return int(str(abs(hash(some_str)) % (10 ** 8))[:number_of_digits])
-
-
 def get_availability(product_id: str, day: date) -> Dict:
     """
-    Fake randomness generator.
+    Fake randomness generator, see `availability` for the range engine behind it.
 
     This supports both products with and without timeslots.
 
@@ -96,82 +58,66 @@ def get_availability(product_id: str, day: date) -> Dict:
 
         The `price` attribute is optional but MUST be present if the product's `provides_pricing` is `True`.
     """
+    return availability.get_day(registry.require(product_id), day)
 
-    timeslots = [f'{day.isoformat()}T00:00']
-    if product_supports_timeslot(product_id):
-        timeslots = [f'{day.isoformat()}T17:30', f'{day.isoformat()}T19:30']
-
-    result = {}
-
-    if day.isoweekday() == 7:
-        for timeslot in timeslots:
-            result[timeslot] = {}
-        return result
-
-    number_of_digits = 1 if day.isoweekday() % 3 == 0 else 2
-
-    product_supports_pricing = product_provides_pricing(product_id)
 
-    for timeslot in timeslots:
-        max_tickets = str_to_int(day.isoformat(), number_of_digits)
-        tickets_left = max_tickets
-        timeslot_available_tickets = 0
-
-        variants = []
-        for i, variant in enumerate(VARIANTS, 1):
-            if i == len(VARIANTS):
-                variant_max_ticket = tickets_left
-            else:
-                variant_max_ticket = min(
-                    tickets_left,
-                    str_to_int(f'{i * day.isoweekday()}{day.isoformat()}', number_of_digits)
-                )
-                tickets_left -= variant_max_ticket
-
-            current_variant = {
-                'id': str(i), 'name': variant, 'available_tickets': variant_max_ticket,
-            }
-
-            if product_supports_pricing:
-                current_variant['price'] = {
-                    'amount': f"{Decimal('12.45') * i}",
-                    'currency': PRODUCTS_CURRENCIES.get(product_id, 'EUR'),
-                }
-
-            variants.append(current_variant)
-
-            if variant_max_ticket > timeslot_available_tickets:
-                timeslot_available_tickets = variant_max_ticket
-
-        result[timeslot] = {
-            'available_tickets': max_tickets if timeslot_available_tickets_is_sum else timeslot_available_tickets,
-            'variants': variants,
-        }
-
-    return result
-
-
-def encode_barcode(some_str):
-    return b64encode(some_str.encode()).decode()
+def ticket_quantities(tickets: List[Dict]) -> Dict[str, int]:
+    """Requested quantity per variant id."""
+    quantities: Dict[str, int] = {}
+    for ticket in tickets:
+        variant_id = str(ticket['variant_id'])
+        quantities[variant_id] = quantities.get(variant_id, 0) + ticket['quantity']
+    return quantities
 
 
 def encode_reservation_id(expires_at: datetime, tickets: list, product_id: str, booking_date: datetime) -> str:
-    variants_quantity_map = {ticket['variant_id']: ticket['quantity'] for ticket in tickets}
-    json_content = json.dumps([expires_at.isoformat(), variants_quantity_map, product_id, booking_date.isoformat()])
-    return b64encode(json_content.encode()).replace(b'=', b'!').decode()
+    return ids.encode_reservation_id(expires_at, ticket_quantities(tickets), product_id, booking_date)
 
 
-def encode_booking_id(booking_date_str, product_id):
-    json_content = json.dumps([booking_date_str, product_id])
-    return b64encode(json_content.encode()).replace(b'=', b'!').decode()
+def encode_booking_id(booking_date_str, product_id, reservation_id):
+    return ids.encode_booking_id(datetime.fromisoformat(booking_date_str), product_id, reservation_id)
 
 
 def decode_booking_data(booking_id: str):
+    if ids.is_legacy(booking_id):
+        return _decode_legacy_booking_data(booking_id)
+    booked_for, product_id = ids.decode_booking_id(booking_id)
+    return booked_for.isoformat(), product_id
+
+
+def decode_reservation_data(reservation_id: str) -> tuple:
+    """
+    Expiry, quantity per variant id, product id and booked time of a reservation ID. Raises ValueError when the
+    quantities are not a booking of the product's variants, legacy IDs are not signed.
+    """
+    if ids.is_legacy(reservation_id):
+        data = _decode_legacy_reservation_data(reservation_id)
+    else:
+        data = ids.decode_reservation_id(reservation_id)
+    _check_quantities(data[1], data[2])
+    return data
+
+
+def _check_quantities(variants_quantity_map, product_id: str):
+    product = registry.get(product_id)
+    if product is None:
+        raise ValueError(f'Unknown product {product_id!r}')
+    variant_ids = {variant_id for variant_id, _, _ in availability.get_layout(product).variants}
+    if not isinstance(variants_quantity_map, dict) or not variants_quantity_map:
+        raise ValueError('A reservation must hold tickets')
+    for variant_id, quantity in variants_quantity_map.items():
+        if str(variant_id) not in variant_ids:
+            raise ValueError(f'Unknown variant {variant_id!r}')
+        if not isinstance(quantity, int) or isinstance(quantity, bool) or not 0 <= quantity <= ids.MAX_QUANTITY:
+            raise ValueError(f'Invalid quantity {quantity!r} of variant {variant_id!r}')
+
+
+def _decode_legacy_booking_data(booking_id: str):
     json_content = json.loads(b64decode(booking_id.replace('!', '=')).decode())
     return json_content[0], json_content[1]
 
 
-def decode_reservation_data(reservation_id: str) -> tuple:
+def _decode_legacy_reservation_data(reservation_id: str) -> tuple:
     json_content = json.loads(b64decode(reservation_id.replace('!', '=')).decode())
     expires_at = datetime.fromisoformat(json_content[0])
     variants_quantity_map = json_content[1]